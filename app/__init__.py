@@ -8,7 +8,6 @@ from flask import Flask
 from flask_login import LoginManager
 from flask_sqlalchemy import SQLAlchemy
 import logging
-from logging.handlers import RotatingFileHandler
 import os
 from dotenv import load_dotenv
 
@@ -40,6 +39,16 @@ def create_app(config_name=None):
     from config import config
     app.config.from_object(config.get(config_name, config['default']))
     
+    # Pool connessioni esplicito per MySQL (SQLite usa il pool di default)
+    if not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+        app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {
+            'pool_size': 10,
+            'max_overflow': 20,
+            'pool_timeout': 30,
+            'pool_pre_ping': True,   # Evita connessioni chiuse da wait_timeout
+            'pool_recycle': 280
+        })
+    
     # Validazione SECRET_KEY
     if not app.config.get('SECRET_KEY'):
         app.logger.warning('SECRET_KEY non configurata! Usando valore temporaneo (NON sicuro per produzione)')
@@ -48,6 +57,10 @@ def create_app(config_name=None):
     # ===== LOGGING =====
     configure_logging(app)
     
+    # Validazione GROQ_API_KEY (segnalata una sola volta, non ad ogni chiamata AI)
+    if not app.config.get('GROQ_API_KEY'):
+        app.logger.warning('GROQ_API_KEY non configurata: le funzioni AI useranno i fallback locali')
+    
     # ===== INIZIALIZZA ESTENSIONI =====
     db.init_app(app)
     
@@ -69,6 +82,32 @@ def create_app(config_name=None):
     register_routes(app)
     
     # ===== CREA DATABASE =====
+    # Solo se richiesto (FF_INIT_DB=1): con N worker gunicorn evita N create_all()
+    # ad ogni riavvio. In produzione eseguire una volta `flask --app app init-db`.
+    if os.environ.get('FF_INIT_DB') == '1':
+        init_db(app)
+    
+    @app.cli.command('init-db')
+    def init_db_command():
+        """Crea le tabelle mancanti e i badge di default."""
+        init_db(app)
+    
+    # ===== LOG STARTUP =====
+    app.logger.info(f'FoodFlow started in {config_name} mode')
+    try:
+        # Ricavato dall'URI: nessun app_context né creazione engine solo per il log
+        from sqlalchemy.engine import make_url
+        engine_name = make_url(app.config['SQLALCHEMY_DATABASE_URI']).get_backend_name()
+    except Exception as e:
+        app.logger.warning(f'Could not determine database engine: {e}')
+        engine_name = 'Unknown'
+    app.logger.info(f'Database engine: {engine_name}')
+    
+    return app
+
+
+def init_db(app):
+    """Crea tabelle (se non esistono) e dati base"""
     with app.app_context():
         try:
             # Per MySQL: crea tabelle solo se non esistono
@@ -81,23 +120,11 @@ def create_app(config_name=None):
         except Exception as e:
             app.logger.error(f'Database initialization error: {e}')
             app.logger.warning('Continuando senza inizializzazione DB. Verifica connessione MySQL.')
-    
-    # ===== LOG STARTUP =====
-    app.logger.info(f'FoodFlow started in {config_name} mode')
-    try:
-        with app.app_context():
-            engine = db.get_engine()
-            engine_name = engine.name if hasattr(engine, 'name') else str(engine.url.drivername)
-    except Exception as e:
-        app.logger.warning(f'Could not determine database engine: {e}')
-        engine_name = 'Unknown'
-    app.logger.info(f'Database engine: {engine_name}')
-    
-    return app
 
 
 def configure_logging(app):
     """Configura logging per l'applicazione"""
+    from logging.handlers import RotatingFileHandler, MemoryHandler
     
     # Livello log
     log_level = logging.INFO
@@ -107,12 +134,13 @@ def configure_logging(app):
     if not os.path.exists('logs'):
         os.mkdir('logs')
     
-    # File handler con rotazione
+    # File handler con rotazione (file aperto solo alla prima scrittura)
     file_handler = RotatingFileHandler(
         'logs/foodflow.log',
-        maxBytes=10485760,  # 10MB
+        maxBytes=52428800,  # 50MB
         backupCount=10,
-        encoding='utf-8'  # Importante per caratteri speciali
+        encoding='utf-8',  # Importante per caratteri speciali
+        delay=True
     )
     
     file_handler.setFormatter(logging.Formatter(
@@ -120,7 +148,18 @@ def configure_logging(app):
     ))
     
     file_handler.setLevel(log_level)
-    app.logger.addHandler(file_handler)
+    
+    # Buffer in memoria: scrive su file a blocchi, subito in caso di ERROR
+    buffered_handler = MemoryHandler(
+        capacity=1024,
+        flushLevel=logging.ERROR,
+        target=file_handler
+    )
+    buffered_handler.setLevel(log_level)
+    app.logger.addHandler(buffered_handler)
+    
+    # Riduci il rumore delle librerie HTTP
+    logging.getLogger('urllib3').setLevel(logging.WARNING)
     
     app.logger.info('Logging configured')
 
@@ -197,16 +236,16 @@ def initialize_database(app):
     ]
     
     try:
-        badges_created = 0
-        for badge_data in default_badges:
-            # Controlla se badge esiste già
-            existing = Badge.query.filter_by(name=badge_data['name']).first()
-            if not existing:
-                badge = Badge(**badge_data)
-                db.session.add(badge)
-                badges_created += 1
+        # Una sola SELECT per tutti i badge già presenti
+        wanted = [b['name'] for b in default_badges]
+        existing = {
+            name for (name,) in db.session.query(Badge.name).filter(Badge.name.in_(wanted)).all()
+        }
+        to_add = [Badge(**b) for b in default_badges if b['name'] not in existing]
+        badges_created = len(to_add)
         
         if badges_created > 0:
+            db.session.bulk_save_objects(to_add)
             db.session.commit()
             app.logger.info(f'Initialized {badges_created} new badges')
         else:
@@ -0,0 +1,106 @@
+"""
+AI Cache - FoodFlow
+Cache in-process (LRU + TTL) per le risposte AI: evita di ripetere chiamate
+LLM identiche (stessa dispensa, stesse preferenze) entro la scadenza
+"""
+
+import copy
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+# ========================================
+# CONSTANTS
+# ========================================
+
+DEFAULT_TTL = 600        # 10 minuti
+DEFAULT_MAXSIZE = 2048
+
+
+# ========================================
+# TTL CACHE
+# ========================================
+
+class TTLCache:
+    """Cache LRU con scadenza (TTL), thread-safe, limitata a maxsize voci."""
+
+    def __init__(self, maxsize=DEFAULT_MAXSIZE, ttl=DEFAULT_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = (time.monotonic() + (ttl or self.ttl), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            return item[1] if item is not None else default
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+# Cache condivisa per le risposte AI
+_STORE = TTLCache()
+
+
+# ========================================
+# API
+# ========================================
+
+def make_key(namespace, payload):
+    """
+    Chiave esatta: sha256 del payload serializzato in forma canonica
+
+    Args:
+        namespace: prefisso (es. 'recipes', 'meal_plan')
+        payload: dati JSON-serializzabili che determinano la risposta
+
+    Returns:
+        str: chiave cache
+    """
+    raw = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+    return f"{namespace}:{hashlib.sha256(raw.encode('utf-8')).hexdigest()}"
+
+
+def get(key):
+    """Ritorna una copia del valore in cache (None se assente o scaduto)."""
+    value = _STORE.get(key)
+    # Copia: i chiamanti modificano i risultati in place (porzioni, unità...)
+    return copy.deepcopy(value) if value is not None else None
+
+
+def set(key, value, ttl=None):
+    """Salva una copia del valore in cache con TTL opzionale (secondi)."""
+    _STORE.set(key, copy.deepcopy(value), ttl)
+
+
+def delete(key):
+    """Rimuove una voce dalla cache."""
+    _STORE.pop(key)
+
+
+def clear():
+    """Svuota la cache."""
+    _STORE.clear()
@@ -4,25 +4,484 @@ Funzioni basate su AI/LLM per suggerimenti intelligenti
 """
 
 import os
+import re
+import copy
 import json
+import hashlib
+import time
+import random
+import threading
+from collections import deque
+from functools import lru_cache
+from concurrent.futures import Future, ThreadPoolExecutor
+import orjson
 import requests
-from datetime import datetime, timedelta
-from flask import current_app
+from datetime import date, datetime, timedelta
+from flask import current_app, g, has_app_context
+from sqlalchemy import case, func, or_, select
 from dotenv import load_dotenv
 
 # Carica variabili d'ambiente dal file .env
 load_dotenv()
 
+from . import db, ai_cache
 from .models import Product, NutritionalProfile, MealPlan, NutritionalGoal, UserStats, User
 
+# Parser JSON veloce (orjson.JSONDecodeError è sottoclasse di
+# json.JSONDecodeError, quindi gli except esistenti restano validi)
+_json_loads = orjson.loads
+_json_dumps_bytes = orjson.dumps
+
+
+def _json_loads_lenient(text):
+    """
+    Parse veloce (orjson); se fallisce riprova con json in modalità non
+    stretta, che accetta i caratteri di controllo nelle stringhe (es. a capo
+    non escapati), l'errore più frequente nel JSON generato dall'LLM
+    """
+    try:
+        return _json_loads(text)
+    except ValueError:
+        return json.loads(text, strict=False)
+
+
+# Recinto markdown ```json ... ``` attorno alle risposte JSON dell'LLM
+_FENCE_RE = re.compile(r'^\s*```(?:json)?\s*\n?(.*?)\n?\s*```\s*$', re.DOTALL)
+
+
+def _strip_fence(content):
+    """Rimuove l'eventuale recinto markdown (```json ... ```) e gli spazi esterni"""
+    if '```' not in content:
+        return content.strip()
+    m = _FENCE_RE.match(content)
+    return m.group(1) if m else content.strip()
+
+
+# Primo oggetto {...} in una risposta con testo attorno
+_JSON_OBJ_RE = re.compile(r'\{.*\}', re.DOTALL)
+
+
+def _extract_json_object(content):
+    """Oggetto JSON dalla risposta: parse diretto (caso comune), altrimenti il {...} nel testo"""
+    try:
+        data = _json_loads(content)
+        if isinstance(data, dict):
+            return data
+    except ValueError:
+        pass
+    m = _JSON_OBJ_RE.search(content)
+    return _json_loads(m.group()) if m else None
+
+
 # ========================================
 # CONSTANTS
 # ========================================
 
 GROQ_API_URL = "https://api.groq.com/openai/v1/chat/completions"
 DEFAULT_MODEL = "llama-3.3-70b-versatile"
+INSTANT_MODEL = "llama-3.1-8b-instant"
+
+# Modelli per fascia di latenza: 'instant' per output JSON semplici,
+# 'balanced' dove conta la qualità (ricette, piani pasti, chatbot)
+MODEL_TIERS = {
+    'instant': INSTANT_MODEL,
+    'balanced': DEFAULT_MODEL
+}
 DEFAULT_MAX_TOKENS = 2000
 DEFAULT_TEMPERATURE = 0.7
+MAX_COMPLETION_TOKENS = 8000  # Tetto per le richieste batch
+
+# Chiave API letta una sola volta all'import (load_dotenv è già stato eseguito);
+# l'assenza viene segnalata una volta sola all'avvio in create_app()
+GROQ_API_KEY = os.environ.get('GROQ_API_KEY')
+
+_HEADERS = {
+    "Authorization": f"Bearer {GROQ_API_KEY}",
+    "Content-Type": "application/json"
+}
+
+# Sessione HTTP condivisa: riusa connessioni TCP/TLS verso Groq (keep-alive).
+# Creata al primo utilizzo per non pesare sull'avvio dell'app.
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+
+
+def _get_session():
+    """Ritorna la requests.Session condivisa, creandola alla prima chiamata."""
+    global _SESSION
+    if _SESSION is None:
+        # Lock: i thread del pool AI possono arrivare qui insieme al primo avvio
+        # e creerebbero due sessioni (e due pool di connessioni)
+        with _SESSION_LOCK:
+            if _SESSION is None:
+                from requests.adapters import HTTPAdapter
+                from urllib3.util.retry import Retry
+
+                session = requests.Session()
+                session.headers.update(_HEADERS)
+                session.mount("https://", HTTPAdapter(
+                    pool_connections=16,
+                    pool_maxsize=64,
+                    max_retries=Retry(
+                        total=3,
+                        backoff_factor=0.3,
+                        status_forcelist=[429, 500, 502, 503, 504],
+                        allowed_methods=frozenset({'POST'}),
+                        raise_on_status=False
+                    )
+                ))
+                _SESSION = session
+    return _SESSION
+
+
+# ========================================
+# RATE LIMITING
+# ========================================
+
+class GroqRateLimiter:
+    """
+    Token bucket proattivo su finestra mobile di 60s: traccia richieste (RPM)
+    e token stimati (TPM) e attende PRIMA della chiamata quando si supera
+    il 90% dei limiti, invece di accumulare errori 429 e retry.
+    """
+
+    WINDOW = 60.0
+
+    def __init__(self, rpm, tpm=None, headroom=0.9):
+        self.rpm_limit = max(1, int(rpm * headroom))
+        # tpm None = nessun limite sui token (solo richieste/minuto)
+        self.tpm_limit = max(1, int(tpm * headroom)) if tpm else None
+        self._requests = deque()   # timestamp richieste
+        self._tokens = deque()     # (timestamp, token)
+        self._token_total = 0
+        self._lock = threading.Lock()
+
+    def _evict(self, now):
+        cutoff = now - self.WINDOW
+        while self._requests and self._requests[0] <= cutoff:
+            self._requests.popleft()
+        while self._tokens and self._tokens[0][0] <= cutoff:
+            self._token_total -= self._tokens.popleft()[1]
+
+    def acquire(self, estimated_tokens=0):
+        """Attende finché la richiesta rientra nei limiti; ritorna i secondi attesi."""
+        # Una singola richiesta più grande del limite non deve bloccare per sempre
+        tokens = max(0, int(estimated_tokens))
+        if self.tpm_limit:
+            tokens = min(tokens, self.tpm_limit)
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._evict(now)
+                wait = 0.0
+                if len(self._requests) >= self.rpm_limit:
+                    wait = self._requests[0] + self.WINDOW - now
+                if self.tpm_limit and self._tokens and self._token_total + tokens > self.tpm_limit:
+                    wait = max(wait, self._tokens[0][0] + self.WINDOW - now)
+                if wait <= 0:
+                    self._requests.append(now)
+                    self._tokens.append((now, tokens))
+                    self._token_total += tokens
+                    return waited
+            time.sleep(wait)
+            waited += wait
+
+
+# Limiti del proprio piano Groq (default: 30 RPM, TPM non limitato)
+_RATE_LIMITER = GroqRateLimiter(
+    rpm=int(os.environ.get('GROQ_RPM', 30)),
+    tpm=int(os.environ.get('GROQ_TPM', 0))
+)
+
+
+def _estimate_tokens(body):
+    """Stima grossolana: ~4 caratteri per token nel prompt + token massimi in uscita."""
+    prompt_chars = sum(len(m.get('content') or '') for m in body.get('messages', []))
+    return prompt_chars // 4 + int(body.get('max_tokens') or 0)
+
+
+class _GroqResult:
+    """
+    Risposta Groq non in streaming già letta per intero: solo status e bytes,
+    immutabile e quindi condivisibile tra i thread che coalescono la chiamata
+    """
+    __slots__ = ('status_code', 'content')
+    
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+    
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+
+# Chiamate Groq identiche in corso: {chiave del body: Future del _GroqResult}
+_INFLIGHT = {}
+_INFLIGHT_LOCK = threading.Lock()
+
+
+def _groq_send(body, payload, timeout=30, stream=False):
+    """
+    POST verso Groq tramite sessione condivisa, dopo il controllo rate limit.
+    payload è il body già serializzato (bytes): gli header (_HEADERS) sono sulla sessione.
+    """
+    waited = _RATE_LIMITER.acquire(_estimate_tokens(body))
+    if waited:
+        current_app.logger.info("Groq rate limiter: attesa %.1fs", waited)
+    return _get_session().post(GROQ_API_URL, data=payload, timeout=timeout, stream=stream)
+
+
+def _groq_post(body, timeout=30, stream=False):
+    """
+    POST verso Groq con coalescenza delle richieste identiche: se la stessa
+    chiamata è già in corso (es. due schede che rigenerano lo stesso piano),
+    si attende quella invece di farne un'altra. Si condivide solo il risultato
+    decodificato (_GroqResult), mai la Response di requests; se la chiamata
+    condivisa fallisce, chi attendeva riprova con una richiesta propria.
+    In streaming ritorna la Response (non coalescente).
+    """
+    # Body serializzato una sola volta: stessi bytes per l'invio e per la chiave
+    payload = _json_dumps_bytes(body)
+    if stream:
+        return _groq_send(body, payload, timeout, stream=True)
+    
+    key = hashlib.sha256(payload).hexdigest()
+    with _INFLIGHT_LOCK:
+        future = _INFLIGHT.get(key)
+        owner = future is None
+        if owner:
+            future = _INFLIGHT[key] = Future()
+    if not owner:
+        if future.exception() is None:
+            return future.result()
+        return _groq_fetch(body, payload, timeout)
+    
+    try:
+        result = _groq_fetch(body, payload, timeout)
+        future.set_result(result)
+        return result
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _INFLIGHT_LOCK:
+            _INFLIGHT.pop(key, None)
+
+
+def _groq_fetch(body, payload, timeout):
+    """Invio non in streaming: legge la risposta e la chiude, ritorna un _GroqResult"""
+    with _groq_send(body, payload, timeout) as response:
+        return _GroqResult(response.status_code, response.content)
+
+
+# ========================================
+# STREAMING
+# ========================================
+
+def _groq_stream(body, timeout=30):
+    """
+    Chiamata Groq in streaming (SSE): ritorna un generatore dei frammenti di
+    testo (delta.content) man mano che il modello li produce.
+    Solleva RuntimeError se Groq non risponde 200.
+    """
+    response = _groq_post(dict(body, stream=True), timeout=timeout, stream=True)
+    if response.status_code != 200:
+        text = response.text
+        response.close()
+        raise RuntimeError(f"Groq API error: {response.status_code} - {text}")
+    return _iter_sse_content(response)
+
+
+def _iter_sse_content(response):
+    """Legge le righe SSE 'data: {...}' fino a '[DONE]' e ritorna i delta di testo."""
+    try:
+        for line in response.iter_lines():
+            if not line or not line.startswith(b'data:'):
+                continue
+            data = line[5:].strip()
+            if data == b'[DONE]':
+                break
+            try:
+                event = _json_loads(data)
+            except ValueError:
+                continue
+            delta = (event.get('choices') or [{}])[0].get('delta') or {}
+            content = delta.get('content')
+            if content:
+                yield content
+    finally:
+        response.close()
+
+
+class IncrementalJsonParser:
+    """
+    Parser JSON incrementale: riceve il testo a frammenti (come arriva dallo
+    stream) e restituisce ogni oggetto {...} appena chiuso dentro un array,
+    insieme al percorso delle chiavi che lo contengono (es. ['meal_plan', 'monday']);
+    alla chiusura di un array restituisce (percorso, ARRAY_END).
+    Scansione O(n) con stack delle parentesi, senza regex; il testo fuori dal
+    JSON (es. recinti ```json) viene ignorato.
+    """
+
+    # Marcatore di fine array (es. fine dei pasti di un giorno)
+    ARRAY_END = object()
+
+    def __init__(self):
+        self._stack = []          # contenitori aperti: [tipo, chiave corrente]
+        self._in_string = False
+        self._escape = False
+        self._key_buf = None      # stringa in lettura fuori dagli oggetti catturati
+        self._last_string = None
+        self._capture = None      # testo dell'oggetto in costruzione
+        self._capture_depth = 0
+
+    def feed(self, chunk):
+        """Aggiunge un frammento; ritorna la lista di (percorso, oggetto) completati."""
+        completed = []
+        stack = self._stack
+        for ch in chunk:
+            if self._capture is not None:
+                self._capture.append(ch)
+            
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == '\\':
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    if self._key_buf is not None:
+                        raw = ''.join(self._key_buf)
+                        try:
+                            self._last_string = _json_loads(f'"{raw}"')
+                        except ValueError:
+                            self._last_string = raw
+                        self._key_buf = None
+                    continue
+                if self._key_buf is not None:
+                    self._key_buf.append(ch)
+                continue
+            
+            if ch == '"':
+                self._in_string = True
+                self._key_buf = [] if self._capture is None else None
+            elif ch == '{' or ch == '[':
+                # Nuovo oggetto dentro un array: inizia a catturarne il testo
+                if ch == '{' and self._capture is None and stack and stack[-1][0] == '[':
+                    self._capture = [ch]
+                    self._capture_depth = len(stack)
+                stack.append([ch, None])
+            elif ch == '}' or ch == ']':
+                if not stack:
+                    continue
+                stack.pop()
+                if ch == ']' and self._capture is None:
+                    completed.append(([frame[1] for frame in stack if frame[0] == '{'], self.ARRAY_END))
+                elif self._capture is not None and len(stack) == self._capture_depth:
+                    text = ''.join(self._capture)
+                    self._capture = None
+                    try:
+                        obj = _json_loads(text)
+                    except ValueError:
+                        continue
+                    path = [frame[1] for frame in stack if frame[0] == '{']
+                    completed.append((path, obj))
+            elif ch == ':' and self._capture is None and stack and stack[-1][0] == '{':
+                stack[-1][1] = self._last_string
+        
+        return completed
+
+
+class JsonStringFieldStream:
+    """
+    Estrae in streaming il valore (stringa) di un campo JSON, es. "response":
+    feed(chunk) ritorna il testo del campo arrivato con il frammento, già
+    decodificato; gli escape spezzati tra due frammenti attendono il successivo.
+    """
+
+    _VALUE_START_RE = re.compile(r'\s*:\s*"')
+    # Escape di surrogato alto in coda: va decodificato insieme al basso
+    _HIGH_SURROGATE_RE = re.compile(r'\\u[dD][89abAB][0-9a-fA-F]{2}$')
+
+    def __init__(self, field):
+        self._key = f'"{field}"'
+        self._buf = ''
+        self._pos = None          # inizio del testo non ancora emesso
+        self._done = False
+
+    def feed(self, chunk):
+        self._buf += chunk
+        if self._done:
+            return ''
+        buf = self._buf
+        if self._pos is None:
+            k = buf.find(self._key)
+            m = self._VALUE_START_RE.match(buf, k + len(self._key)) if k != -1 else None
+            if not m:
+                return ''
+            self._pos = m.end()
+
+        i, n = self._pos, len(buf)
+        while i < n:
+            ch = buf[i]
+            if ch == '\\':
+                step = 6 if buf[i + 1:i + 2] == 'u' else 2
+                if i + step > n:
+                    break
+                i += step
+            elif ch == '"':
+                self._done = True
+                break
+            else:
+                i += 1
+
+        if not self._done and self._HIGH_SURROGATE_RE.search(buf, self._pos, i):
+            i -= 6
+        raw = buf[self._pos:i]
+        if not raw:
+            return ''
+        try:
+            text = _json_loads(f'"{raw}"')
+        except ValueError:
+            # Escape incompleto: si riprova col frammento successivo
+            return ''
+        self._pos = i
+        return text
+
+
+# ========================================
+# CONCURRENCY
+# ========================================
+
+# Pool di thread per chiamate AI concorrenti (I/O bound: il GIL viene
+# rilasciato durante l'attesa HTTP)
+_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix='foodflow-ai')
+# Pool separato per query DB brevi eseguite in parallelo: non resta in coda
+# dietro alle chiamate Groq (che possono durare decine di secondi)
+_DB_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix='foodflow-db')
+
+
+def _call_with_app_context(app, func, *args, **kwargs):
+    """Esegue func in un thread del pool con l'app context Flask attivo."""
+    with app.app_context():
+        return func(*args, **kwargs)
+
+
+def _in_ai_worker():
+    """True se il codice gira già in un thread del pool AI."""
+    return threading.current_thread().name.startswith('foodflow-ai')
+
+
+def submit_ai_task(func, *args, **kwargs):
+    """
+    Avvia func sul pool AI (con l'app context corrente) e ritorna subito un Future:
+    il chiamante può fare altro lavoro (query DB, altre chiamate AI) e poi
+    raccogliere il risultato con future.result()
+    """
+    app = current_app._get_current_object()
+    return _EXECUTOR.submit(_call_with_app_context, app, func, *args, **kwargs)
 
 
 # ========================================
@@ -41,8 +500,14 @@ def suggest_recipes(user_id, max_recipes=5, servings=None):
         list: Ricette con formato standardizzato
     """
     try:
-        # Recupera prodotti disponibili
-        products = Product.query.filter_by(user_id=user_id, wasted=False).all()
+        # Recupera prodotti disponibili: solo le colonne necessarie (Row leggere,
+        # niente oggetti ORM né identity map)
+        products = db.session.execute(
+            select(Product.name, Product.quantity, Product.unit).where(
+                Product.user_id == user_id,
+                Product.wasted == False
+            )
+        ).all()
         
         if not products:
             return []
@@ -56,21 +521,22 @@ def suggest_recipes(user_id, max_recipes=5, servings=None):
         if not recipes:
             return _generate_fallback_recipes(products[:5], max_recipes)
 
-        # Filtra per allergie e restrizioni utente
+        # Preferenze utente per il filtro
         try:
             restrictions, allergies = _get_user_restrictions_and_allergies(user_id)
-            if restrictions or allergies:
-                filtered = []
-                for recipe in recipes:
-                    if not _recipe_violates_preferences(recipe, restrictions, allergies):
-                        filtered.append(recipe)
-                recipes = filtered
         except Exception as _:
             # In caso di problemi col profilo, proseguiamo senza filtrare
-            pass
+            restrictions, allergies = set(), set()
+        # Controlli decisi una volta: con preferenze vuote nessuna chiamata per ricetta
+        allergen_re = _compile_allergen_pattern(allergies) if allergies else None
         
-        # Arricchisci, scala porzioni e normalizza unità
+        # Un solo passaggio: filtra, arricchisci, scala porzioni e normalizza unità
+        output = []
         for recipe in recipes:
+            if allergen_re is not None and _violates_allergies(recipe, allergen_re):
+                continue
+            if restrictions and _violates_restrictions(recipe, restrictions):
+                continue
             if 'nutritional_info' not in recipe:
                 recipe['nutritional_info'] = _estimate_nutrition_fallback()
             if 'tips' not in recipe:
@@ -82,53 +548,25 @@ def suggest_recipes(user_id, max_recipes=5, servings=None):
                 _scale_recipe_servings(recipe, servings)
             # Normalizza unità ingredienti
             _normalize_recipe_units(recipe)
+            output.append(recipe)
+        recipes = output
+        
         # Rimappa unità verso quelle della dispensa dell'utente quando possibile
-        _remap_recipe_units_to_pantry(recipes, user_id)
+        # (mappa nome -> unità costruita una volta dalle righe già caricate)
+        _remap_recipe_units_to_pantry(recipes, _build_pantry_units(products))
         
         return recipes
         
     except Exception as e:
-        current_app.logger.error(f"suggest_recipes error: {e}")
+        current_app.logger.error("suggest_recipes error: %s", e)
         try:
             return _generate_fallback_recipes(products[:5], max_recipes)
         except Exception:
             return []
 
 
-def ai_generate_recipe_suggestions(ingredients, user_id=None, max_recipes=5):
-    """
-    Genera ricette usando Groq AI
-    
-    Args:
-        ingredients: lista di tuple (nome, quantità, unità)
-        user_id: ID utente per personalizzazione
-        max_recipes: numero ricette da generare
-    
-    Returns:
-        list: Ricette in formato JSON
-    """
-    try:
-        api_key = os.getenv('GROQ_API_KEY')
-        
-        if not api_key:
-            current_app.logger.error("GROQ_API_KEY not configured")
-            return []
-        
-        if not ingredients:
-            return []
-        
-        # Recupera preferenze utente
-        dietary_info = _get_user_dietary_info(user_id) if user_id else "Nessuna preferenza"
-        restrictions, allergies = _get_user_restrictions_and_allergies(user_id) if user_id else (set(), set())
-        
-        # Formatta ingredienti per prompt
-        ingredients_text = "\n".join([
-            f"- {qty} {unit} di {name}" 
-            for name, qty, unit in ingredients
-        ])
-        
-        # Prepara prompt
-        system_prompt = """Sei uno chef esperto. Genera ricette in formato JSON valido.
+# Prompt di sistema costante: costruito una volta all'import
+_RECIPE_SYSTEM_PROMPT = """Sei uno chef esperto. Genera ricette in formato JSON valido.
 Formato richiesto:
 {
   "recipes": [
@@ -156,8 +594,15 @@ Formato richiesto:
     }
   ]
 }"""
-        
-        user_prompt = f"""Ingredienti disponibili:
+
+_RECIPE_SYSTEM_MSG = {"role": "system", "content": _RECIPE_SYSTEM_PROMPT}
+
+# Prompt utente: template costanti, per ogni chiamata solo i campi variabili
+_RECIPE_CONSTRAINTS = """CONSTRAINT IMPORTANTI:
+- Evita QUALSIASI ingrediente che corrisponda a queste allergie (case-insensitive, sinonimi comuni): {allergies}
+- Rispetta queste restrizioni dietetiche e includile in dietary_tags: {restrictions}"""
+
+_RECIPE_USER_PROMPT = """Ingredienti disponibili:
 {ingredients_text}
 
 Preferenze utente:
@@ -169,40 +614,91 @@ Genera {max_recipes} ricette creative che:
 3. Sono bilanciate nutrizionalmente
 4. Hanno istruzioni chiare e dettagliate
 
-CONSTRAINT IMPORTANTI:
-- Evita QUALSIASI ingrediente che corrisponda a queste allergie (case-insensitive, sinonimi comuni): {', '.join(sorted(allergies)) if allergies else 'nessuna'}
-- Rispetta queste restrizioni dietetiche e includile in dietary_tags: {', '.join(sorted(restrictions)) if restrictions else 'nessuna'}
+""" + _RECIPE_CONSTRAINTS + """
 
 Rispondi SOLO con JSON valido."""
+
+
+def _recipe_constraints(restrictions, allergies):
+    """Campi allergie/restrizioni dei prompt ricette ('nessuna' se vuoti)"""
+    return {
+        'allergies': ', '.join(sorted(allergies)) if allergies else 'nessuna',
+        'restrictions': ', '.join(sorted(restrictions)) if restrictions else 'nessuna'
+    }
+
+
+def ai_generate_recipe_suggestions(ingredients, user_id=None, max_recipes=5):
+    """
+    Genera ricette usando Groq AI
+    
+    Args:
+        ingredients: lista di tuple (nome, quantità, unità)
+        user_id: ID utente per personalizzazione
+        max_recipes: numero ricette da generare
+    
+    Returns:
+        list: Ricette in formato JSON
+    """
+    try:
+        if not GROQ_API_KEY:
+            return []
         
-        # Chiamata API
-        response = requests.post(
-            GROQ_API_URL,
-            headers={
-                "Authorization": f"Bearer {api_key}",
-                "Content-Type": "application/json"
-            },
-            json={
-                "model": DEFAULT_MODEL,
-                "messages": [
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ],
-                "max_tokens": DEFAULT_MAX_TOKENS,
-                "temperature": DEFAULT_TEMPERATURE
-            },
-            timeout=30
+        if not ingredients:
+            return []
+        
+        # Recupera preferenze utente
+        dietary_info = _get_user_dietary_info(user_id) if user_id else "Nessuna preferenza"
+        restrictions, allergies = _get_user_restrictions_and_allergies(user_id) if user_id else (set(), set())
+        
+        # Cache esatta: stessa dispensa + stesse preferenze = stesse ricette
+        cache_key = ai_cache.make_key('recipes', {
+            'user_id': user_id,
+            'model': DEFAULT_MODEL,
+            'max': max_recipes,
+            'ingredients': sorted((_normalize_token(n), q, u) for n, q, u in ingredients),
+            'dietary_info': dietary_info,
+            'restrictions': sorted(restrictions),
+            'allergies': sorted(allergies)
+        })
+        cached = ai_cache.get(cache_key)
+        if cached is not None:
+            return cached
+        
+        # Formatta ingredienti per prompt
+        ingredients_text = "\n".join([
+            f"- {qty} {unit} di {name}" 
+            for name, qty, unit in ingredients
+        ])
+        
+        # Prepara prompt
+        user_prompt = _RECIPE_USER_PROMPT.format(
+            ingredients_text=ingredients_text,
+            dietary_info=dietary_info,
+            max_recipes=max_recipes,
+            **_recipe_constraints(restrictions, allergies)
         )
         
+        # Chiamata API
+        body = {
+            "model": DEFAULT_MODEL,
+            "messages": [
+                _RECIPE_SYSTEM_MSG,
+                {"role": "user", "content": user_prompt}
+            ],
+            "max_tokens": DEFAULT_MAX_TOKENS,
+            "temperature": DEFAULT_TEMPERATURE
+        }
+        response = _groq_post(body, timeout=30)
+        
         if response.status_code != 200:
-            current_app.logger.error(f"Groq API error: {response.status_code} - {response.text}")
+            current_app.logger.error("Groq API error: %s - %s", response.status_code, response.text)
             return []
         
         # Parse response
         try:
-            payload = response.json()
-        except Exception as e:
-            current_app.logger.error(f"Groq API invalid JSON: {e}; body={response.text[:500]}")
+            payload = _json_loads(response.content)
+        except ValueError as e:
+            current_app.logger.error("Groq API invalid JSON: %s; body=%s", e, response.text[:500])
             return []
         content = (payload.get("choices") or [{}])[0].get("message", {}).get("content", "")
         if not content:
@@ -210,47 +706,40 @@ Rispondi SOLO con JSON valido."""
             return []
         
         # Estrai JSON (gestisce markdown code blocks)
-        content = content.strip()
-        if content.startswith("```json"):
-            content = content[7:]
-        if content.startswith("```"):
-            content = content[3:]
-        if content.endswith("```"):
-            content = content[:-3]
-        content = content.strip()
+        content = _strip_fence(content)
         
         # Parse JSON
         try:
-            data = json.loads(content)
-        except json.JSONDecodeError:
+            data = _json_loads_lenient(content)
+        except ValueError:
             # Prova a trovare un blocco JSON tra backticks o parentesi
             start = content.find('{')
             end = content.rfind('}')
-            if start != -1 and end != -1 and end > start:
-                try:
-                    data = json.loads(content[start:end+1])
-                except Exception as e:
-                    raise e
-            else:
+            if start == -1 or end <= start:
                 raise
+            data = _json_loads_lenient(content[start:end+1])
         
         # Estrai ricette
         if isinstance(data, dict) and "recipes" in data:
-            return data["recipes"]
+            recipes = data["recipes"]
         elif isinstance(data, list):
-            return data
+            recipes = data
         else:
             current_app.logger.warning("Unexpected AI response format")
             return []
         
+        if recipes:
+            ai_cache.set(cache_key, recipes)
+        return recipes
+        
     except json.JSONDecodeError as e:
-        current_app.logger.error(f"JSON parse error: {e}")
+        current_app.logger.error("JSON parse error: %s", e)
         return []
     except requests.Timeout:
         current_app.logger.error("Groq API timeout")
         return []
     except Exception as e:
-        current_app.logger.error(f"ai_generate_recipe_suggestions error: {e}")
+        current_app.logger.error("ai_generate_recipe_suggestions error: %s", e)
         return []
 
 
@@ -258,18 +747,8 @@ Rispondi SOLO con JSON valido."""
 # AI INGREDIENT EXTRACTION
 # ========================================
 
-def ai_extract_ingredients(meal_description):
-    """
-    Estrae ingredienti strutturati da testo libero con AI.
-    Ritorna lista di dict: {item, quantity, unit}
-    """
-    try:
-        api_key = os.getenv('GROQ_API_KEY')
-        if not api_key:
-            # Senza AI, ritorna vuoto per far usare il parser locale
-            return []
-
-        system_prompt = """Sei un assistente culinario. Estrai ingredienti da testo libero.
+# Prompt di sistema costante: costruito una volta all'import
+_EXTRACT_SYSTEM_PROMPT = """Sei un assistente culinario. Estrai ingredienti da testo libero.
 Respondi SOLO con JSON valido:
 {
   "ingredients": [
@@ -283,21 +762,29 @@ Regole:
 - Se non trovi quantità/unità, ometti quell'ingrediente
 """
 
+_EXTRACT_SYSTEM_MSG = {"role": "system", "content": _EXTRACT_SYSTEM_PROMPT}
+
+
+def ai_extract_ingredients(meal_description):
+    """
+    Estrae ingredienti strutturati da testo libero con AI.
+    Ritorna lista di dict: {item, quantity, unit}
+    """
+    try:
+        if not GROQ_API_KEY:
+            # Senza AI, ritorna vuoto per far usare il parser locale
+            return []
+
         user_prompt = f"""Testo pasto:
 {meal_description}
 
 Estrai solo ingredienti con quantità e unità."""
 
-        response = requests.post(
-            GROQ_API_URL,
-            headers={
-                "Authorization": f"Bearer {api_key}",
-                "Content-Type": "application/json"
-            },
-            json={
+        response = _groq_post(
+            {
                 "model": DEFAULT_MODEL,
                 "messages": [
-                    {"role": "system", "content": system_prompt},
+                    _EXTRACT_SYSTEM_MSG,
                     {"role": "user", "content": user_prompt}
                 ],
                 "max_tokens": 600,
@@ -307,36 +794,30 @@ Estrai solo ingredienti con quantità e unità."""
         )
 
         if response.status_code != 200:
-            current_app.logger.error(f"Groq AI extract ingredients error: {response.status_code} - {response.text}")
+            current_app.logger.error("Groq AI extract ingredients error: %s - %s", response.status_code, response.text)
             return []
 
-        payload = response.json()
+        payload = _json_loads(response.content)
         content = (payload.get("choices") or [{}])[0].get("message", {}).get("content", "").strip()
         if not content:
             return []
-        if content.startswith("```json"):
-            content = content[7:]
-        if content.startswith("```"):
-            content = content[3:]
-        if content.endswith("```"):
-            content = content[:-3]
-        content = content.strip()
-
-        data = json.loads(content)
+        content = _strip_fence(content)
+
+        data = _json_loads(content)
         ings = data.get('ingredients', []) if isinstance(data, dict) else []
         normalized = []
         for ing in ings:
             name = (ing.get('item') or '').strip()
             try:
                 qty = float(ing.get('quantity') or 0)
-            except Exception:
+            except (TypeError, ValueError):
                 qty = 0.0
             unit = (ing.get('unit') or '').strip().lower()
             if name and qty > 0 and unit:
                 normalized.append({'item': name, 'quantity': qty, 'unit': unit})
         return normalized
     except Exception as e:
-        current_app.logger.error(f"ai_extract_ingredients error: {e}")
+        current_app.logger.error("ai_extract_ingredients error: %s", e)
         return []
 
 
@@ -354,67 +835,112 @@ def _get_family_nutritional_constraints(user_id):
     Returns:
         dict: Dizionario con allergie e restrizioni aggregate della famiglia
     """
+    cached = _FAMILY_CACHE.get(user_id)
+    if cached is not None:
+        return copy.deepcopy(cached)
+    
     try:
-        from .smart_functions import get_user_family
-        from .models import User
-        
-        family = get_user_family(user_id)
-        if not family:
-            return {'allergies': [], 'restrictions': [], 'members_count': 1, 'members_info': []}
+        from .models import FamilyMember
+        
+        # Un'unica query: membri della famiglia dell'utente con il relativo profilo
+        family_id = select(FamilyMember.family_id).where(
+            FamilyMember.user_id == user_id
+        ).limit(1).scalar_subquery()
+        rows = db.session.query(
+            User.username, NutritionalProfile.allergies, NutritionalProfile.dietary_restrictions
+        ).join(
+            FamilyMember, FamilyMember.user_id == User.id
+        ).outerjoin(
+            NutritionalProfile, NutritionalProfile.user_id == User.id
+        ).filter(
+            FamilyMember.family_id == family_id
+        ).order_by(FamilyMember.id).all()
+        
+        if not rows:
+            constraints = {'allergies': [], 'restrictions': [], 'members_count': 1, 'members_info': []}
+            _FAMILY_CACHE.set(user_id, constraints)
+            return copy.deepcopy(constraints)
         
         all_allergies = set()
         all_restrictions = set()
         members_info = []
         
         # Itera sui membri della famiglia
-        for member in family.members:
-            user = User.query.get(member.user_id)
-            if not user:
-                continue
-            
-            profile = NutritionalProfile.query.filter_by(user_id=user.id).first()
-            if not profile:
-                continue
-            
+        for username, profile_allergies, profile_restrictions in rows:
             # Aggiungi info membro
-            member_data = {'name': user.username}
+            member_data = {'name': username}
             
             # Raccogli allergie
-            if profile.allergies:
-                try:
-                    member_allergies = json.loads(profile.allergies)
-                    if member_allergies:
-                        all_allergies.update(member_allergies)
-                        member_data['allergies'] = member_allergies
-                except:
-                    pass
+            if profile_allergies:
+                all_allergies.update(profile_allergies)
+                member_data['allergies'] = profile_allergies
             
             # Raccogli restrizioni
-            if profile.dietary_restrictions:
-                try:
-                    member_restrictions = json.loads(profile.dietary_restrictions)
-                    if member_restrictions:
-                        all_restrictions.update(member_restrictions)
-                        member_data['restrictions'] = member_restrictions
-                except:
-                    pass
+            if profile_restrictions:
+                all_restrictions.update(profile_restrictions)
+                member_data['restrictions'] = profile_restrictions
             
             if 'allergies' in member_data or 'restrictions' in member_data:
                 members_info.append(member_data)
         
-        return {
+        constraints = {
             'allergies': sorted(list(all_allergies)),
             'restrictions': sorted(list(all_restrictions)),
-            'members_count': family.members.count(),
+            'members_count': len(rows),
             'members_info': members_info
         }
+        _FAMILY_CACHE.set(user_id, constraints)
+        return copy.deepcopy(constraints)
         
     except Exception as e:
-        current_app.logger.error(f"_get_family_nutritional_constraints error: {e}")
+        current_app.logger.error("_get_family_nutritional_constraints error: %s", e)
         return {'allergies': [], 'restrictions': [], 'members_count': 1, 'members_info': []}
 
 
-def ai_optimize_meal_planning(user_id, days=7, share_with_family=False):
+# Ultimo piano AI per utente con la firma di dispensa e vincoli che l'hanno prodotto
+_MEAL_PLAN_SIG_CACHE = ai_cache.TTLCache(maxsize=10000, ttl=86400)  # 24 ore
+
+
+# Campi di profilo e obiettivi che entrano nel prompt del piano
+_MEAL_PLAN_PROFILE_FIELDS = ('age', 'weight', 'height', 'gender', 'activity_level', 'goal')
+_MEAL_PLAN_GOAL_FIELDS = ('daily_calories', 'daily_protein', 'daily_carbs', 'daily_fat', 'daily_fiber')
+
+
+def _meal_plan_signature(user_id, products, days, share_with_family, profile, goals):
+    """
+    Firma economica degli input del piano: insieme (nome, unità) della dispensa,
+    dati di profilo e obiettivi nutrizionali, vincoli dell'utente (e della
+    famiglia se condiviso), giorni.
+    Le variazioni di sole quantità non cambiano la firma.
+    """
+    _, restrictions, allergies = _profile_cache(user_id)
+    family = None
+    if share_with_family:
+        constraints = _get_family_nutritional_constraints(user_id)
+        family = (tuple(constraints['allergies']), tuple(constraints['restrictions']), constraints['members_count'])
+    return hash((
+        frozenset((p.name, p.unit) for p in products),
+        tuple(getattr(profile, f, None) for f in _MEAL_PLAN_PROFILE_FIELDS) if profile else None,
+        tuple(getattr(goals, f, None) for f in _MEAL_PLAN_GOAL_FIELDS) if goals else None,
+        restrictions, allergies, family, days, share_with_family
+    ))
+
+
+def _get_signed_meal_plan(user_id, products, days, share_with_family, profile, goals):
+    """Piano in cache se la firma degli input coincide, altrimenti None"""
+    entry = _MEAL_PLAN_SIG_CACHE.get(user_id)
+    if entry is None or entry[0] != _meal_plan_signature(user_id, products, days, share_with_family, profile, goals):
+        return None
+    return copy.deepcopy(entry[1])
+
+
+def _set_signed_meal_plan(user_id, products, days, share_with_family, profile, goals, meal_plan):
+    """Memorizza il piano AI con la firma degli input che l'hanno prodotto"""
+    signature = _meal_plan_signature(user_id, products, days, share_with_family, profile, goals)
+    _MEAL_PLAN_SIG_CACHE.set(user_id, (signature, copy.deepcopy(meal_plan)))
+
+
+def ai_optimize_meal_planning(user_id, days=7, share_with_family=False, refresh=False):
     """
     Genera piano pasti settimanale ottimizzato usando AI
     
@@ -422,23 +948,32 @@ def ai_optimize_meal_planning(user_id, days=7, share_with_family=False):
         user_id: ID utente
         days: Giorni da pianificare
         share_with_family: Se True, considera i vincoli nutrizionali di tutta la famiglia
+        refresh: Se True, ignora i piani in cache e ne genera uno nuovo
     
     Returns:
         dict: Piano pasti per giorni {day: [meals]}
     """
     try:
-        # Recupera profilo nutrizionale
-        profile = NutritionalProfile.query.filter_by(user_id=user_id).first()
-        goals = NutritionalGoal.query.filter_by(user_id=user_id).first()
-        
         # Recupera ingredienti disponibili
         products = Product.query.filter_by(user_id=user_id, wasted=False).all()
         
         if not products:
             return _generate_basic_meal_plan(days)
         
+        # Recupera profilo nutrizionale
+        profile = _load_profile(user_id)
+        goals = NutritionalGoal.query.filter_by(user_id=user_id).first()
+        
+        # Stessa dispensa, profilo e vincoli di un piano già generato: niente LLM
+        if not refresh:
+            cached = _get_signed_meal_plan(user_id, products, days, share_with_family, profile, goals)
+            if cached is not None:
+                return cached
+        
         # Genera piano con AI considerando eventualmente i vincoli della famiglia
-        meal_plan = ai_generate_weekly_meal_plan(user_id, profile, goals, products, days, share_with_family)
+        meal_plan = ai_generate_weekly_meal_plan(
+            user_id, profile, goals, products, days, share_with_family, refresh=refresh
+        )
         
         if not meal_plan:
             return _generate_basic_meal_plan(days)
@@ -446,127 +981,118 @@ def ai_optimize_meal_planning(user_id, days=7, share_with_family=False):
         return meal_plan
         
     except Exception as e:
-        current_app.logger.error(f"ai_optimize_meal_planning error: {e}")
+        current_app.logger.error("ai_optimize_meal_planning error: %s", e)
         return _generate_basic_meal_plan(days)
 
-def ai_generate_weekly_meal_plan(user_id, profile, goals, products, days=7, share_with_family=False):
+
+def get_cached_meal_plan(user_id, days=7, share_with_family=False):
     """
-    Genera piano pasti settimanale usando Groq AI
-    
-    Args:
-        user_id: ID utente
-        profile: Profilo nutrizionale utente
-        goals: Obiettivi nutrizionali utente
-        products: Lista prodotti disponibili
-        days: Giorni da pianificare
-        share_with_family: Se True, considera vincoli di tutta la famiglia
+    Piano pasti già generato per gli input attuali (firma in cache), senza
+    chiamare l'AI: {} se non disponibile. Per le pagine che lo mostrano solo
+    se pronto; la generazione passa da /api/ai-meal-plan(/stream)
     """
     try:
-        api_key = os.getenv('GROQ_API_KEY')
-        
-        if not api_key:
-            current_app.logger.error("GROQ_API_KEY not configured")
-            return _generate_basic_meal_plan(days)
-        
-        # Prepara dati per AI
-        ingredients_text = "\n".join([
-            f"- {p.name} ({p.quantity} {p.unit})" 
-            for p in products[:20]  # Limita per prompt
-        ])
-        
-        # Info nutrizionali
-        nutritional_info = ""
-        if goals:
-            nutritional_info = f"""
-Obiettivi nutrizionali giornalieri:
-- Calorie: {goals.daily_calories}
-- Proteine: {goals.daily_protein}g
-- Carboidrati: {goals.daily_carbs}g
-- Grassi: {goals.daily_fat}g
-- Fibre: {goals.daily_fiber}g
-"""
+        products = Product.query.filter_by(user_id=user_id, wasted=False).all()
+        if not products:
+            return {}
+        profile = _load_profile(user_id)
+        goals = NutritionalGoal.query.filter_by(user_id=user_id).first()
+        return _get_signed_meal_plan(user_id, products, days, share_with_family, profile, goals) or {}
+    except Exception as e:
+        current_app.logger.error("get_cached_meal_plan error: %s", e)
+        return {}
+
+
+def ai_optimize_meal_planning_stream(user_id, days=7, share_with_family=False):
+    """
+    Versione in streaming di ai_optimize_meal_planning: genera le coppie
+    (day_index, meals) appena Groq chiude l'array dei pasti di ciascun giorno,
+    così il primo giorno arriva al client senza attendere l'intera risposta.
+    A fine stream il piano completo viene salvato in cache con la stessa chiave
+    di ai_generate_weekly_meal_plan.
+    """
+    try:
+        products = Product.query.filter_by(user_id=user_id, wasted=False).all()
         
-        # Info profilo
-        profile_info = ""
-        if profile:
-            profile_info = f"""
-Profilo utente principale:
-- Età: {profile.age} anni
-- Peso: {profile.weight} kg
-- Altezza: {profile.height} cm
-- Genere: {profile.gender}
-- Livello attività: {profile.activity_level}
-- Obiettivo: {profile.goal}
-"""
+        if not products or not GROQ_API_KEY:
+            yield from _iter_meal_plan(_generate_basic_meal_plan(days))
+            return
         
-        # Gestione vincoli: individuali o familiari
-        restrictions = ""
-        allergies = ""
-        family_info = ""
+        profile = _load_profile(user_id)
+        goals = NutritionalGoal.query.filter_by(user_id=user_id).first()
         
-        if share_with_family:
-            # Recupera vincoli di TUTTA la famiglia
-            family_constraints = _get_family_nutritional_constraints(user_id)
-            
-            if family_constraints['members_count'] > 1:
-                family_info = f"\n🏠 PASTO CONDIVISO CON LA FAMIGLIA ({family_constraints['members_count']} persone)\n"
-                
-                # Info dettagliata sui vincoli dei membri
-                if family_constraints['members_info']:
-                    family_info += "Vincoli nutrizionali dei membri della famiglia:\n"
-                    for member in family_constraints['members_info']:
-                        member_constraints = []
-                        if member.get('allergies'):
-                            member_constraints.append(f"Allergie: {', '.join(member['allergies'])}")
-                        if member.get('restrictions'):
-                            member_constraints.append(f"Restrizioni: {', '.join(member['restrictions'])}")
-                        if member_constraints:
-                            family_info += f"- {member['name']}: {'; '.join(member_constraints)}\n"
-                
-                # Allergie aggregate (TUTTE devono essere rispettate)
-                if family_constraints['allergies']:
-                    allergies = f"\n⚠️ ALLERGIE DA RISPETTARE (di tutti i membri): {', '.join(family_constraints['allergies'])}\n"
-                
-                # Restrizioni aggregate
-                if family_constraints['restrictions']:
-                    restrictions = f"Restrizioni dietetiche (di tutti i membri): {', '.join(family_constraints['restrictions'])}\n"
-            else:
-                # Nessuna famiglia, usa solo vincoli individuali
-                if profile and profile.dietary_restrictions:
-                    try:
-                        restrictions_list = json.loads(profile.dietary_restrictions)
-                        if restrictions_list:
-                            restrictions = f"Restrizioni dietetiche: {', '.join(restrictions_list)}\n"
-                    except:
-                        pass
-                
-                if profile and profile.allergies:
-                    try:
-                        allergies_list = json.loads(profile.allergies)
-                        if allergies_list:
-                            allergies = f"Allergie: {', '.join(allergies_list)}\n"
-                    except:
-                        pass
-        else:
-            # Solo vincoli individuali
-            if profile and profile.dietary_restrictions:
-                try:
-                    restrictions_list = json.loads(profile.dietary_restrictions)
-                    if restrictions_list:
-                        restrictions = f"Restrizioni dietetiche: {', '.join(restrictions_list)}\n"
-                except:
-                    pass
-            
-            if profile and profile.allergies:
-                try:
-                    allergies_list = json.loads(profile.allergies)
-                    if allergies_list:
-                        allergies = f"Allergie: {', '.join(allergies_list)}\n"
-                except:
-                    pass
-        
-        # Prompt per AI
-        system_prompt = """Sei un nutrizionista esperto e chef professionista. 
+        cached = _get_signed_meal_plan(user_id, products, days, share_with_family, profile, goals)
+        if cached is not None:
+            yield from _iter_meal_plan(cached)
+            return
+        
+        user_prompt = _build_weekly_meal_plan_prompt(
+            user_id, profile, goals, products, days, share_with_family
+        )
+        cache_key = _meal_plan_cache_key(user_id, days, share_with_family, user_prompt)
+        cached = ai_cache.get(cache_key)
+        if cached is not None:
+            yield from _iter_meal_plan(cached)
+            return
+        
+        chunks = _groq_stream(
+            {
+                "model": DEFAULT_MODEL,
+                "messages": [
+                    _MEAL_PLAN_SYSTEM_MSG,
+                    {"role": "user", "content": user_prompt}
+                ],
+                "max_tokens": 3000,
+                "temperature": 0.7
+            },
+            timeout=30
+        )
+    except Exception as e:
+        current_app.logger.error("ai_optimize_meal_planning_stream error: %s", e)
+        yield from _iter_meal_plan(_generate_basic_meal_plan(days))
+        return
+    
+    parser = IncrementalJsonParser()
+    meal_plan = {}
+    day_meals = []   # pasti del giorno in corso, emessi alla chiusura del suo array
+    completed = False
+    try:
+        for chunk in chunks:
+            for path, item in parser.feed(chunk):
+                day_index = _day_index(path[-1]) if path else None
+                if day_index is None or day_index >= days:
+                    continue
+                if item is IncrementalJsonParser.ARRAY_END:
+                    if day_meals:
+                        meal_plan.setdefault(day_index, []).extend(day_meals)
+                        yield day_index, day_meals
+                        day_meals = []
+                    continue
+                normalized_meal = _normalize_meal(item)
+                if normalized_meal:
+                    day_meals.append(normalized_meal)
+        completed = True
+    except Exception as e:
+        current_app.logger.error("ai_optimize_meal_planning_stream error: %s", e)
+    finally:
+        chunks.close()
+    
+    # In cache solo piani ricevuti per intero
+    if meal_plan and completed:
+        ai_cache.set(cache_key, meal_plan)
+        _set_signed_meal_plan(user_id, products, days, share_with_family, profile, goals, meal_plan)
+    elif not meal_plan:
+        yield from _iter_meal_plan(_generate_basic_meal_plan(days))
+
+
+def _iter_meal_plan(meal_plan):
+    """Scorre un piano {day: [meals]} come coppie (day_index, meals) ordinate per giorno"""
+    for day_index in sorted(meal_plan):
+        yield day_index, meal_plan[day_index]
+
+
+# Prompt di sistema costante: costruito una volta all'import
+_MEAL_PLAN_SYSTEM_PROMPT = """Sei un nutrizionista esperto e chef professionista. 
 Genera un piano pasti settimanale bilanciato in formato JSON.
 
 Formato richiesto:
@@ -598,8 +1124,91 @@ IMPORTANTE:
 - Le descrizioni devono essere BREVI (massimo 100 caratteri)
 - Non usare a capo o caratteri speciali nelle descrizioni
 - Rispondi SOLO con JSON valido"""
+
+_MEAL_PLAN_SYSTEM_MSG = {"role": "system", "content": _MEAL_PLAN_SYSTEM_PROMPT}
+
+
+def _build_weekly_meal_plan_prompt(user_id, profile, goals, products, days=7, share_with_family=False):
+    """Costruisce il prompt utente per la generazione del piano pasti"""
+    # Prepara dati per AI
+    ingredients_text = "\n".join([
+        f"- {p.name} ({p.quantity} {p.unit})" 
+        for p in products[:20]  # Limita per prompt
+    ])
+    
+    # Info nutrizionali
+    nutritional_info = ""
+    if goals:
+        nutritional_info = f"""
+Obiettivi nutrizionali giornalieri:
+- Calorie: {goals.daily_calories}
+- Proteine: {goals.daily_protein}g
+- Carboidrati: {goals.daily_carbs}g
+- Grassi: {goals.daily_fat}g
+- Fibre: {goals.daily_fiber}g
+"""
+    
+    # Info profilo
+    profile_info = ""
+    if profile:
+        profile_info = f"""
+Profilo utente principale:
+- Età: {profile.age} anni
+- Peso: {profile.weight} kg
+- Altezza: {profile.height} cm
+- Genere: {profile.gender}
+- Livello attività: {profile.activity_level}
+- Obiettivo: {profile.goal}
+"""
+    
+    # Gestione vincoli: individuali o familiari
+    restrictions = ""
+    allergies = ""
+    family_info = ""
+    
+    if share_with_family:
+        # Recupera vincoli di TUTTA la famiglia
+        family_constraints = _get_family_nutritional_constraints(user_id)
         
-        user_prompt = f"""Genera un piano pasti per {days} giorni.
+        if family_constraints['members_count'] > 1:
+            family_info = f"\n🏠 PASTO CONDIVISO CON LA FAMIGLIA ({family_constraints['members_count']} persone)\n"
+            
+            # Info dettagliata sui vincoli dei membri
+            if family_constraints['members_info']:
+                family_info += "Vincoli nutrizionali dei membri della famiglia:\n"
+                for member in family_constraints['members_info']:
+                    member_constraints = []
+                    if member.get('allergies'):
+                        member_constraints.append(f"Allergie: {', '.join(member['allergies'])}")
+                    if member.get('restrictions'):
+                        member_constraints.append(f"Restrizioni: {', '.join(member['restrictions'])}")
+                    if member_constraints:
+                        family_info += f"- {member['name']}: {'; '.join(member_constraints)}\n"
+            
+            # Allergie aggregate (TUTTE devono essere rispettate)
+            if family_constraints['allergies']:
+                allergies = f"\n⚠️ ALLERGIE DA RISPETTARE (di tutti i membri): {', '.join(family_constraints['allergies'])}\n"
+            
+            # Restrizioni aggregate
+            if family_constraints['restrictions']:
+                restrictions = f"Restrizioni dietetiche (di tutti i membri): {', '.join(family_constraints['restrictions'])}\n"
+        else:
+            # Nessuna famiglia, usa solo vincoli individuali
+            if profile and profile.dietary_restrictions:
+                restrictions = f"Restrizioni dietetiche: {', '.join(profile.dietary_restrictions)}\n"
+            
+            if profile and profile.allergies:
+                allergies = f"Allergie: {', '.join(profile.allergies)}\n"
+    else:
+        # Solo vincoli individuali
+        if profile and profile.dietary_restrictions:
+            restrictions = f"Restrizioni dietetiche: {', '.join(profile.dietary_restrictions)}\n"
+        
+        if profile and profile.allergies:
+            allergies = f"Allergie: {', '.join(profile.allergies)}\n"
+    
+    # Prompt per AI
+    user_prompt = f"""Genera un piano pasti per {days} giorni.
 
 {profile_info}
 {nutritional_info}
@@ -613,18 +1222,53 @@ Ingredienti disponibili:
 {"⚠️ IMPORTANTE: Questo piano sarà condiviso con la famiglia. DEVI rispettare TUTTE le allergie e restrizioni elencate sopra." if share_with_family and family_info else ""}
 
 Crea un piano variato, bilanciato e SICURO per tutti. Rispondi SOLO con JSON valido."""
+    
+    return user_prompt
+
+
+def _meal_plan_cache_key(user_id, days, share_with_family, user_prompt):
+    """Cache esatta sul prompt: profilo, obiettivi, dispensa, vincoli famiglia e giorni"""
+    return ai_cache.make_key('meal_plan', {
+        'user_id': user_id,
+        'model': DEFAULT_MODEL,
+        'days': days,
+        'share_with_family': share_with_family,
+        'prompt': user_prompt
+    })
+
+
+def ai_generate_weekly_meal_plan(user_id, profile, goals, products, days=7, share_with_family=False, refresh=False):
+    """
+    Genera piano pasti settimanale usando Groq AI
+    
+    Args:
+        user_id: ID utente
+        profile: Profilo nutrizionale utente
+        goals: Obiettivi nutrizionali utente
+        products: Lista prodotti disponibili
+        days: Giorni da pianificare
+        share_with_family: Se True, considera vincoli di tutta la famiglia
+        refresh: Se True, non usa la cache (il nuovo piano la sostituisce)
+    """
+    try:
+        if not GROQ_API_KEY:
+            return _generate_basic_meal_plan(days)
+        
+        user_prompt = _build_weekly_meal_plan_prompt(
+            user_id, profile, goals, products, days, share_with_family
+        )
+        
+        cache_key = _meal_plan_cache_key(user_id, days, share_with_family, user_prompt)
+        cached = None if refresh else ai_cache.get(cache_key)
+        if cached is not None:
+            return cached
         
         # Chiamata API
-        response = requests.post(
-            GROQ_API_URL,
-            headers={
-                "Authorization": f"Bearer {api_key}",
-                "Content-Type": "application/json"
-            },
-            json={
+        response = _groq_post(
+            {
                 "model": DEFAULT_MODEL,
                 "messages": [
-                    {"role": "system", "content": system_prompt},
+                    _MEAL_PLAN_SYSTEM_MSG,
                     {"role": "user", "content": user_prompt}
                 ],
                 "max_tokens": 3000,
@@ -634,14 +1278,14 @@ Crea un piano variato, bilanciato e SICURO per tutti. Rispondi SOLO con JSON val
         )
         
         if response.status_code != 200:
-            current_app.logger.error(f"Groq API error: {response.status_code} - {response.text}")
+            current_app.logger.error("Groq API error: %s - %s", response.status_code, response.text)
             return _generate_basic_meal_plan(days)
         
         # Parse response
         try:
-            payload = response.json()
-        except Exception as e:
-            current_app.logger.error(f"Groq API invalid JSON: {e}")
+            payload = _json_loads(response.content)
+        except ValueError as e:
+            current_app.logger.error("Groq API invalid JSON: %s", e)
             return _generate_basic_meal_plan(days)
         
         content = (payload.get("choices") or [{}])[0].get("message", {}).get("content", "")
@@ -649,116 +1293,135 @@ Crea un piano variato, bilanciato e SICURO per tutti. Rispondi SOLO con JSON val
             current_app.logger.warning("Groq API empty content")
             return _generate_basic_meal_plan(days)
         
-        # Estrai JSON
-        content = content.strip()
-        
-        # Pulisci il JSON
-        if content.startswith("```json"):
-            content = content[7:]
-        if content.startswith("```"):
-            content = content[3:]
-        if content.endswith("```"):
-            content = content[:-3]
-        content = content.strip()
+        # Estrai JSON (gestisce markdown code blocks)
+        content = _strip_fence(content)
         
         # Parse JSON
         try:
-            data = json.loads(content)
+            data = _json_loads(content)
             meal_plan = data.get("meal_plan", {})
             
             if not meal_plan:
                 return _generate_basic_meal_plan(days)
             
-            return _validate_and_normalize_meal_plan(meal_plan, days)
+            normalized = _validate_and_normalize_meal_plan(meal_plan, days)
+            if normalized:
+                ai_cache.set(cache_key, normalized)
+                _set_signed_meal_plan(user_id, products, days, share_with_family, profile, goals, normalized)
+            return normalized
             
         except json.JSONDecodeError as e:
-            current_app.logger.error(f"Invalid JSON from AI: {e}")
+            current_app.logger.error("Invalid JSON from AI: %s", e)
             return _generate_basic_meal_plan(days)
         
     except Exception as e:
-        current_app.logger.error(f"ai_generate_weekly_meal_plan error: {e}")
+        current_app.logger.error("ai_generate_weekly_meal_plan error: %s", e)
         return _generate_basic_meal_plan(days)
+
+
+_DAYS_BASE = {
+    'monday': 0, 'tuesday': 1, 'wednesday': 2, 'thursday': 3,
+    'friday': 4, 'saturday': 5, 'sunday': 6
+}
+# Varianti già pronte (monday/Monday/MONDAY): nel caso comune basta un solo .get()
+_DAYS_MAP = {
+    **_DAYS_BASE,
+    **{k.capitalize(): v for k, v in _DAYS_BASE.items()},
+    **{k.upper(): v for k, v in _DAYS_BASE.items()}
+}
+
+
+def _day_index(day_name):
+    """Indice del giorno (0 = lunedì) dal nome inglese, None se non riconosciuto"""
+    day_index = _DAYS_MAP.get(day_name)
+    if day_index is None and isinstance(day_name, str):
+        day_index = _DAYS_BASE.get(day_name.strip().lower())
+    return day_index
+
+
+_MACRO_FIELDS = ('calories', 'protein', 'carbs', 'fat')
+
+
+def _non_negative(value):
+    """Valore nutrizionale >= 0: numeri così come sono, stringhe numeriche convertite, il resto 0"""
+    if isinstance(value, (int, float)):
+        return value if value > 0 else 0
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return 0
+
+
+def _normalize_meal(meal):
+    """Normalizza un singolo pasto generato dall'AI (None se non valido)"""
+    if not isinstance(meal, dict) or 'meal_type' not in meal:
+        return None
+    get = meal.get
+    normalized = {
+        'meal_type': meal['meal_type'],
+        'name': get('name', 'Pasto'),
+        'description': get('description', '')
+    }
+    for field in _MACRO_FIELDS:
+        normalized[field] = _non_negative(get(field, 0))
+    return normalized
+
+
 def _validate_and_normalize_meal_plan(meal_plan, days):
     """Valida e normalizza il piano pasti generato dall'AI"""
     try:
-        days_map = {
-            'monday': 0, 'tuesday': 1, 'wednesday': 2, 'thursday': 3,
-            'friday': 4, 'saturday': 5, 'sunday': 6
-        }
-        
         normalized = {}
         
         for day_name, meals in meal_plan.items():
-            if day_name.lower() in days_map and isinstance(meals, list):
-                day_index = days_map[day_name.lower()]
-                if day_index < days:
-                    normalized[day_index] = []
-                    
-                    for meal in meals:
-                        if isinstance(meal, dict) and 'meal_type' in meal:
-                            # Normalizza meal
-                            normalized_meal = {
-                                'meal_type': meal.get('meal_type', 'lunch'),
-                                'name': meal.get('name', 'Pasto'),
-                                'description': meal.get('description', ''),
-                                'calories': max(0, meal.get('calories', 0)),
-                                'protein': max(0, meal.get('protein', 0)),
-                                'carbs': max(0, meal.get('carbs', 0)),
-                                'fat': max(0, meal.get('fat', 0))
-                            }
-                            normalized[day_index].append(normalized_meal)
+            day_index = _day_index(day_name)
+            if day_index is None or day_index >= days or not isinstance(meals, list):
+                continue
+            
+            normalized[day_index] = []
+            for meal in meals:
+                normalized_meal = _normalize_meal(meal)
+                if normalized_meal:
+                    normalized[day_index].append(normalized_meal)
         
         return normalized
         
     except Exception as e:
-        current_app.logger.error(f"_validate_and_normalize_meal_plan error: {e}")
+        current_app.logger.error("_validate_and_normalize_meal_plan error: %s", e)
         return _generate_basic_meal_plan(days)
 
 
+# Template del piano base: costruiti una volta all'import
+_MEAL_TYPES = ('breakfast', 'lunch', 'dinner', 'snack')
+_MEAL_TEMPLATES = {
+    'breakfast': [
+        {'name': 'Omelette con verdure', 'description': 'Omelette con pomodori, spinaci e formaggio', 'calories': 350, 'protein': 20, 'carbs': 8, 'fat': 25},
+        {'name': 'Porridge con frutta', 'description': 'Avena con banana, mirtilli e miele', 'calories': 300, 'protein': 12, 'carbs': 45, 'fat': 8},
+        {'name': 'Yogurt con granola', 'description': 'Yogurt greco con granola e frutti di bosco', 'calories': 280, 'protein': 15, 'carbs': 35, 'fat': 10}
+    ],
+    'lunch': [
+        {'name': 'Insalata di pollo', 'description': 'Insalata mista con petto di pollo grigliato', 'calories': 450, 'protein': 35, 'carbs': 20, 'fat': 25},
+        {'name': 'Pasta integrale', 'description': 'Pasta integrale con pomodoro e basilico', 'calories': 400, 'protein': 15, 'carbs': 60, 'fat': 12},
+        {'name': 'Riso con verdure', 'description': 'Riso integrale con verdure miste al vapore', 'calories': 380, 'protein': 12, 'carbs': 65, 'fat': 8}
+    ],
+    'dinner': [
+        {'name': 'Salmone al forno', 'description': 'Salmone con patate e broccoli al vapore', 'calories': 500, 'protein': 40, 'carbs': 35, 'fat': 20},
+        {'name': 'Pollo alla griglia', 'description': 'Petto di pollo con quinoa e verdure', 'calories': 450, 'protein': 45, 'carbs': 30, 'fat': 15},
+        {'name': 'Pesce spada', 'description': 'Pesce spada con riso e insalata', 'calories': 420, 'protein': 35, 'carbs': 40, 'fat': 18}
+    ],
+    'snack': [
+        {'name': 'Frutta fresca', 'description': 'Mela con mandorle', 'calories': 150, 'protein': 4, 'carbs': 20, 'fat': 8},
+        {'name': 'Yogurt greco', 'description': 'Yogurt greco con noci', 'calories': 120, 'protein': 10, 'carbs': 8, 'fat': 6},
+        {'name': 'Smoothie', 'description': 'Smoothie con banana e spinaci', 'calories': 180, 'protein': 6, 'carbs': 25, 'fat': 5}
+    ]
+}
+
+
 def _generate_basic_meal_plan(days=7):
     """Genera piano pasti base (fallback)"""
-    meal_templates = {
-        'breakfast': [
-            {'name': 'Omelette con verdure', 'description': 'Omelette con pomodori, spinaci e formaggio', 'calories': 350, 'protein': 20, 'carbs': 8, 'fat': 25},
-            {'name': 'Porridge con frutta', 'description': 'Avena con banana, mirtilli e miele', 'calories': 300, 'protein': 12, 'carbs': 45, 'fat': 8},
-            {'name': 'Yogurt con granola', 'description': 'Yogurt greco con granola e frutti di bosco', 'calories': 280, 'protein': 15, 'carbs': 35, 'fat': 10}
-        ],
-        'lunch': [
-            {'name': 'Insalata di pollo', 'description': 'Insalata mista con petto di pollo grigliato', 'calories': 450, 'protein': 35, 'carbs': 20, 'fat': 25},
-            {'name': 'Pasta integrale', 'description': 'Pasta integrale con pomodoro e basilico', 'calories': 400, 'protein': 15, 'carbs': 60, 'fat': 12},
-            {'name': 'Riso con verdure', 'description': 'Riso integrale con verdure miste al vapore', 'calories': 380, 'protein': 12, 'carbs': 65, 'fat': 8}
-        ],
-        'dinner': [
-            {'name': 'Salmone al forno', 'description': 'Salmone con patate e broccoli al vapore', 'calories': 500, 'protein': 40, 'carbs': 35, 'fat': 20},
-            {'name': 'Pollo alla griglia', 'description': 'Petto di pollo con quinoa e verdure', 'calories': 450, 'protein': 45, 'carbs': 30, 'fat': 15},
-            {'name': 'Pesce spada', 'description': 'Pesce spada con riso e insalata', 'calories': 420, 'protein': 35, 'carbs': 40, 'fat': 18}
-        ],
-        'snack': [
-            {'name': 'Frutta fresca', 'description': 'Mela con mandorle', 'calories': 150, 'protein': 4, 'carbs': 20, 'fat': 8},
-            {'name': 'Yogurt greco', 'description': 'Yogurt greco con noci', 'calories': 120, 'protein': 10, 'carbs': 8, 'fat': 6},
-            {'name': 'Smoothie', 'description': 'Smoothie con banana e spinaci', 'calories': 180, 'protein': 6, 'carbs': 25, 'fat': 5}
-        ]
+    return {
+        day: [{'meal_type': meal_type, **random.choice(_MEAL_TEMPLATES[meal_type])} for meal_type in _MEAL_TYPES]
+        for day in range(days)
     }
-    
-    meal_plan = {}
-    for day in range(days):
-        day_meals = []
-        for meal_type in ['breakfast', 'lunch', 'dinner', 'snack']:
-            import random
-            template = random.choice(meal_templates[meal_type])
-            meal = {
-                'meal_type': meal_type,
-                'name': template['name'],
-                'description': template['description'],
-                'calories': template['calories'],
-                'protein': template['protein'],
-                'carbs': template['carbs'],
-                'fat': template['fat']
-            }
-            day_meals.append(meal)
-        meal_plan[day] = day_meals
-    
-    return meal_plan
 
 
 # ========================================
@@ -773,23 +1436,19 @@ def ai_suggest_shopping_list(user_id):
         dict: {suggestions: [product_names]}
     """
     try:
-        # Prodotti in scadenza (3 giorni)
-        expiring = Product.query.filter(
-            Product.user_id == user_id,
-            Product.expiry_date <= datetime.utcnow().date() + timedelta(days=3),
-            Product.wasted == False
-        ).all()
-        
-        # Prodotti in esaurimento
-        low_stock = Product.query.filter(
-            Product.user_id == user_id,
-            Product.quantity <= Product.min_quantity,
-            Product.wasted == False
+        # Prodotti in scadenza (3 giorni) o in esaurimento: una sola query,
+        # deduplicazione lato DB
+        suggestions = db.session.scalars(
+            select(Product.name).where(
+                Product.user_id == user_id,
+                Product.wasted == False,
+                or_(
+                    Product.expiry_date <= datetime.utcnow().date() + timedelta(days=3),
+                    Product.quantity <= Product.min_quantity
+                )
+            ).distinct()
         ).all()
         
-        # Unisci e deduplica
-        suggestions = list(set([p.name for p in expiring + low_stock]))
-        
         return {
             'success': True,
             'suggestions': suggestions,
@@ -797,7 +1456,7 @@ def ai_suggest_shopping_list(user_id):
         }
         
     except Exception as e:
-        current_app.logger.error(f"ai_suggest_shopping_list error: {e}")
+        current_app.logger.error("ai_suggest_shopping_list error: %s", e)
         return {'success': False, 'suggestions': []}
 
 
@@ -805,21 +1464,26 @@ def ai_suggest_shopping_list(user_id):
 # NUTRITION ANALYSIS
 # ========================================
 
-def analyze_meal_plan_nutrition(meal_plan_id):
+def analyze_meal_plan_nutrition(meal_plan):
     """
     Analizza valori nutrizionali di un meal plan
     
+    Args:
+        meal_plan: MealPlan già caricato (nessuna query) oppure il suo ID
+    
     Returns:
         dict: Analisi nutrizionale
     """
     try:
-        meal_plan = MealPlan.query.get(meal_plan_id)
+        if not isinstance(meal_plan, MealPlan):
+            # session.get usa prima l'identity map: nessuna SELECT se già caricato
+            meal_plan = db.session.get(MealPlan, meal_plan)
         
         if not meal_plan:
             return None
         
         # Se ha già i dati, ritornali
-        if all([meal_plan.calories, meal_plan.protein, meal_plan.carbs, meal_plan.fat]):
+        if meal_plan.calories and meal_plan.protein and meal_plan.carbs and meal_plan.fat:
             return {
                 'calories': meal_plan.calories,
                 'protein': meal_plan.protein,
@@ -840,7 +1504,7 @@ def analyze_meal_plan_nutrition(meal_plan_id):
         }
         
     except Exception as e:
-        current_app.logger.error(f"analyze_meal_plan_nutrition error: {e}")
+        current_app.logger.exception("analyze_meal_plan_nutrition error: %s", e)
         return None
 
 
@@ -851,103 +1515,213 @@ def analyze_meal_plan_nutrition(meal_plan_id):
 def _get_user_dietary_info(user_id):
     """Recupera info dietetiche utente"""
     try:
-        profile = NutritionalProfile.query.filter_by(user_id=user_id).first()
-        
-        if not profile:
-            return "Nessuna preferenza specificata"
-        
-        info_parts = []
-        
-        if profile.goal:
-            goal_map = {
-                'lose_weight': 'Perdita peso',
-                'gain_weight': 'Aumento peso',
-                'maintain': 'Mantenimento',
-                'muscle_gain': 'Aumento massa muscolare'
-            }
-            info_parts.append(f"Obiettivo: {goal_map.get(profile.goal, profile.goal)}")
-        
-        if profile.activity_level:
-            info_parts.append(f"Attività: {profile.activity_level}")
-        
-        if profile.dietary_restrictions:
-            try:
-                restrictions = json.loads(profile.dietary_restrictions)
-                if restrictions:
-                    info_parts.append(f"Restrizioni: {', '.join(restrictions)}")
-            except:
-                pass
-        
-        if profile.allergies:
-            try:
-                allergies = json.loads(profile.allergies)
-                if allergies:
-                    info_parts.append(f"Allergie: {', '.join(allergies)}")
-            except:
-                pass
-        
-        return "\n".join(info_parts) if info_parts else "Nessuna preferenza specificata"
-        
+        return _profile_cache(user_id)[0]
     except Exception as e:
-        current_app.logger.error(f"Error getting dietary info: {e}")
+        current_app.logger.error("Error getting dietary info: %s", e)
         return "Errore recupero preferenze"
 
 
+# Etichette degli obiettivi nutrizionali nei prompt
+_GOAL_LABELS = {
+    'lose_weight': 'Perdita peso',
+    'gain_weight': 'Aumento peso',
+    'maintain': 'Mantenimento',
+    'muscle_gain': 'Aumento massa muscolare'
+}
+
+
+def _format_dietary_info(profile):
+    """Testo con obiettivo, attività, restrizioni e allergie del profilo (per i prompt)"""
+    if not profile:
+        return "Nessuna preferenza specificata"
+    
+    info_parts = []
+    
+    if profile.goal:
+        info_parts.append(f"Obiettivo: {_GOAL_LABELS.get(profile.goal, profile.goal)}")
+    
+    if profile.activity_level:
+        info_parts.append(f"Attività: {profile.activity_level}")
+    
+    if profile.dietary_restrictions:
+        info_parts.append(f"Restrizioni: {', '.join(profile.dietary_restrictions)}")
+    
+    if profile.allergies:
+        info_parts.append(f"Allergie: {', '.join(profile.allergies)}")
+    
+    return "\n".join(info_parts) if info_parts else "Nessuna preferenza specificata"
+
+
+@lru_cache(maxsize=4096)
+def _normalize_str(value):
+    """strip + casefold di una stringa (cache: allergie e tag si ripetono tra le ricette)."""
+    return value.strip().casefold()
+
+
 def _normalize_token(value):
-    """Normalizza stringhe per confronto naive."""
+    """Normalizza stringhe per confronto case-insensitive (casefold Unicode)."""
     if not value:
         return ""
-    return str(value).strip().lower()
+    return _normalize_str(value if isinstance(value, str) else str(value))
 
 
-def _get_user_restrictions_and_allergies(user_id):
-    """Ritorna (restrictions_set, allergies_set) dal profilo nutrizionale."""
+# Preferenze derivate dai profili (testo prompt + set normalizzati) e vincoli
+# familiari: cambiano di rado, quindi restano in cache tra le richieste per 5
+# minuti e vengono invalidate esplicitamente quando il profilo o la famiglia cambiano
+_PROFILE_CACHE = ai_cache.TTLCache(maxsize=10000, ttl=300)
+_FAMILY_CACHE = ai_cache.TTLCache(maxsize=10000, ttl=300)
+
+
+def _load_profile(user_id):
+    """
+    NutritionalProfile dell'utente, interrogato una sola volta per richiesta
+    (memorizzato su flask.g: prompt, preferenze e contesto chat lo condividono)
+    """
+    if not has_app_context():
+        return NutritionalProfile.query.filter_by(user_id=user_id).first()
+    profiles = g.setdefault('_nutr_profiles', {})
+    if user_id not in profiles:
+        profiles[user_id] = NutritionalProfile.query.filter_by(user_id=user_id).first()
+    return profiles[user_id]
+
+
+def _profile_cache(user_id):
+    """
+    Ritorna (dietary_info, restrictions, allergies) dell'utente, con i set già
+    normalizzati (frozenset): una sola query ogni 5 minuti per utente.
+    """
+    entry = _PROFILE_CACHE.get(user_id)
+    if entry is not None:
+        return entry
+
     restrictions_set = set()
     allergies_set = set()
-    profile = NutritionalProfile.query.filter_by(user_id=user_id).first()
+    profile = _load_profile(user_id)
     if profile:
-        if profile.dietary_restrictions:
-            try:
-                for r in json.loads(profile.dietary_restrictions) or []:
-                    token = _normalize_token(r)
-                    if token:
-                        restrictions_set.add(token)
-            except Exception:
-                pass
-        if profile.allergies:
-            try:
-                for a in json.loads(profile.allergies) or []:
-                    token = _normalize_token(a)
-                    if token:
-                        allergies_set.add(token)
-            except Exception:
-                pass
+        for r in profile.dietary_restrictions or []:
+            token = _normalize_token(r)
+            if token:
+                restrictions_set.add(token)
+        for a in profile.allergies or []:
+            token = _normalize_token(a)
+            if token:
+                allergies_set.add(token)
+
+    entry = (_format_dietary_info(profile), frozenset(restrictions_set), frozenset(allergies_set))
+    _PROFILE_CACHE.set(user_id, entry)
+    return entry
+
+
+def invalidate_profile_cache(user_id):
+    """
+    Invalida le preferenze in cache dell'utente e i vincoli familiari
+    (da chiamare dopo modifiche al profilo nutrizionale o alla famiglia)
+    """
+    _PROFILE_CACHE.pop(user_id)
+    # Il profilo compare anche nel contesto del chatbot
+    _CHAT_CONTEXT_CACHE.pop(user_id)
+    if has_app_context():
+        g.get('_nutr_profiles', {}).pop(user_id, None)
+    # Obiettivi e profilo entrano nel prompt: il piano firmato non è più valido
+    _MEAL_PLAN_SIG_CACHE.pop(user_id)
+    # I vincoli di famiglia aggregano i profili di più utenti: si svuota tutto
+    _FAMILY_CACHE.clear()
+
+
+def _get_user_restrictions_and_allergies(user_id):
+    """
+    Ritorna (restrictions, allergies) dal profilo nutrizionale: i frozenset
+    condivisi della cache, senza copie (i chiamanti li usano in sola lettura)
+    """
+    _, restrictions_set, allergies_set = _profile_cache(user_id)
     return restrictions_set, allergies_set
 
 
-def _recipe_violates_preferences(recipe, restrictions, allergies):
-    """True se la ricetta viola allergie/restrizioni dell'utente."""
+# Allergeni comuni (nomi con cui l'utente li indica) -> ingredienti che li
+# contengono: si cercano anche questi, non solo il nome dell'allergia.
+# Match a inizio parola ('arachid' trova 'arachidi'); esclusi i termini
+# ambigui ('pasta', 'pane', 'noce', 'miso', 'grano': pasta di mandorle,
+# noce moscata, misto, grano saraceno...)
+_ALLERGEN_FAMILIES = (
+    (('latte', 'lattosio', 'latticini', 'milk', 'lactose'),
+     ('latte', 'burro', 'panna', 'formaggio', 'mozzarella', 'parmigiano',
+      'ricotta', 'mascarpone', 'yogurt', 'besciamella', 'stracchino', 'pecorino')),
+    (('uova', 'uovo', 'egg', 'eggs'),
+     ('uova', 'uovo', 'tuorl', 'albume', 'maionese')),
+    (('glutine', 'frumento', 'grano', 'gluten', 'wheat'),
+     ('glutine', 'frumento', 'farina', 'pangrattato', 'orzo', 'segale', 'farro',
+      'couscous', 'seitan', 'semola')),
+    (('arachidi', 'arachide', 'noccioline', 'peanut', 'peanuts'),
+     ('arachid', 'noccioline')),
+    (('noci', 'frutta a guscio', 'frutta secca', 'nuts', 'tree nuts'),
+     ('noci', 'nocciol', 'mandorl', 'pistacchi', 'anacardi', 'pinoli',
+      'pecan', 'macadamia')),
+    (('crostacei', 'shellfish', 'crustaceans'),
+     ('crostacei', 'gamber', 'scampi', 'aragosta', 'astice', 'granchi', 'mazzancolle')),
+    (('molluschi', 'molluscs'),
+     ('molluschi', 'cozze', 'vongole', 'calamar', 'polpo', 'seppi', 'ostrich')),
+    (('pesce', 'fish'),
+     ('pesce', 'tonno', 'salmone', 'merluzzo', 'acciugh', 'alici', 'baccalà',
+      'sgombro', 'branzino', 'orata', 'sardin')),
+    (('soia', 'soy', 'soya'),
+     ('soia', 'tofu', 'edamame', 'tempeh')),
+    (('sesamo', 'sesame'),
+     ('sesamo', 'tahin')),
+    (('sedano', 'celery'), ('sedano',)),
+    (('senape', 'mustard'), ('senape',)),
+)
+_ALLERGEN_SYNONYMS = {
+    name: frozenset(ingredients)
+    for names, ingredients in _ALLERGEN_FAMILIES
+    for name in names
+}
+
+
+@lru_cache(maxsize=256)
+def _compile_allergen_regex(tokens):
+    """Regex unica (alternanza a inizio parola, token più lunghi per primi) per un insieme di allergie."""
+    alternatives = '|'.join(re.escape(a) for a in sorted(tokens, key=len, reverse=True))
+    return re.compile(rf'(?<!\w)(?:{alternatives})', re.I)
+
+
+def _compile_allergen_pattern(allergies):
+    """
+    Compila le allergie, espanse con gli ingredienti che le contengono
+    (_ALLERGEN_SYNONYMS), in un'unica regex per il match sugli ingredienti
+    (cache per insieme)
+    """
+    tokens = frozenset(
+        token
+        for a in allergies if a
+        for token in (a, *_ALLERGEN_SYNONYMS.get(a, ()))
+    )
+    if not tokens:
+        return None
+    return _compile_allergen_regex(tokens)
+
+
+def _violates_allergies(recipe, allergen_re):
+    """True se un ingrediente della ricetta corrisponde alla regex delle allergie."""
     try:
-        # Check allergie sugli ingredienti
-        if allergies:
-            for ing in (recipe.get('ingredients') or []):
-                item_name = _normalize_token((ing or {}).get('item'))
-                if not item_name:
-                    continue
-                for allergen in allergies:
-                    if allergen and allergen in item_name:
-                        return True
-
-        # Check restrizioni usando dietary_tags se presenti
-        if restrictions:
-            tags = {_normalize_token(t) for t in (recipe.get('dietary_tags') or [])}
-            if tags:
-                # Richiedi che tutte le restrizioni compaiano nei tag
-                missing = [r for r in restrictions if r not in tags]
-                if missing:
-                    return True
-            # Se non ci sono tag, non scartare automaticamente per evitare falsi positivi
+        # Una sola ricerca regex sui nomi di tutti gli ingredienti; separatore
+        # a capo: un match non può attraversare due ingredienti
+        items = '\n'.join(
+            str((ing or {}).get('item') or '') for ing in (recipe.get('ingredients') or [])
+        ).casefold()
+        return bool(items and allergen_re.search(items))
+    except Exception:
         return False
+
+
+def _violates_restrictions(recipe, restrictions):
+    """True se i dietary_tags della ricetta non coprono tutte le restrizioni."""
+    try:
+        # Se non ci sono tag, non scartare automaticamente per evitare falsi positivi
+        dietary_tags = recipe.get('dietary_tags')
+        if not dietary_tags:
+            return False
+        # Richiedi che tutte le restrizioni compaiano nei tag
+        return not restrictions.issubset(map(_normalize_token, dietary_tags))
     except Exception:
         return False
 
@@ -1009,89 +1783,128 @@ def ai_estimate_meal_calories(meal_description, meal_type='lunch'):
     Returns:
         dict: {calories, protein, carbs, fat, fiber}
     """
+    return ai_estimate_meals_calories([(meal_description, meal_type)])[0]
+
+
+def _parse_nutrition(item, meal_type):
+    """Valori nutrizionali da un elemento della risposta AI (fallback se non valido)"""
+    if not isinstance(item, dict):
+        return _estimate_calories_fallback(meal_type)
     try:
-        api_key = os.getenv('GROQ_API_KEY')
-        
-        if not api_key:
-            # Fallback senza AI
-            return _estimate_calories_fallback(meal_type)
-        
-        # Prompt per AI
-        prompt = f"""
-Analizza questo pasto e stima i valori nutrizionali:
+        return {
+            'calories': int(item.get('calories', 0)),
+            'protein': float(item.get('protein', 0)),
+            'carbs': float(item.get('carbs', 0)),
+            'fat': float(item.get('fat', 0)),
+            'fiber': float(item.get('fiber', 0))
+        }
+    except (TypeError, ValueError):
+        return _estimate_calories_fallback(meal_type)
 
-Pasto: {meal_description}
-Tipo: {meal_type}
+
+# Prompt per la stima nutrizionale (riempito con str.format)
+_MEALS_CALORIES_PROMPT = """
+Analizza questi pasti e stima i valori nutrizionali di ciascuno:
+
+{meals_text}
 
 Rispondi SOLO con un JSON valido nel formato:
-{{
-    "calories": numero,
-    "protein": numero,
-    "carbs": numero,
-    "fat": numero,
-    "fiber": numero
-}}
-
-Stima realistica basata su porzioni normali per {meal_type}.
+{{"meals": [
+    {{
+        "calories": numero,
+        "protein": numero,
+        "carbs": numero,
+        "fat": numero,
+        "fiber": numero
+    }},
+    ...
+]}}
+con esattamente {n} elementi in "meals", nello stesso ordine dei pasti.
+
+Stima realistica basata su porzioni normali per il tipo di ciascun pasto.
 """
 
-        headers = {
-            'Authorization': f'Bearer {api_key}',
-            'Content-Type': 'application/json'
-        }
-        
-        data = {
-            'messages': [
-                {'role': 'user', 'content': prompt}
-            ],
-            'model': 'llama-3.1-8b-instant',
-            'temperature': 0.3,
-            'max_tokens': 200
-        }
+
+def _build_meals_calories_body(meals):
+    """Body della richiesta Groq che stima i valori nutrizionali di una lista di (descrizione, tipo pasto)"""
+    n = len(meals)
+    meals_text = "\n".join(
+        f"{i}) {description} ({meal_type})"
+        for i, (description, meal_type) in enumerate(meals, 1)
+    )
+    prompt = _MEALS_CALORIES_PROMPT.format(meals_text=meals_text, n=n)
+
+    return {
+        'messages': [
+            {'role': 'user', 'content': prompt}
+        ],
+        'model': INSTANT_MODEL,
+        'temperature': 0.3,
+        'max_tokens': min(200 * n, MAX_COMPLETION_TOKENS)
+    }
+
+
+def _parse_meals_calories(content, meals):
+    """
+    Valori nutrizionali per pasto dal testo della risposta AI
+    (None se il formato non è riconosciuto)
+    """
+    # Estrai JSON dalla risposta
+    nutrition_data = _extract_json_object(content)
+    if not nutrition_data:
+        return None
+    items = nutrition_data.get('meals')
+    # Risposta singola senza lista: accettata solo per un pasto
+    if items is None and len(meals) == 1:
+        items = [nutrition_data]
+    if not isinstance(items, list):
+        return None
+    return [
+        _parse_nutrition(items[i] if i < len(items) else None, meal_type)
+        for i, (_, meal_type) in enumerate(meals)
+    ]
+
+
+def ai_estimate_meals_calories(meals):
+    """
+    Stima le calorie di più pasti con UNA sola chiamata Groq
+    (invece di una richiesta per pasto)
+    
+    Args:
+        meals: lista di tuple (descrizione, tipo pasto)
+    
+    Returns:
+        list: un dict {calories, protein, carbs, fat, fiber} per pasto (stesso ordine)
+    """
+    meals = list(meals)
+    if not meals:
+        return []
+    
+    try:
+        if not GROQ_API_KEY:
+            # Fallback senza AI
+            return [_estimate_calories_fallback(meal_type) for _, meal_type in meals]
         
-        response = requests.post(
-            'https://api.groq.com/openai/v1/chat/completions',
-            headers=headers,
-            json=data,
-            timeout=10
-        )
+        data = _build_meals_calories_body(meals)
+        response = _groq_post(data, timeout=10 + 2 * (len(meals) - 1))
         
         if response.status_code == 200:
-            result = response.json()
+            result = _json_loads(response.content)
             content = result['choices'][0]['message']['content'].strip()
-            
-            # Estrai JSON dalla risposta
-            import re
-            json_match = re.search(r'\{.*\}', content, re.DOTALL)
-            if json_match:
-                nutrition_data = json.loads(json_match.group())
-                return {
-                    'calories': int(nutrition_data.get('calories', 0)),
-                    'protein': float(nutrition_data.get('protein', 0)),
-                    'carbs': float(nutrition_data.get('carbs', 0)),
-                    'fat': float(nutrition_data.get('fat', 0)),
-                    'fiber': float(nutrition_data.get('fiber', 0))
-                }
+            nutrition = _parse_meals_calories(content, meals)
+            if nutrition is not None:
+                return nutrition
         
         # Fallback se AI non funziona
-        return _estimate_calories_fallback(meal_type)
+        return [_estimate_calories_fallback(meal_type) for _, meal_type in meals]
         
     except Exception as e:
-        current_app.logger.error(f"ai_estimate_meal_calories error: {e}")
-        return _estimate_calories_fallback(meal_type)
+        current_app.logger.exception("ai_estimate_meals_calories error: %s", e)
+        return [_estimate_calories_fallback(meal_type) for _, meal_type in meals]
 
 
-def _estimate_calories_fallback(meal_type):
-    """Stima calorie di base senza AI"""
-    base_calories = {
-        'breakfast': 400,
-        'lunch': 600,
-        'dinner': 700,
-        'snack': 200
-    }
-    
-    calories = base_calories.get(meal_type, 500)
-    
+def _fallback_nutrition(calories):
+    """Ripartizione macro di base per un totale calorico"""
     return {
         'calories': calories,
         'protein': calories * 0.25 / 4,  # 25% proteine
@@ -1101,42 +1914,276 @@ def _estimate_calories_fallback(meal_type):
     }
 
 
+# Stime di base precalcolate per tipo di pasto (i tipi sono pochi e fissi)
+_FALLBACK_NUTRITION = {
+    meal_type: _fallback_nutrition(calories)
+    for meal_type, calories in {
+        'breakfast': 400,
+        'lunch': 600,
+        'dinner': 700,
+        'snack': 200
+    }.items()
+}
+_FALLBACK_NUTRITION_DEFAULT = _fallback_nutrition(500)
+
+
+def _estimate_calories_fallback(meal_type):
+    """Stima calorie di base senza AI"""
+    # Copia: il chiamante può modificare il dict senza toccare la tabella
+    return dict(_FALLBACK_NUTRITION.get(meal_type, _FALLBACK_NUTRITION_DEFAULT))
+
+
 def _calculate_balance_score(meal_plan):
     """Calcola score bilanciamento (0-100)"""
-    if not all([meal_plan.protein, meal_plan.carbs, meal_plan.fat]):
+    if not (meal_plan.protein and meal_plan.carbs and meal_plan.fat):
         return 0
     
     # Proporzioni ideali: 30% proteine, 50% carbs, 20% grassi
-    total_cals = (meal_plan.protein * 4) + (meal_plan.carbs * 4) + (meal_plan.fat * 9)
-    
-    if total_cals == 0:
+    p4, c4, f9 = meal_plan.protein * 4, meal_plan.carbs * 4, meal_plan.fat * 9
+    total_cals = p4 + c4 + f9
+    if not total_cals:
         return 0
     
-    protein_pct = (meal_plan.protein * 4 / total_cals) * 100
-    carbs_pct = (meal_plan.carbs * 4 / total_cals) * 100
-    fat_pct = (meal_plan.fat * 9 / total_cals) * 100
-    
-    # Deviazione da ideale
-    protein_dev = abs(protein_pct - 30)
-    carbs_dev = abs(carbs_pct - 50)
-    fat_dev = abs(fat_pct - 20)
-    
-    total_dev = protein_dev + carbs_dev + fat_dev
-    
-    # Score: meno deviazione = score più alto
-    score = max(0, 100 - total_dev)
-    
-    return round(score, 0)
+    # Deviazione totale dall'ideale: meno deviazione = score più alto
+    inv = 100.0 / total_cals
+    total_dev = abs(p4 * inv - 30) + abs(c4 * inv - 50) + abs(f9 * inv - 20)
+    return round(max(0.0, 100.0 - total_dev), 0)
 
 
 # ========================================
 # RECYCLING SUGGESTIONS AI
 # ========================================
 
+# Prompt di sistema costante: costruito una volta all'import
+_RECYCLING_SYSTEM_PROMPT = """Sei un esperto di gestione rifiuti alimentari. Per ogni prodotto scaduto proponi 2-3 opzioni SICURE e pratiche, in ordine: compostaggio > riutilizzo/animali > smaltimento.
+Regole:
+- Mai consumo umano, ricette di recupero o donazioni a banchi alimentari.
+- animal_feed: solo frutta/verdura integra (max 5 giorni), pane raffermo senza muffa, pasta secca; mai latticini, carne, pesce o muffa; contattare prima il rifugio.
+- composting: frutta, verdura, fondi di caffè, gusci d'uovo; pane/pasta/riso con moderazione; mai carne, pesce, latticini, oli.
+- reuse: solo usi non alimentari (bucce di agrumi come detergente, fondi di caffè come fertilizzante).
+- disposal: muffa, latticini, carne, pesce; oli all'isola ecologica.
+- Istruzioni specifiche (tempi, quantità), contesto italiano (compostiere comunali, isole ecologiche).
+Rispondi SOLO con JSON:
+{"suggestions":[{"product_name":"...","recycling_options":[{"type":"composting|reuse|animal_feed|disposal","title":"...","description":"frase breve","instructions":["max 3 passi"]}]}]}"""
+
+_RECYCLING_SYSTEM_MSG = {"role": "system", "content": _RECYCLING_SYSTEM_PROMPT}
+
+# Opzioni di fallback: parti fisse costruite una volta all'import; per ogni
+# prodotto si copiano (vedi _recycling_option) e si compilano solo i campi che
+# contengono il nome
+_PRODUCE_COMPOST_OPTION = {
+    'type': 'composting',
+    'title': 'Compostaggio Domestico',
+    'benefits': [
+        'Fertilizzante naturale gratuito per piante',
+        'Riduce i rifiuti del 30% in casa',
+        'Migliora la struttura del suolo',
+        'Zero emissioni rispetto allo smaltimento'
+    ],
+    'contact_info': 'Se non hai compostiera: cerca "compostiera comunale + [tua città]" online per punti di raccolta gratuiti',
+    'requirements': 'Compostiera domestica o spazio in giardino. Se abiti in appartamento: compostiera da balcone o vermicompostaggio',
+    'icon': 'bi-recycle',
+    'priority': 'high'
+}
+_PRODUCE_COMPOST_STEPS = [
+    'Mescola con materiale "marrone" (foglie secche, cartone, segatura) in rapporto 1:2',
+    'Aggiungi alla compostiera o crea un cumulo in giardino',
+    'Mescola ogni 2-3 settimane per areazione',
+    'Tempo di decomposizione: 2-4 mesi (più veloce in estate)'
+]
+
+# Requisiti comuni alle donazioni ad animali (completati con il nome o l'avviso sul rifugio)
+_ANIMAL_FEED_REQS = 'Prodotto integro, senza muffa. Scaduto da max 5 giorni.'
+
+_PRODUCE_ANIMAL_FEED_OPTION = {
+    'type': 'animal_feed',
+    'title': 'Donazione a Rifugi Animali',
+    'instructions': [
+        'Verifica che NON ci siano muffe o marciume',
+        'Contatta prima un canile/rifugio locale (cerca online "canile + [tua città]")',
+        'Chiedi quali verdure/frutti accettano (alcuni evitano cipolle, aglio, avocado)',
+        'Porta entro 24 ore in contenitore pulito',
+        'Specifica la data di scadenza al rifugio'
+    ],
+    'benefits': [
+        'Aiuti animali bisognosi',
+        'Risparmi ai rifugi costi di alimentazione',
+        'Riduci sprechi alimentari'
+    ],
+    'contact_info': '⚠️ IMPORTANTE: Chiama PRIMA di portare. Alcuni rifugi hanno restrizioni specifiche.',
+    'icon': 'bi-heart-fill',
+    'priority': 'high'
+}
+
+_BREAD_REUSE_OPTION = {
+    'type': 'reuse',
+    'title': 'Pangrattato Casalingo',
+    'description': 'Trasforma il pane raffermo in pangrattato da conservare per mesi.',
+    'instructions': [
+        'Verifica che NON ci sia muffa (se c\'è, vai al compostaggio)',
+        'Taglia il pane a fette sottili',
+        'Asciuga in forno a 100°C per 30-40 minuti',
+        'Frulla fino a ottenere briciole fini',
+        'Conserva in barattolo di vetro per 3-6 mesi'
+    ],
+    'benefits': [
+        'Pangrattato sempre pronto per impanature',
+        'Risparmi denaro (non compri più pangrattato)',
+        'Zero sprechi'
+    ],
+    'contact_info': '',
+    'requirements': 'Forno, mixer o frullatore, barattolo ermetico. Pane SENZA muffa.',
+    'icon': 'bi-lightbulb',
+    'priority': 'high'
+}
+
+_GRAINS_COMPOST_OPTION = {
+    'type': 'composting',
+    'title': 'Compostaggio (con moderazione)',
+    'instructions': [
+        'Sbriciola finemente il prodotto',
+        'Mescola BENE con materiale marrone (foglie, terra)',
+        'Interra al centro della compostiera (non in superficie)',
+        'Aggiungi PICCOLE quantità alla volta (max 10% del compost)',
+        'Copri subito con terriccio o foglie'
+    ],
+    'benefits': [
+        'Arricchisce il compost di carboidrati',
+        'Riduce i rifiuti domestici'
+    ],
+    'contact_info': '⚠️ ATTENZIONE: Pane e cereali attraggono topi e ratti. Usa solo se hai compostiera chiusa.',
+    'requirements': 'Compostiera CHIUSA (no cumulo aperto). Non usare se hai problemi di roditori.',
+    'icon': 'bi-recycle',
+    'priority': 'medium'
+}
+
+_DAIRY_DISPOSAL_OPTION = {
+    'type': 'disposal',
+    'title': 'Smaltimento Sicuro nell\'Organico',
+    'instructions': [
+        'NON compostare (attira animali e crea odori)',
+        'Butta nel bidone dell\'organico/umido',
+        'Svuota liquidi nel lavandino prima di buttare il contenitore',
+        'Risciacqua e ricicla la confezione (plastica/cartone)',
+        'Lavati bene le mani dopo'
+    ],
+    'benefits': [
+        'Smaltimento igienico e sicuro',
+        'Evita contaminazioni batteriche',
+        'Previene cattivi odori'
+    ],
+    'contact_info': 'Per dubbi: cerca le indicazioni per la raccolta differenziata del tuo comune',
+    'requirements': 'Seguire le norme di raccolta differenziata locali',
+    'icon': 'bi-trash',
+    'priority': 'high'
+}
+
+_MEAT_DISPOSAL_OPTION = {
+    'type': 'disposal',
+    'title': 'Smaltimento Immediato nell\'Umido',
+    'instructions': [
+        'NON compostare mai carne/pesce (batteri pericolosi + cattivi odori)',
+        'Sigilla in sacchetto chiuso',
+        'Butta nel bidone dell\'organico/umido',
+        'Porta subito il bidone fuori (evita odori in casa)',
+        'Lava mani e superfici con sapone',
+        'Disinfetta il frigo se era presente liquido'
+    ],
+    'benefits': [
+        'Previene rischi sanitari gravi',
+        'Evita proliferazione batteri',
+        'Previene cattivi odori'
+    ],
+    'contact_info': '🚨 PERICOLO SANITARIO: Non riutilizzare in alcun modo.',
+    'requirements': 'Smaltimento immediato. Igienizzazione superfici.',
+    'icon': 'bi-trash',
+    'priority': 'high'
+}
+
+_OTHER_COMPOST_OPTION = {
+    'type': 'composting',
+    'title': 'Compostaggio (verifica compatibilità)',
+    'description': 'Se è un prodotto di origine vegetale, probabilmente può essere compostato.',
+    'instructions': [
+        'Verifica che sia di origine vegetale (no carne, latticini, oli)',
+        'Taglia in pezzi piccoli',
+        'Aggiungi alla compostiera mescolando con materiale secco',
+        'Se hai dubbi, chiedi all\'isola ecologica locale'
+    ],
+    'benefits': [
+        'Fertilizzante naturale',
+        'Riduce rifiuti in discarica'
+    ],
+    'contact_info': 'Per dubbi: contatta l\'isola ecologica comunale',
+    'requirements': 'Compostiera o punto di raccolta comunale',
+    'icon': 'bi-recycle',
+    'priority': 'medium'
+}
+
+
+# Arricchimento lato server delle opzioni AI (l'LLM genera solo tipo, titolo,
+# descrizione e istruzioni): testi per tipo di riciclo e categoria prodotto,
+# presi dalle opzioni di fallback per non duplicarli
+_BENEFITS_BY_TYPE = {
+    'composting': _PRODUCE_COMPOST_OPTION['benefits'],
+    'animal_feed': _PRODUCE_ANIMAL_FEED_OPTION['benefits'],
+    'reuse': ['Zero sprechi', 'Risparmi denaro'],
+    'disposal': _DAIRY_DISPOSAL_OPTION['benefits']
+}
+
+_CONTACT_BY_TYPE = {
+    option['type']: option['contact_info']
+    for option in (_PRODUCE_COMPOST_OPTION, _PRODUCE_ANIMAL_FEED_OPTION, _DAIRY_DISPOSAL_OPTION)
+}
+
+# Gruppi di categorie prodotto con le stesse regole di riciclo
+_RECYCLING_CATEGORY_GROUPS = {
+    **dict.fromkeys(('verdura', 'frutta', 'ortaggi'), 'produce'),
+    **dict.fromkeys(('pane', 'pasta', 'cereali', 'farina'), 'grains'),
+    **dict.fromkeys(('latticini', 'formaggi', 'latte', 'yogurt'), 'dairy'),
+    **dict.fromkeys(('carne', 'pesce', 'salumi'), 'meat')
+}
+
+_REQS_BY_CATEGORY = {
+    'produce': _PRODUCE_COMPOST_OPTION['requirements'],
+    'grains': _GRAINS_COMPOST_OPTION['requirements'],
+    'dairy': _DAIRY_DISPOSAL_OPTION['requirements'],
+    'meat': _MEAT_DISPOSAL_OPTION['requirements'],
+    None: _OTHER_COMPOST_OPTION['requirements']
+}
+
+# Requisiti che dipendono dal tipo di riciclo più che dalla categoria
+_REQS_BY_TYPE = {
+    'animal_feed': f'{_ANIMAL_FEED_REQS} Verifica che il rifugio lo accetti.',
+    'reuse': 'Prodotto senza muffa.'
+}
+
+
+def _recycling_category_group(category):
+    """Gruppo di regole di riciclo per una categoria prodotto (None se non classificata)"""
+    return _RECYCLING_CATEGORY_GROUPS.get((category or '').lower())
+
+
+# Modello per i suggerimenti di riciclo (GROQ_RECYCLING_TIER=balanced per confronto qualità)
+RECYCLING_MODEL = MODEL_TIERS.get(os.environ.get('GROQ_RECYCLING_TIER', 'instant'), INSTANT_MODEL)
+
+# Prodotti per richiesta AI di riciclo
+_RECYCLING_BATCH_SIZE = 10
+# I suggerimenti dipendono solo dai prodotti: restano validi a lungo
+_RECYCLING_CACHE_TTL = 7 * 86400
+# Budget di token in uscita: ~220 per prodotto (fino a 3 opzioni) + JSON di contorno
+_RECYCLING_TOKENS_PER_PRODUCT = 220
+_RECYCLING_MAX_TOKENS = 3000
+
+
 def ai_suggest_food_recycling(expired_products, user_id=None):
     """
     Suggerisce modi per riciclare/riutilizzare cibo scaduto usando AI
     
+    I prodotti vengono inviati a gruppi di _RECYCLING_BATCH_SIZE per richiesta
+    (più prodotti per prompt, ma senza risposte troppo lunghe); i gruppi
+    partono in parallelo sul pool AI.
+    
     Args:
         expired_products: Lista di prodotti scaduti
         user_id: ID utente per personalizzazione
@@ -1144,183 +2191,197 @@ def ai_suggest_food_recycling(expired_products, user_id=None):
     Returns:
         dict: Suggerimenti di riciclo per ogni prodotto
     """
-    try:
-        api_key = os.getenv('GROQ_API_KEY')
-        
-        if not api_key:
-            current_app.logger.error("GROQ_API_KEY not configured")
-            return _generate_fallback_recycling_suggestions(expired_products)
-        
-        if not expired_products:
-            return {'success': True, 'suggestions': []}
-        
-        # Prepara lista prodotti scaduti con informazioni dettagliate
-        from datetime import datetime
-        today = datetime.now().date()
-        products_text = "\n".join([
-            f"- {p.name} (categoria: {p.category}, quantità: {p.quantity} {p.unit}, scaduto da {(today - p.expiry_date).days} giorni)" 
-            for p in expired_products
-        ])
-        
-        # Recupera preferenze utente se disponibili
-        dietary_info = _get_user_dietary_info(user_id) if user_id else "Nessuna preferenza specificata"
-        
-        # Prompt per AI - completamente rinnovato per essere più realistico
-        system_prompt = """Sei un esperto di sostenibilità ambientale e gestione rifiuti alimentari.
-Genera suggerimenti PRATICI, REALISTICI e SICURI per riciclare cibo scaduto in formato JSON.
-
-Formato richiesto:
-{
-  "suggestions": [
-    {
-      "product_name": "Nome Prodotto",
-      "recycling_options": [
-        {
-          "type": "composting|reuse|animal_feed",
-          "title": "Titolo breve e chiaro",
-          "description": "Descrizione pratica di cosa fare",
-          "instructions": ["step 1", "step 2", "step 3"],
-          "benefits": ["beneficio 1", "beneficio 2"],
-          "contact_info": "Info se necessario",
-          "requirements": "Cosa serve per farlo"
-        }
-      ]
+    if not GROQ_API_KEY:
+        return _generate_fallback_recycling_suggestions(expired_products)
+    
+    if not expired_products:
+        return {'success': True, 'suggestions': []}
+    
+    chunks = [
+        expired_products[i:i + _RECYCLING_BATCH_SIZE]
+        for i in range(0, len(expired_products), _RECYCLING_BATCH_SIZE)
+    ]
+    # Dentro un thread del pool (es. dashboard) si procede in sequenza:
+    # attendere altri task dello stesso pool potrebbe esaurirne i worker
+    if len(chunks) == 1 or _in_ai_worker():
+        results = [_suggest_food_recycling_chunk(chunk) for chunk in chunks]
+    else:
+        futures = [submit_ai_task(_suggest_food_recycling_chunk, chunk) for chunk in chunks]
+        results = [future.result() for future in futures]
+    
+    if len(results) == 1:
+        return results[0]
+    suggestions = [s for result in results for s in result.get('suggestions', [])]
+    return {
+        'success': True,
+        'suggestions': suggestions,
+        'total_products': len(suggestions)
     }
-  ]
-}
 
-🚨 REGOLE CRITICHE PER LA SICUREZZA:
 
-1. **CIBO SCADUTO NON È MAI SICURO PER CONSUMO UMANO**
-   - NON suggerire MAI di mangiarlo o donarlo a banchi alimentari
-   - NON proporre ricette per "recuperare" cibo scaduto
+def _days_expired(products):
+    """Giorni dalla scadenza per ogni prodotto (stesso ordine), calcolati una volta"""
+    today = datetime.now().date()
+    return [(today - p.expiry_date).days for p in products]
 
-2. **DONAZIONE ANIMALI** (type: "animal_feed")
-   - OK SOLO per: verdure/frutta integre scadute da max 3-5 giorni
-   - OK per: pane raffermo (non ammuffito), pasta secca
-   - MAI per: latticini, carne, pesce, prodotti con muffa
-   - Sempre specificare: "Contatta prima il canile/rifugio per verificare"
 
-3. **COMPOSTAGGIO** (type: "composting") - LA SOLUZIONE MIGLIORE
-   - OK per: tutta la frutta, verdura, scarti vegetali, fondi caffè, gusci uovo
-   - OK con moderazione: pane, pasta, riso (attirano roditori)
-   - MAI per: carne, pesce, latticini, oli, prodotti animali
-   - Spiega come fare compost domestico o dove trovare compostiere comunali
-
-4. **RIUTILIZZO NON ALIMENTARE** (type: "reuse")
-   - Bucce di agrumi: detergenti naturali, profumatori
-   - Fondi di caffè: fertilizzante, scrub corpo, assorbi-odori
-   - Gusci d'uovo: fertilizzante ricco di calcio
-   - Acqua di cottura verdure: annaffiare piante
+def _build_recycling_prompt(products, days_expired):
+    """Prompt utente con i prodotti scaduti di un gruppo"""
+    products_text = "\n".join([
+        f"- {p.name} (categoria: {p.category}, quantità: {p.quantity} {p.unit}, scaduto da {days} giorni)" 
+        for p, days in zip(products, days_expired)
+    ])
+    
+    return f"""Prodotti scaduti:
+{products_text}
+Giorni dalla scadenza: 1-5 animal_feed ammesso se integro; 6-14 solo compostaggio o riutilizzo; 15+ compostaggio o smaltimento."""
 
-5. **COSA EVITARE**
-   - Prodotti con muffa: NON compostabili, solo smaltimento
-   - Latticini scaduti: rischio batterico alto, solo smaltimento
-   - Carne/pesce: rischio sanitario, solo smaltimento differenziato
-   - Oli e grassi: NON nel compost, portare in isole ecologiche
 
-📋 STRUTTURA SUGGERIMENTI:
+def _recycling_request_body(products, days_expired):
+    """Body della richiesta Groq di riciclo per un gruppo di prodotti"""
+    return {
+        "model": RECYCLING_MODEL,
+        "messages": [
+            _RECYCLING_SYSTEM_MSG,
+            {"role": "user", "content": _build_recycling_prompt(products, days_expired)}
+        ],
+        # Solo i token necessari al gruppo: meno spazio per risposte prolisse
+        "max_tokens": min(_RECYCLING_MAX_TOKENS, _RECYCLING_TOKENS_PER_PRODUCT * max(1, len(products)) + 200),
+        # Deterministico: la risposta è riutilizzabile dalla cache
+        "temperature": 0,
+        # JSON mode: Groq garantisce un oggetto JSON valido, senza recinti markdown
+        "response_format": {"type": "json_object"}
+    }
 
-Per ogni prodotto, fornisci 2-3 opzioni in ordine di priorità:
-1. PRIMA SCELTA: Compostaggio (se applicabile)
-2. SECONDA SCELTA: Riutilizzo creativo/donazione animali (se sicuro)
-3. TERZA SCELTA: Smaltimento corretto
 
-Sii SPECIFICO nelle istruzioni:
-- Non "compostalo" ma "Taglia in pezzi da 5cm, mescola con foglie secche, tempo decomposizione: 2-3 mesi"
-- Non "dona al canile" ma "Contatta canile locale prima, porta entro 24h, no prodotti ammuffiti"
-- Includi TEMPI: "Decomposizione: 1-2 mesi", "Conservazione: max 3 giorni"
+def _recycling_cache_key(products, days_expired):
+    """Chiave cache canonica: (nome, categoria, giorni di scadenza fino a 30) ordinati"""
+    return ai_cache.make_key('recycling', {
+        'model': RECYCLING_MODEL,
+        'products': sorted(
+            (_normalize_token(p.name), _normalize_token(p.category), min(days, 30))
+            for p, days in zip(products, days_expired)
+        )
+    })
 
-🌍 CONTATTI UTILI DA SUGGERIRE:
-- Compostiere comunali: "Cerca 'compostaggio + [tua città]' online"
-- Centri raccolta rifiuti: "Isola ecologica più vicina"
-- Rifugi animali: "Cerca 'canile + [tua città]' e chiama prima"
 
-Rispondi SOLO con JSON valido. Priorità: SICUREZZA > PRATICITÀ > CREATIVITÀ."""
+def _suggest_food_recycling_chunk(expired_products):
+    """Una chiamata AI per un gruppo di prodotti scaduti (fallback a regole se fallisce)"""
+    # Giorni di scadenza calcolati una volta per prompt, chiave cache e fallback
+    days_expired = _days_expired(expired_products)
+    try:
+        # Stessi prodotti (nome, categoria, giorni di scadenza) = stessa risposta,
+        # anche tra utenti diversi: si riusa il JSON già generato
+        cache_key = _recycling_cache_key(expired_products, days_expired)
+        cached = ai_cache.get(cache_key)
+        if cached is not None:
+            return _validate_and_enrich_recycling_suggestions(cached, expired_products)
         
-        user_prompt = f"""Prodotti scaduti da riciclare:
-{products_text}
-
-IMPORTANTE: Per ogni prodotto, considera i GIORNI DI SCADENZA specificati:
-- Scaduto da 1-5 giorni: potenzialmente ancora sicuro per donazione animali (se integro, no muffa)
-- Scaduto da 6-14 giorni: solo compostaggio o riutilizzo non alimentare
-- Scaduto da 15+ giorni: compostaggio o smaltimento, NON donazione
-
-Genera suggerimenti di riciclo REALISTICI per ogni prodotto seguendo le regole di sicurezza:
-1. Priorità al compostaggio per prodotti organici
-2. Donazione animali SOLO se sicuro (max 5 giorni, no muffa, no latticini/carne)
-3. Riutilizzi creativi non alimentari (detergenti, fertilizzanti, etc)
-4. NO donazioni a banchi alimentari (cibo scaduto non è legale)
-
-Sii MOLTO specifico nelle istruzioni (tempi, temperature, quantità).
-Considera la situazione italiana (isole ecologiche, compostiere comunali, rifugi locali)."""
-
         # Chiamata API
-        response = requests.post(
-            GROQ_API_URL,
-            headers={
-                "Authorization": f"Bearer {api_key}",
-                "Content-Type": "application/json"
-            },
-            json={
-                "model": DEFAULT_MODEL,
-                "messages": [
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ],
-                "max_tokens": 3000,
-                "temperature": 0.7
-            },
-            timeout=30
-        )
+        response = _groq_post(_recycling_request_body(expired_products, days_expired), timeout=30)
         
         if response.status_code != 200:
-            current_app.logger.error(f"Groq API error: {response.status_code} - {response.text}")
-            return _generate_fallback_recycling_suggestions(expired_products)
+            current_app.logger.error("Groq API error: %s - %s", response.status_code, response.text)
+            return _generate_fallback_recycling_suggestions(expired_products, days_expired)
         
         # Parse response
         try:
-            payload = response.json()
-        except Exception as e:
-            current_app.logger.error(f"Groq API invalid JSON: {e}; body={response.text[:500]}")
-            return _generate_fallback_recycling_suggestions(expired_products)
+            payload = _json_loads(response.content)
+        except ValueError as e:
+            current_app.logger.error("Groq API invalid JSON: %s; body=%s", e, response.text[:500])
+            return _generate_fallback_recycling_suggestions(expired_products, days_expired)
         
         content = (payload.get("choices") or [{}])[0].get("message", {}).get("content", "")
         if not content:
             current_app.logger.warning("Groq API empty content")
-            return _generate_fallback_recycling_suggestions(expired_products)
-        
-        # Estrai JSON
-        content = content.strip()
-        if content.startswith("```json"):
-            content = content[7:]
-        if content.startswith("```"):
-            content = content[3:]
-        if content.endswith("```"):
-            content = content[:-3]
-        content = content.strip()
+            return _generate_fallback_recycling_suggestions(expired_products, days_expired)
         
-        # Parse JSON
+        # Parse JSON (JSON mode: niente recinti da rimuovere; l'except resta come difesa)
         try:
-            data = json.loads(content)
+            data = _json_loads(content)
             suggestions = data.get("suggestions", [])
+            if suggestions:
+                ai_cache.set(cache_key, suggestions, ttl=_RECYCLING_CACHE_TTL)
             
             # Valida e arricchisci i suggerimenti
             return _validate_and_enrich_recycling_suggestions(suggestions, expired_products)
             
         except json.JSONDecodeError as e:
-            current_app.logger.error(f"Invalid JSON from AI: {e}; content: {content[:500]}")
-            return _generate_fallback_recycling_suggestions(expired_products)
+            current_app.logger.error("Invalid JSON from AI: %s; content: %s", e, content[:500])
+            return _generate_fallback_recycling_suggestions(expired_products, days_expired)
         
     except Exception as e:
-        current_app.logger.error(f"ai_suggest_food_recycling error: {e}")
-        return _generate_fallback_recycling_suggestions(expired_products)
+        current_app.logger.error("_suggest_food_recycling_chunk error: %s", e)
+        return _generate_fallback_recycling_suggestions(expired_products, days_expired)
+
+
+def ai_suggest_food_recycling_stream(expired_products):
+    """
+    Versione in streaming di ai_suggest_food_recycling: genera ogni
+    suggerimento (già arricchito) appena Groq chiude l'oggetto del suo
+    prodotto, senza attendere la risposta completa. I gruppi di prodotti
+    vengono elaborati in sequenza.
+    """
+    if not expired_products:
+        return
+    if not GROQ_API_KEY:
+        yield from _generate_fallback_recycling_suggestions(expired_products).get('suggestions', [])
+        return
+    
+    for i in range(0, len(expired_products), _RECYCLING_BATCH_SIZE):
+        yield from _stream_recycling_chunk(expired_products[i:i + _RECYCLING_BATCH_SIZE])
+
+
+def _stream_recycling_chunk(expired_products):
+    """Suggerimenti di un gruppo di prodotti man mano che arrivano dallo stream Groq"""
+    days_expired = _days_expired(expired_products)
+    try:
+        cache_key = _recycling_cache_key(expired_products, days_expired)
+        cached = ai_cache.get(cache_key)
+        if cached is not None:
+            yield from _validate_and_enrich_recycling_suggestions(cached, expired_products).get('suggestions', [])
+            return
+        
+        chunks = _groq_stream(_recycling_request_body(expired_products, days_expired), timeout=30)
+    except Exception as e:
+        current_app.logger.error("_stream_recycling_chunk error: %s", e)
+        yield from _generate_fallback_recycling_suggestions(expired_products, days_expired).get('suggestions', [])
+        return
+    
+    parser = IncrementalJsonParser()
+    raw_suggestions = []
+    emitted = False
+    completed = False
+    try:
+        for chunk in chunks:
+            for path, item in parser.feed(chunk):
+                # Solo gli oggetti prodotto chiusi dentro "suggestions"
+                if path != ['suggestions'] or item is IncrementalJsonParser.ARRAY_END:
+                    continue
+                raw_suggestions.append(item)
+                enriched = _validate_and_enrich_recycling_suggestions([item], expired_products)
+                for suggestion in enriched.get('suggestions', []):
+                    emitted = True
+                    yield suggestion
+        completed = True
+    except Exception as e:
+        current_app.logger.error("_stream_recycling_chunk error: %s", e)
+    finally:
+        chunks.close()
+    
+    # In cache solo risposte ricevute per intero
+    if raw_suggestions and completed:
+        ai_cache.set(cache_key, raw_suggestions, ttl=_RECYCLING_CACHE_TTL)
+    if not emitted:
+        yield from _generate_fallback_recycling_suggestions(expired_products, days_expired).get('suggestions', [])
 
 
 def _validate_and_enrich_recycling_suggestions(suggestions, expired_products):
     """Valida e arricchisce i suggerimenti di riciclo"""
     try:
         enriched_suggestions = []
+        # Indice nome -> prodotto (reversed: a parità di nome vince il primo, come prima)
+        by_name = {product.name.casefold(): product for product in reversed(expired_products)}
         
         for suggestion in suggestions:
             if not isinstance(suggestion, dict) or 'product_name' not in suggestion:
@@ -1330,32 +2391,30 @@ def _validate_and_enrich_recycling_suggestions(suggestions, expired_products):
             recycling_options = suggestion.get('recycling_options', [])
             
             # Trova il prodotto corrispondente
-            matching_product = None
-            for product in expired_products:
-                if product.name.lower() == product_name.lower():
-                    matching_product = product
-                    break
+            matching_product = by_name.get(product_name.casefold())
             
             if not matching_product:
                 continue
             
-            # Valida e arricchisci le opzioni
+            # Valida e arricchisci le opzioni (testi fissi da tipo e categoria)
+            category_reqs = _REQS_BY_CATEGORY[_recycling_category_group(matching_product.category)]
             valid_options = []
             for option in recycling_options:
                 if not isinstance(option, dict) or 'type' not in option:
                     continue
                 
                 # Normalizza l'opzione
+                option_type = option.get('type') or 'reuse'
                 normalized_option = {
-                    'type': option.get('type', 'reuse'),
+                    'type': option_type,
                     'title': option.get('title', 'Opzione di Riciclo'),
                     'description': option.get('description', ''),
                     'instructions': option.get('instructions', []),
-                    'benefits': option.get('benefits', []),
-                    'contact_info': option.get('contact_info', ''),
-                    'requirements': option.get('requirements', ''),
-                    'icon': _get_recycling_icon(option.get('type', 'reuse')),
-                    'priority': _get_recycling_priority(option.get('type', 'reuse'))
+                    'benefits': option.get('benefits') or list(_BENEFITS_BY_TYPE.get(option_type, ())),
+                    'contact_info': option.get('contact_info') or _CONTACT_BY_TYPE.get(option_type, ''),
+                    'requirements': option.get('requirements') or _REQS_BY_TYPE.get(option_type, category_reqs),
+                    'icon': _get_recycling_icon(option_type),
+                    'priority': _get_recycling_priority(option_type)
                 }
                 
                 valid_options.append(normalized_option)
@@ -1374,198 +2433,113 @@ def _validate_and_enrich_recycling_suggestions(suggestions, expired_products):
         }
         
     except Exception as e:
-        current_app.logger.error(f"_validate_and_enrich_recycling_suggestions error: {e}")
+        current_app.logger.error("_validate_and_enrich_recycling_suggestions error: %s", e)
         return _generate_fallback_recycling_suggestions(expired_products)
 
 
-def _generate_fallback_recycling_suggestions(expired_products):
-    """Genera suggerimenti realistici e sicuri se AI non funziona"""
+def _recycling_option(template, **fields):
+    """Copia di un'opzione di fallback con liste proprie (modificabili dal chiamante)"""
+    option = {**template, **fields}
+    for key in ('instructions', 'benefits'):
+        if key in option:
+            option[key] = list(option[key])
+    return option
+
+
+def _produce_recycling_options(product, days_expired):
+    """Opzioni di riciclo per frutta e verdura"""
+    name = product.name
+    # Compostaggio - sempre prima opzione
+    recycling_options = [_recycling_option(
+        _PRODUCE_COMPOST_OPTION,
+        description=f'Il compost è la soluzione migliore per {name}. Crea fertilizzante naturale ricco di nutrienti per piante e giardino.',
+        instructions=[f'Taglia {name} in pezzi di 3-5 cm per accelerare la decomposizione', *_PRODUCE_COMPOST_STEPS]
+    )]
+    
+    # Donazione animali solo se scaduto da poco e integro
+    if days_expired <= 5:
+        recycling_options.append(_recycling_option(
+            _PRODUCE_ANIMAL_FEED_OPTION,
+            description=f'{name} può essere utilizzato come cibo per animali se ancora integro (no muffa, no marciume).',
+            requirements=f'{_ANIMAL_FEED_REQS} {name} deve essere nella lista accettata dal rifugio.'
+        ))
+    
+    return recycling_options
+
+
+def _grains_recycling_options(product, days_expired):
+    """Opzioni di riciclo per pane e cereali"""
+    recycling_options = []
+    
+    # Pane raffermo può avere riutilizzo
+    if 'pane' in product.name.lower() and days_expired <= 7:
+        recycling_options.append(_recycling_option(_BREAD_REUSE_OPTION))
+    
+    # Compostaggio per pane (con cautela)
+    recycling_options.append(_recycling_option(
+        _GRAINS_COMPOST_OPTION,
+        description=f'{product.name} può essere compostato ma attira roditori. Usa con cautela.'
+    ))
+    
+    return recycling_options
+
+
+def _dairy_recycling_options(product, days_expired):
+    """Opzioni di riciclo per latticini"""
+    return [_recycling_option(
+        _DAIRY_DISPOSAL_OPTION,
+        description=f'{product.name} scaduto NON è sicuro né per compost né per animali. Smaltisci correttamente.'
+    )]
+
+
+def _meat_recycling_options(product, days_expired):
+    """Opzioni di riciclo per carne e pesce"""
+    return [_recycling_option(
+        _MEAT_DISPOSAL_OPTION,
+        description=f'{product.name} scaduto è ad ALTO RISCHIO BATTERICO. Smaltisci immediatamente in modo sicuro.'
+    )]
+
+
+def _other_recycling_options(product, days_expired):
+    """Opzioni di riciclo per prodotti non classificati"""
+    # Suggerimento generico per prodotti non categorizzati
+    return [_recycling_option(_OTHER_COMPOST_OPTION)]
+
+
+# Generatore di opzioni per gruppo di categoria (None = non classificata)
+_RECYCLING_OPTION_HANDLERS = {
+    'produce': _produce_recycling_options,
+    'grains': _grains_recycling_options,
+    'dairy': _dairy_recycling_options,
+    'meat': _meat_recycling_options,
+    None: _other_recycling_options
+}
+
+
+def _recycling_options_for(product, days_expired):
+    """Opzioni di riciclo di fallback per un prodotto, in base al gruppo di categoria"""
+    handler = _RECYCLING_OPTION_HANDLERS[_recycling_category_group(product.category)]
+    return handler(product, days_expired)
+
+
+def _generate_fallback_recycling_suggestions(expired_products, days_expired=None):
+    """
+    Genera suggerimenti realistici e sicuri se AI non funziona
+    (days_expired: giorni dalla scadenza già calcolati, stesso ordine dei prodotti)
+    """
     try:
-        from datetime import datetime, timedelta
-        suggestions = []
-        today = datetime.now().date()
-        
-        for product in expired_products:
-            recycling_options = []
-            category = product.category.lower()
-            days_expired = (today - product.expiry_date).days
-            
-            # === FRUTTA E VERDURA ===
-            if category in ['verdura', 'frutta', 'ortaggi']:
-                # Compostaggio - sempre prima opzione
-                recycling_options.append({
-                    'type': 'composting',
-                    'title': 'Compostaggio Domestico',
-                    'description': f'Il compost è la soluzione migliore per {product.name}. Crea fertilizzante naturale ricco di nutrienti per piante e giardino.',
-                    'instructions': [
-                        f'Taglia {product.name} in pezzi di 3-5 cm per accelerare la decomposizione',
-                        'Mescola con materiale "marrone" (foglie secche, cartone, segatura) in rapporto 1:2',
-                        'Aggiungi alla compostiera o crea un cumulo in giardino',
-                        'Mescola ogni 2-3 settimane per areazione',
-                        f'Tempo di decomposizione: 2-4 mesi (più veloce in estate)'
-                    ],
-                    'benefits': [
-                        'Fertilizzante naturale gratuito per piante',
-                        'Riduce i rifiuti del 30% in casa',
-                        'Migliora la struttura del suolo',
-                        'Zero emissioni rispetto allo smaltimento'
-                    ],
-                    'contact_info': 'Se non hai compostiera: cerca "compostiera comunale + [tua città]" online per punti di raccolta gratuiti',
-                    'requirements': 'Compostiera domestica o spazio in giardino. Se abiti in appartamento: compostiera da balcone o vermicompostaggio',
-                    'icon': 'bi-recycle',
-                    'priority': 'high'
-                })
-                
-                # Donazione animali solo se scaduto da poco e integro
-                if days_expired <= 5:
-                    recycling_options.append({
-                        'type': 'animal_feed',
-                        'title': 'Donazione a Rifugi Animali',
-                        'description': f'{product.name} può essere utilizzato come cibo per animali se ancora integro (no muffa, no marciume).',
-                        'instructions': [
-                            'Verifica che NON ci siano muffe o marciume',
-                            'Contatta prima un canile/rifugio locale (cerca online "canile + [tua città]")',
-                            'Chiedi quali verdure/frutti accettano (alcuni evitano cipolle, aglio, avocado)',
-                            'Porta entro 24 ore in contenitore pulito',
-                            'Specifica la data di scadenza al rifugio'
-                        ],
-                        'benefits': [
-                            'Aiuti animali bisognosi',
-                            'Risparmi ai rifugi costi di alimentazione',
-                            'Riduci sprechi alimentari'
-                        ],
-                        'contact_info': '⚠️ IMPORTANTE: Chiama PRIMA di portare. Alcuni rifugi hanno restrizioni specifiche.',
-                        'requirements': f'Prodotto integro, senza muffa. Scaduto da max 5 giorni. {product.name} deve essere nella lista accettata dal rifugio.',
-                        'icon': 'bi-heart-fill',
-                        'priority': 'high'
-                    })
-            
-            # === PANE E CEREALI ===
-            elif category in ['pane', 'pasta', 'cereali', 'farina']:
-                if 'pane' in product.name.lower() and days_expired <= 7:
-                    # Pane raffermo può avere riutilizzo
-                    recycling_options.append({
-                        'type': 'reuse',
-                        'title': 'Pangrattato Casalingo',
-                        'description': 'Trasforma il pane raffermo in pangrattato da conservare per mesi.',
-                        'instructions': [
-                            'Verifica che NON ci sia muffa (se c\'è, vai al compostaggio)',
-                            'Taglia il pane a fette sottili',
-                            'Asciuga in forno a 100°C per 30-40 minuti',
-                            'Frulla fino a ottenere briciole fini',
-                            'Conserva in barattolo di vetro per 3-6 mesi'
-                        ],
-                        'benefits': [
-                            'Pangrattato sempre pronto per impanature',
-                            'Risparmi denaro (non compri più pangrattato)',
-                            'Zero sprechi'
-                        ],
-                        'contact_info': '',
-                        'requirements': 'Forno, mixer o frullatore, barattolo ermetico. Pane SENZA muffa.',
-                        'icon': 'bi-lightbulb',
-                        'priority': 'high'
-                    })
-                
-                # Compostaggio per pane (con cautela)
-                recycling_options.append({
-                    'type': 'composting',
-                    'title': 'Compostaggio (con moderazione)',
-                    'description': f'{product.name} può essere compostato ma attira roditori. Usa con cautela.',
-                    'instructions': [
-                        'Sbriciola finemente il prodotto',
-                        'Mescola BENE con materiale marrone (foglie, terra)',
-                        'Interra al centro della compostiera (non in superficie)',
-                        'Aggiungi PICCOLE quantità alla volta (max 10% del compost)',
-                        'Copri subito con terriccio o foglie'
-                    ],
-                    'benefits': [
-                        'Arricchisce il compost di carboidrati',
-                        'Riduce i rifiuti domestici'
-                    ],
-                    'contact_info': '⚠️ ATTENZIONE: Pane e cereali attraggono topi e ratti. Usa solo se hai compostiera chiusa.',
-                    'requirements': 'Compostiera CHIUSA (no cumulo aperto). Non usare se hai problemi di roditori.',
-                    'icon': 'bi-recycle',
-                    'priority': 'medium'
-                })
-            
-            # === LATTICINI ===
-            elif category in ['latticini', 'formaggi', 'latte', 'yogurt']:
-                recycling_options.append({
-                    'type': 'disposal',
-                    'title': 'Smaltimento Sicuro nell\'Organico',
-                    'description': f'{product.name} scaduto NON è sicuro né per compost né per animali. Smaltisci correttamente.',
-                    'instructions': [
-                        'NON compostare (attira animali e crea odori)',
-                        'Butta nel bidone dell\'organico/umido',
-                        'Svuota liquidi nel lavandino prima di buttare il contenitore',
-                        'Risciacqua e ricicla la confezione (plastica/cartone)',
-                        'Lavati bene le mani dopo'
-                    ],
-                    'benefits': [
-                        'Smaltimento igienico e sicuro',
-                        'Evita contaminazioni batteriche',
-                        'Previene cattivi odori'
-                    ],
-                    'contact_info': 'Per dubbi: cerca le indicazioni per la raccolta differenziata del tuo comune',
-                    'requirements': 'Seguire le norme di raccolta differenziata locali',
-                    'icon': 'bi-trash',
-                    'priority': 'high'
-                })
-            
-            # === CARNE E PESCE ===
-            elif category in ['carne', 'pesce', 'salumi']:
-                recycling_options.append({
-                    'type': 'disposal',
-                    'title': 'Smaltimento Immediato nell\'Umido',
-                    'description': f'{product.name} scaduto è ad ALTO RISCHIO BATTERICO. Smaltisci immediatamente in modo sicuro.',
-                    'instructions': [
-                        'NON compostare mai carne/pesce (batteri pericolosi + cattivi odori)',
-                        'Sigilla in sacchetto chiuso',
-                        'Butta nel bidone dell\'organico/umido',
-                        'Porta subito il bidone fuori (evita odori in casa)',
-                        'Lava mani e superfici con sapone',
-                        'Disinfetta il frigo se era presente liquido'
-                    ],
-                    'benefits': [
-                        'Previene rischi sanitari gravi',
-                        'Evita proliferazione batteri',
-                        'Previene cattivi odori'
-                    ],
-                    'contact_info': '🚨 PERICOLO SANITARIO: Non riutilizzare in alcun modo.',
-                    'requirements': 'Smaltimento immediato. Igienizzazione superfici.',
-                    'icon': 'bi-trash',
-                    'priority': 'high'
-                })
-            
-            # === ALTRI PRODOTTI ===
-            else:
-                # Suggerimento generico per prodotti non categorizzati
-                recycling_options.append({
-                    'type': 'composting',
-                    'title': 'Compostaggio (verifica compatibilità)',
-                    'description': 'Se è un prodotto di origine vegetale, probabilmente può essere compostato.',
-                    'instructions': [
-                        'Verifica che sia di origine vegetale (no carne, latticini, oli)',
-                        'Taglia in pezzi piccoli',
-                        'Aggiungi alla compostiera mescolando con materiale secco',
-                        'Se hai dubbi, chiedi all\'isola ecologica locale'
-                    ],
-                    'benefits': [
-                        'Fertilizzante naturale',
-                        'Riduce rifiuti in discarica'
-                    ],
-                    'contact_info': 'Per dubbi: contatta l\'isola ecologica comunale',
-                    'requirements': 'Compostiera o punto di raccolta comunale',
-                    'icon': 'bi-recycle',
-                    'priority': 'medium'
-                })
-            
-            if recycling_options:
-                suggestions.append({
-                    'product': product,
-                    'product_name': product.name,
-                    'recycling_options': recycling_options
-                })
+        if days_expired is None:
+            days_expired = _days_expired(expired_products)
+        
+        suggestions = [
+            {
+                'product': product,
+                'product_name': product.name,
+                'recycling_options': recycling_options
+            }
+            for product, days in zip(expired_products, days_expired)
+            if (recycling_options := _recycling_options_for(product, days))
+        ]
         
         return {
             'success': True,
@@ -1574,7 +2548,7 @@ def _generate_fallback_recycling_suggestions(expired_products):
         }
         
     except Exception as e:
-        current_app.logger.error(f"_generate_fallback_recycling_suggestions error: {e}")
+        current_app.logger.error("_generate_fallback_recycling_suggestions error: %s", e)
         return {'success': False, 'suggestions': []}
 
 
@@ -1624,104 +2598,99 @@ def _validate_chat_response(data):
             'timestamp': datetime.now().isoformat()
         }
     except Exception as e:
-        current_app.logger.error(f"_validate_chat_response error: {e}")
+        current_app.logger.error("_validate_chat_response error: %s", e)
         return _generate_fallback_chat_response("")
 
 
+def _keyword_re(words):
+    """Regex che trova una qualsiasi delle parole/frasi come sottostringa"""
+    return re.compile('|'.join(map(re.escape, words)))
+
+
+# Parole chiave del chatbot di fallback, una regex precompilata per argomento:
+# una sola scansione del messaggio per argomento, mantenendo il confronto per
+# sottostringa (es. 'scade' copre anche 'scadenze', 'cosa fai' è una frase)
+_CHAT_KW_RECIPE = _keyword_re(('ricetta', 'cucinare', 'cucino', 'pasto', 'pranzo', 'cena'))
+_CHAT_KW_EXPIRY = _keyword_re(('scadenza', 'scaduto', 'scade', 'scaduti', 'vecchio'))
+_CHAT_KW_RECYCLING = _keyword_re(('riciclo', 'riciclare', 'spreco', 'sprechi', 'buttare', 'compost'))
+_CHAT_KW_SHOPPING = _keyword_re(('spesa', 'comprare', 'lista', 'shopping', 'supermercato'))
+_CHAT_KW_HELP = _keyword_re(('aiuto', 'help', 'come funziona', 'cosa fai', 'chi sei'))
+_CHAT_KW_PANTRY = _keyword_re(('dispensa', 'prodotti', 'inventario', 'magazzino'))
+
+
+# Risposte di fallback del chatbot (testo e suggerimenti fissi): costruite una
+# volta, per ogni risposta si aggiungono solo i campi variabili
+_CHAT_FALLBACK_RECIPE = {
+    'response': 'Perfetto! Posso aiutarti a trovare ricette basate su quello che hai in dispensa. Controlla la sezione Ricette AI per suggerimenti personalizzati, oppure dimmi che ingredienti hai e ti suggerisco qualcosa!',
+    'suggestions': ('Mostra i miei ingredienti', 'Suggerisci ricette veloci', 'Ricette con prodotti in scadenza'),
+}
+_CHAT_FALLBACK_EXPIRY = {
+    'response': 'Per controllare le scadenze vai alla tua Dispensa - lì puoi vedere tutti i prodotti, quelli in scadenza e quelli già scaduti. Per i prodotti scaduti, posso suggerirti modi creativi per riciclarli!',
+    'suggestions': ('Vedi prodotti in scadenza', 'Come riciclare cibo scaduto', 'Suggerimenti anti-spreco'),
+}
+_CHAT_FALLBACK_RECYCLING = {
+    'response': 'Ottimo che tu voglia ridurre gli sprechi! Nella sezione Riciclo trovi tanti suggerimenti per trasformare il cibo scaduto in compost, fertilizzante o cibo per animali. Ogni piccolo gesto conta!',
+    'suggestions': ('Idee per riciclare', 'Come fare il compost', 'Ridurre gli sprechi'),
+}
+_CHAT_FALLBACK_SHOPPING = {
+    'response': 'Vuoi gestire la tua lista della spesa? Controlla la sezione Liste Spesa dove puoi creare liste, aggiungere prodotti e segnare cosa hai già comprato. Posso anche suggerirti cosa comprare in base a cosa sta finendo!',
+    'suggestions': ('Vedi le mie liste', 'Cosa mi sta finendo?', 'Crea nuova lista'),
+}
+_CHAT_FALLBACK_HELP = {
+    'response': 'Ciao! Sono FoodFlowBot, il tuo assistente personale per gestire la dispensa. Ti aiuto a tenere traccia del cibo, suggerire ricette, ridurre sprechi e organizzare la spesa. Chiedimi quello che vuoi sapere!',
+    'suggestions': ('Cosa ho in dispensa?', 'Cosa posso cucinare?', 'Mostra le funzionalità'),
+}
+_CHAT_FALLBACK_PANTRY = {
+    'response': 'La tua dispensa è il cuore di FoodFlow! Lì puoi vedere tutti i prodotti che hai, quando scadono e quanto te ne resta. Vuoi che ti mostri un riepilogo di cosa hai?',
+    'suggestions': ('Mostra la mia dispensa', 'Prodotti in scadenza', 'Aggiungi prodotto'),
+}
+_CHAT_FALLBACK_DEFAULT = {
+    'response': 'Sono qui per aiutarti! Posso rispondere a domande sulla tua dispensa, suggerirti ricette, aiutarti con la lista della spesa o darti consigli anti-spreco. Cosa ti interessa di più?',
+    'suggestions': ('Cosa ho in dispensa?', 'Suggerisci ricette', 'Lista della spesa', 'Ridurre sprechi'),
+}
+_CHAT_FALLBACK_ERROR = {
+    'response': "Ops! Si è verificato un problema tecnico. Riprova tra un momento, oppure usa il menu per navigare nelle diverse sezioni dell'app.",
+    'suggestions': ('Vai alla Dashboard', 'Vedi la Dispensa', 'Ricette AI'),
+}
+
+
+def _chat_fallback(template, success=True):
+    """Risposta del chatbot da un template di fallback con timestamp corrente"""
+    return {
+        'success': success,
+        'response': template['response'],
+        'type': 'text',
+        'suggestions': list(template['suggestions']),
+        'actions': [],
+        'data': {},
+        'timestamp': datetime.now().isoformat()
+    }
+
+
 def _generate_fallback_chat_response(user_message):
     """Genera risposta di fallback se AI non funziona - più naturale e contestuale"""
     try:
         message_lower = user_message.lower()
         
         # Risposte predefinite più naturali basate su parole chiave
-        if any(word in message_lower for word in ['ricetta', 'cucinare', 'cucino', 'pasto', 'pranzo', 'cena']):
-            return {
-                'success': True,
-                'response': 'Perfetto! Posso aiutarti a trovare ricette basate su quello che hai in dispensa. Controlla la sezione Ricette AI per suggerimenti personalizzati, oppure dimmi che ingredienti hai e ti suggerisco qualcosa!',
-                'type': 'text',
-                'suggestions': ['Mostra i miei ingredienti', 'Suggerisci ricette veloci', 'Ricette con prodotti in scadenza'],
-                'actions': [],
-                'data': {},
-                'timestamp': datetime.now().isoformat()
-            }
-        
-        elif any(word in message_lower for word in ['scadenza', 'scaduto', 'scade', 'scaduti', 'vecchio']):
-            return {
-                'success': True,
-                'response': 'Per controllare le scadenze vai alla tua Dispensa - lì puoi vedere tutti i prodotti, quelli in scadenza e quelli già scaduti. Per i prodotti scaduti, posso suggerirti modi creativi per riciclarli!',
-                'type': 'text',
-                'suggestions': ['Vedi prodotti in scadenza', 'Come riciclare cibo scaduto', 'Suggerimenti anti-spreco'],
-                'actions': [],
-                'data': {},
-                'timestamp': datetime.now().isoformat()
-            }
-        
-        elif any(word in message_lower for word in ['riciclo', 'riciclare', 'spreco', 'sprechi', 'buttare', 'compost']):
-            return {
-                'success': True,
-                'response': 'Ottimo che tu voglia ridurre gli sprechi! Nella sezione Riciclo trovi tanti suggerimenti per trasformare il cibo scaduto in compost, fertilizzante o cibo per animali. Ogni piccolo gesto conta!',
-                'type': 'text',
-                'suggestions': ['Idee per riciclare', 'Come fare il compost', 'Ridurre gli sprechi'],
-                'actions': [],
-                'data': {},
-                'timestamp': datetime.now().isoformat()
-            }
-        
-        elif any(word in message_lower for word in ['spesa', 'comprare', 'lista', 'shopping', 'supermercato']):
-            return {
-                'success': True,
-                'response': 'Vuoi gestire la tua lista della spesa? Controlla la sezione Liste Spesa dove puoi creare liste, aggiungere prodotti e segnare cosa hai già comprato. Posso anche suggerirti cosa comprare in base a cosa sta finendo!',
-                'type': 'text',
-                'suggestions': ['Vedi le mie liste', 'Cosa mi sta finendo?', 'Crea nuova lista'],
-                'actions': [],
-                'data': {},
-                'timestamp': datetime.now().isoformat()
-            }
-        
-        elif any(word in message_lower for word in ['aiuto', 'help', 'come funziona', 'cosa fai', 'chi sei']):
-            return {
-                'success': True,
-                'response': 'Ciao! Sono FoodFlowBot, il tuo assistente personale per gestire la dispensa. Ti aiuto a tenere traccia del cibo, suggerire ricette, ridurre sprechi e organizzare la spesa. Chiedimi quello che vuoi sapere!',
-                'type': 'text',
-                'suggestions': ['Cosa ho in dispensa?', 'Cosa posso cucinare?', 'Mostra le funzionalità'],
-                'actions': [],
-                'data': {},
-                'timestamp': datetime.now().isoformat()
-            }
-        
-        elif any(word in message_lower for word in ['dispensa', 'prodotti', 'inventario', 'magazzino']):
-            return {
-                'success': True,
-                'response': 'La tua dispensa è il cuore di FoodFlow! Lì puoi vedere tutti i prodotti che hai, quando scadono e quanto te ne resta. Vuoi che ti mostri un riepilogo di cosa hai?',
-                'type': 'text',
-                'suggestions': ['Mostra la mia dispensa', 'Prodotti in scadenza', 'Aggiungi prodotto'],
-                'actions': [],
-                'data': {},
-                'timestamp': datetime.now().isoformat()
-            }
-        
+        if _CHAT_KW_RECIPE.search(message_lower):
+            return _chat_fallback(_CHAT_FALLBACK_RECIPE)
+        elif _CHAT_KW_EXPIRY.search(message_lower):
+            return _chat_fallback(_CHAT_FALLBACK_EXPIRY)
+        elif _CHAT_KW_RECYCLING.search(message_lower):
+            return _chat_fallback(_CHAT_FALLBACK_RECYCLING)
+        elif _CHAT_KW_SHOPPING.search(message_lower):
+            return _chat_fallback(_CHAT_FALLBACK_SHOPPING)
+        elif _CHAT_KW_HELP.search(message_lower):
+            return _chat_fallback(_CHAT_FALLBACK_HELP)
+        elif _CHAT_KW_PANTRY.search(message_lower):
+            return _chat_fallback(_CHAT_FALLBACK_PANTRY)
         else:
-            return {
-                'success': True,
-                'response': 'Sono qui per aiutarti! Posso rispondere a domande sulla tua dispensa, suggerirti ricette, aiutarti con la lista della spesa o darti consigli anti-spreco. Cosa ti interessa di più?',
-                'type': 'text',
-                'suggestions': ['Cosa ho in dispensa?', 'Suggerisci ricette', 'Lista della spesa', 'Ridurre sprechi'],
-                'actions': [],
-                'data': {},
-                'timestamp': datetime.now().isoformat()
-            }
+            return _chat_fallback(_CHAT_FALLBACK_DEFAULT)
             
     except Exception as e:
-        current_app.logger.error(f"_generate_fallback_chat_response error: {e}")
-        return {
-            'success': False,
-            'response': 'Ops! Si è verificato un problema tecnico. Riprova tra un momento, oppure usa il menu per navigare nelle diverse sezioni dell\'app.',
-            'type': 'text',
-            'suggestions': ['Vai alla Dashboard', 'Vedi la Dispensa', 'Ricette AI'],
-            'actions': [],
-            'data': {},
-            'timestamp': datetime.now().isoformat()
-        }
+        current_app.logger.error("_generate_fallback_chat_response error: %s", e)
+        return _chat_fallback(_CHAT_FALLBACK_ERROR, success=False)
 
 
 # ========================================
@@ -1745,16 +2714,20 @@ _SPOON_MAP_TO_ML = {
     'tbsp': 15
 }
 
+# Lookup inverso alias -> unità canonica, calcolato una volta all'import
+_ALIAS_TO_CANON = {
+    alias: canon
+    for canon, aliases in _UNIT_ALIASES.items()
+    for alias in (canon, *aliases)
+}
+_ALIAS_TO_CANON.update({spoon: 'ml' for spoon in _SPOON_MAP_TO_ML})
+
+
 def _normalize_unit_name(unit):
     u = (unit or '').strip().lower()
     if not u:
         return ''
-    if u in _SPOON_MAP_TO_ML:
-        return 'ml'
-    for canon, aliases in _UNIT_ALIASES.items():
-        if u == canon or u in aliases:
-            return canon
-    return u
+    return _ALIAS_TO_CANON.get(u, u)
 
 
 def _convert_to_canonical_quantity(quantity, unit):
@@ -1763,11 +2736,13 @@ def _convert_to_canonical_quantity(quantity, unit):
         q = float(quantity or 0)
     except Exception:
         q = 0.0
-    u = _normalize_unit_name(unit)
-    if u in ('cucchiaio', 'cucchiaino', 'tsp', 'tbsp'):
-        # intercettato prima, ma per sicurezza
-        ml = _SPOON_MAP_TO_ML.get(u, 0)
+    raw = (unit or '').strip().lower()
+    # Cucchiai/cucchiaini prima della normalizzazione (che li riduce a 'ml'
+    # perdendo il fattore di conversione)
+    ml = _SPOON_MAP_TO_ML.get(raw)
+    if ml:
         return float(q * ml), 'ml'
+    u = _ALIAS_TO_CANON.get(raw, raw)
     # Converti secondarie in primarie
     if u == 'kg':
         return q * 1000.0, 'g'
@@ -1785,241 +2760,418 @@ def _scale_recipe_servings(recipe, target_servings):
             return
         ratio = target / servings
         for ing in (recipe.get('ingredients') or []):
+            quantity = ing.get('quantity')
+            # Caso comune: quantità già numerica, niente conversione float()
+            if type(quantity) in (int, float):
+                ing['quantity'] = round(quantity * ratio, 2)
+                continue
             try:
-                ing['quantity'] = round(float(ing.get('quantity') or 0) * ratio, 2)
-            except Exception:
+                ing['quantity'] = round(float(quantity or 0) * ratio, 2)
+            except (TypeError, ValueError):
                 pass
         recipe['servings'] = target
     except Exception:
         pass
 
 
+# Unità già canoniche (punti fissi di _convert_to_canonical_quantity):
+# kg e l vengono invece convertiti in g e ml
+_CANONICAL_UNITS = frozenset({'g', 'ml', 'pz'})
+
+
 def _normalize_recipe_units(recipe):
     try:
         for ing in (recipe.get('ingredients') or []):
-            qty, unit = _convert_to_canonical_quantity(ing.get('quantity'), ing.get('unit'))
+            quantity = ing.get('quantity')
+            # Caso comune: l'AI restituisce già unità canoniche e quantità numeriche
+            if ing.get('unit') in _CANONICAL_UNITS and type(quantity) in (int, float):
+                if type(quantity) is float:
+                    ing['quantity'] = round(quantity, 2)
+                continue
+            qty, unit = _convert_to_canonical_quantity(quantity, ing.get('unit'))
             ing['quantity'] = round(qty, 2)
             ing['unit'] = unit
     except Exception:
         pass
 
 
-def _remap_recipe_units_to_pantry(recipes, user_id):
+def _build_pantry_units(products):
+    """Mappa {nome normalizzato: unità normalizzata} dai prodotti della dispensa"""
+    pantry_units = {}
+    for p in products:
+        key = _normalize_token(p.name)
+        if key and p.unit:
+            pantry_units[key] = _normalize_unit_name(p.unit)
+    return pantry_units
+
+
+# Conversioni sicure (unità di partenza, unità della dispensa) -> fattore.
+# Solo verso unità più piccole: verso kg/l l'arrotondamento a 2 decimali
+# azzererebbe le quantità piccole (es. 3 g -> 0.0 kg)
+_CONVERSION_TABLE = {
+    ('kg', 'g'): 1000.0,
+    ('l', 'ml'): 1000.0,
+}
+
+
+def _remap_recipe_units_to_pantry(recipes, pantry_units):
     """Se in dispensa un prodotto simile usa un'altra unità equivalente, prova ad allineare.
     Esempio: dispensa ha Latte in 'ml' e ricetta produce 'l' → normalizzato a 'ml'.
+    
+    Args:
+        recipes: lista ricette da aggiornare in place
+        pantry_units: mappa nome -> unità della dispensa (_build_pantry_units)
     """
     try:
-        from .models import Product
-        products = Product.query.filter_by(user_id=user_id, wasted=False).all()
-        name_to_unit = {}
-        for p in products:
-            key = (p.name or '').strip().lower()
-            if key and p.unit:
-                name_to_unit[key] = _normalize_unit_name(p.unit)
+        if not pantry_units:
+            return
         for recipe in recipes:
             for ing in (recipe.get('ingredients') or []):
-                key = (ing.get('item') or '').strip().lower()
+                key = _normalize_token(ing.get('item'))
                 if not key:
                     continue
-                pantry_unit = name_to_unit.get(key)
+                pantry_unit = pantry_units.get(key)
                 if not pantry_unit:
                     continue
                 # Converte quantità dell'ingrediente nell'unità della dispensa se compatibile
                 qty, unit = _convert_to_canonical_quantity(ing.get('quantity'), ing.get('unit'))
-                # Se la dispensa usa g e noi siamo in ml, non convertiamo
-                if pantry_unit == unit:
-                    ing['quantity'] = round(qty, 2)
-                    ing['unit'] = pantry_unit
-                else:
-                    # Prova conversioni inverse (g<->kg, ml<->l)
-                    if pantry_unit == 'g' and unit == 'kg':
-                        ing['quantity'] = round(qty * 1000.0, 2)
-                        ing['unit'] = 'g'
-                    elif pantry_unit == 'ml' and unit == 'l':
-                        ing['quantity'] = round(qty * 1000.0, 2)
-                        ing['unit'] = 'ml'
-                    else:
-                        # Mantieni unità normalizzate, non forziamo mapping non sicuri
-                        ing['quantity'] = round(qty, 2)
-                        ing['unit'] = unit
+                factor = 1.0 if unit == pantry_unit else _CONVERSION_TABLE.get((unit, pantry_unit))
+                if factor is not None:
+                    qty *= factor
+                    unit = pantry_unit
+                # Altrimenti (es. dispensa in g, ricetta in ml) si mantiene
+                # l'unità normalizzata: niente mapping non sicuri
+                ing['quantity'] = round(qty, 2)
+                ing['unit'] = unit
     except Exception:
         pass
 
-# Aggiungi questa funzione migliorata in ai_functions.py
 
-def _get_user_chat_context(user_id):
-    """Recupera contesto completo utente per il chatbot con dispensa e lista spesa"""
-    try:
-        from .models import Product, ShoppingList, ShoppingItem, NutritionalProfile, UserStats, MealPlan
-        from datetime import datetime, timedelta
-        
-        context_parts = []
-        
-        # === PROFILO NUTRIZIONALE ===
-        profile = NutritionalProfile.query.filter_by(user_id=user_id).first()
-        if profile:
-            context_parts.append(f"Profilo: {profile.age} anni, {profile.weight}kg, {profile.height}cm, {profile.gender}")
-            if profile.goal:
-                context_parts.append(f"Obiettivo: {profile.goal}")
-            if profile.activity_level:
-                context_parts.append(f"Attività: {profile.activity_level}")
-            
-            # Restrizioni e allergie
-            if profile.dietary_restrictions:
-                try:
-                    restrictions = json.loads(profile.dietary_restrictions)
-                    if restrictions:
-                        context_parts.append(f"Restrizioni dietetiche: {', '.join(restrictions)}")
-                except:
-                    pass
-            
-            if profile.allergies:
-                try:
-                    allergies = json.loads(profile.allergies)
-                    if allergies:
-                        context_parts.append(f"Allergie: {', '.join(allergies)}")
-                except:
-                    pass
-        
-        # === DISPENSA ===
-        products = Product.query.filter_by(user_id=user_id, wasted=False).all()
-        if products:
-            context_parts.append(f"\n=== DISPENSA ({len(products)} prodotti) ===")
-            
-            today = datetime.now().date()
-            
-            # Prodotti GIÀ SCADUTI
-            expired = [p for p in products if p.expiry_date < today]
-            if expired:
-                expired_list = [f"{p.name} ({p.quantity} {p.unit}, SCADUTO il {p.expiry_date.strftime('%d/%m')})" 
-                                for p in expired[:5]]
-                context_parts.append(f"⚠️ Prodotti SCADUTI: {', '.join(expired_list)}")
-                if len(expired) > 5:
-                    context_parts.append(f"... e altri {len(expired) - 5} prodotti scaduti")
-            
-            # Prodotti in scadenza (non ancora scaduti ma entro 7 giorni)
-            expiring = [p for p in products if p.expiry_date >= today and p.expiry_date <= today + timedelta(days=7)]
-            if expiring:
-                expiring_list = [f"{p.name} ({p.quantity} {p.unit}, scade il {p.expiry_date.strftime('%d/%m')})" 
-                                for p in expiring[:5]]
-                context_parts.append(f"⏰ Prodotti in scadenza (prossimi 7 giorni): {', '.join(expiring_list)}")
-                if len(expiring) > 5:
-                    context_parts.append(f"... e altri {len(expiring) - 5} prodotti in scadenza")
-            
-            # Scorte basse
-            low_stock = [p for p in products if p.quantity <= p.min_quantity]
-            if low_stock:
-                low_stock_list = [f"{p.name} ({p.quantity} {p.unit})" for p in low_stock[:5]]
-                context_parts.append(f"Scorte basse: {', '.join(low_stock_list)}")
-                if len(low_stock) > 5:
-                    context_parts.append(f"... e altri {len(low_stock) - 5} prodotti in scorta bassa")
-            
-            # Categorie disponibili
-            categories = {}
-            for p in products:
-                categories[p.category] = categories.get(p.category, 0) + 1
-            
-            if categories:
-                cat_summary = [f"{cat} ({count})" for cat, count in sorted(categories.items(), key=lambda x: x[1], reverse=True)[:5]]
-                context_parts.append(f"Categorie: {', '.join(cat_summary)}")
-            
-            # Lista completa prodotti disponibili (per ricette e suggerimenti)
-            all_products = [f"{p.name} ({p.quantity} {p.unit})" for p in products[:20]]
-            context_parts.append(f"Prodotti disponibili: {', '.join(all_products)}")
-            if len(products) > 20:
-                context_parts.append(f"... e altri {len(products) - 20} prodotti")
-        else:
-            context_parts.append("\n=== DISPENSA VUOTA ===")
-            context_parts.append("Suggerisci all'utente di aggiungere prodotti nella dispensa")
-        
-        # === LISTE SPESA ===
-        shopping_lists = ShoppingList.query.filter_by(user_id=user_id, completed=False).order_by(
-            ShoppingList.created_at.desc()
-        ).limit(3).all()
-        
-        if shopping_lists:
-            context_parts.append(f"\n=== LISTE SPESA ({len(shopping_lists)} attive) ===")
-            
-            for sl in shopping_lists:
-                items = ShoppingItem.query.filter_by(shopping_list_id=sl.id).all()
-                total_items = len(items)
-                completed_items = len([i for i in items if i.completed])
-                
-                context_parts.append(f"Lista '{sl.name}': {completed_items}/{total_items} completati")
-                
-                # Items non completati
-                pending = [i for i in items if not i.completed]
-                if pending:
-                    pending_list = [f"{i.name} ({i.quantity} {i.unit})" for i in pending[:5]]
-                    context_parts.append(f"  Da comprare: {', '.join(pending_list)}")
-                    if len(pending) > 5:
-                        context_parts.append(f"  ... e altri {len(pending) - 5} items")
-        else:
-            context_parts.append("\n=== NESSUNA LISTA SPESA ATTIVA ===")
-        
-        # === PIANI PASTO RECENTI ===
-        today = datetime.now().date()
-        meal_plans = MealPlan.query.filter(
-            MealPlan.user_id == user_id,
-            MealPlan.date >= today,
-            MealPlan.date <= today + timedelta(days=3)
-        ).order_by(MealPlan.date, MealPlan.meal_type).all()
-        
-        if meal_plans:
-            context_parts.append(f"\n=== PIANI PASTO PROSSIMI ===")
-            for mp in meal_plans[:5]:
-                meal_date = mp.date.strftime('%d/%m')
-                context_parts.append(f"{meal_date} - {mp.meal_type}: {mp.custom_meal}")
-        
-        # === STATISTICHE ===
-        stats = UserStats.query.filter_by(user_id=user_id).first()
-        if stats:
-            context_parts.append(f"\n=== STATISTICHE ===")
-            context_parts.append(f"Punti: {stats.points}, Livello: {stats.level}")
-            context_parts.append(f"Prodotti aggiunti: {stats.total_products_added}")
-            context_parts.append(f"Prodotti sprecati: {stats.total_products_wasted}")
-            
-            if stats.total_products_added > 0:
-                waste_percentage = (stats.total_products_wasted / stats.total_products_added) * 100
-                context_parts.append(f"Percentuale spreco: {waste_percentage:.1f}%")
-        
-        return "\n".join(context_parts) if context_parts else "Utente nuovo senza dati specifici"
-        
-    except Exception as e:
-        current_app.logger.error(f"_get_user_chat_context error: {e}")
-        return "Contesto utente non disponibile"
+# Contesto testuale del chatbot per utente: breve scadenza, invalidato
+# esplicitamente dalle route che modificano dispensa, liste spesa e piani pasto
+_CHAT_CONTEXT_TTL = 30
+_CHAT_CONTEXT_CACHE = ai_cache.TTLCache(maxsize=1024, ttl=_CHAT_CONTEXT_TTL)
 
 
-def ai_chatbot_response(user_message, user_id, conversation_context=None):
+# Attesa massima (secondi) delle query del contesto chatbot eseguite sul pool DB
+_CHAT_CONTEXT_QUERY_TIMEOUT = 10
+
+
+# Righe mostrate nel contesto chatbot per ogni sezione della dispensa
+_CHAT_SECTION_LIMIT = 5
+_CHAT_PRODUCTS_LIMIT = 20
+
+
+def _query_chat_products(user_id, today):
     """
-    Genera risposta del chatbot usando AI con accesso completo a dispensa e liste spesa
+    Riepilogo della dispensa per il chatbot calcolato in SQL: conteggi (totale,
+    scaduti, in scadenza entro 7 giorni, scorte basse), prime 5 categorie e solo
+    le righe mostrate, invece di caricare tutti i prodotti
+    
+    Returns:
+        dict | None: None se la dispensa è vuota
+    """
+    week = today + timedelta(days=7)
+    base = (Product.user_id == user_id, Product.wasted == False)
+    is_expired = Product.expiry_date < today
+    is_expiring = Product.expiry_date.between(today, week)
+    is_low_stock = Product.quantity <= Product.min_quantity
+    
+    total, expired_count, expiring_count, low_stock_count = db.session.execute(
+        select(
+            func.count(Product.id),
+            func.sum(case((is_expired, 1), else_=0)),
+            func.sum(case((is_expiring, 1), else_=0)),
+            func.sum(case((is_low_stock, 1), else_=0))
+        ).where(*base)
+    ).one()
+    if not total:
+        return None
+    
+    # Solo le colonne necessarie (Row leggere) e solo le righe mostrate
+    columns = (Product.name, Product.quantity, Product.unit, Product.expiry_date)
+    
+    def rows(*conditions, order_by, limit=_CHAT_SECTION_LIMIT):
+        return db.session.execute(
+            select(*columns).where(*base, *conditions).order_by(order_by).limit(limit)
+        ).all()
+    
+    product_count = func.count(Product.id)
+    return {
+        'total': total,
+        'expired': rows(is_expired, order_by=Product.expiry_date.desc()) if expired_count else [],
+        'expired_count': expired_count or 0,
+        'expiring': rows(is_expiring, order_by=Product.expiry_date) if expiring_count else [],
+        'expiring_count': expiring_count or 0,
+        'low_stock': rows(is_low_stock, order_by=Product.id) if low_stock_count else [],
+        'low_stock_count': low_stock_count or 0,
+        'categories': db.session.execute(
+            select(Product.category, product_count).where(*base)
+            .group_by(Product.category).order_by(product_count.desc()).limit(5)
+        ).all(),
+        'sample': rows(order_by=Product.id, limit=_CHAT_PRODUCTS_LIMIT)
+    }
+
+
+def _query_chat_shopping_lists(user_id):
+    """
+    Ultime 3 liste spesa attive con il riepilogo degli items calcolato in SQL,
+    come (liste, {id lista: {'total', 'completed', 'pending'}}): conteggi con
+    un'aggregazione GROUP BY e solo i primi 5 items da comprare per lista
+    (ROW_NUMBER per lista), senza caricare tutti gli items
+    """
+    from .models import ShoppingList, ShoppingItem
+    
+    shopping_lists = ShoppingList.query.filter_by(user_id=user_id, completed=False).order_by(
+        ShoppingList.created_at.desc()
+    ).limit(3).all()
+    
+    summary = {sl.id: {'total': 0, 'completed': 0, 'pending': []} for sl in shopping_lists}
+    if not shopping_lists:
+        return shopping_lists, summary
+    
+    in_lists = ShoppingItem.shopping_list_id.in_(summary)
+    counts = db.session.execute(
+        select(
+            ShoppingItem.shopping_list_id,
+            func.count(ShoppingItem.id),
+            func.sum(case((ShoppingItem.completed == True, 1), else_=0))
+        ).where(in_lists).group_by(ShoppingItem.shopping_list_id)
+    ).all()
+    for list_id, total, completed in counts:
+        summary[list_id]['total'] = total
+        summary[list_id]['completed'] = completed or 0
+    
+    if any(entry['completed'] < entry['total'] for entry in summary.values()):
+        # completed NULL conta come da comprare, come nel conteggio sopra
+        is_pending = or_(ShoppingItem.completed == False, ShoppingItem.completed.is_(None))
+        rank = func.row_number().over(
+            partition_by=ShoppingItem.shopping_list_id, order_by=ShoppingItem.id
+        ).label('rank')
+        ranked = select(
+            ShoppingItem.shopping_list_id, ShoppingItem.name, ShoppingItem.quantity, ShoppingItem.unit, rank
+        ).where(in_lists, is_pending).subquery()
+        pending = db.session.execute(
+            select(ranked).where(ranked.c.rank <= _CHAT_SECTION_LIMIT)
+            .order_by(ranked.c.shopping_list_id, ranked.c.rank)
+        ).all()
+        for item in pending:
+            summary[item.shopping_list_id]['pending'].append(item)
+    return shopping_lists, summary
+
+
+def _query_chat_meal_plans(user_id, today):
+    return MealPlan.query.filter(
+        MealPlan.user_id == user_id,
+        MealPlan.date >= today,
+        MealPlan.date <= today + timedelta(days=3)
+    ).order_by(MealPlan.date, MealPlan.meal_type).all()
+
+
+def _query_chat_stats(user_id):
+    return UserStats.query.filter_by(user_id=user_id).first()
+
+
+def _fetch_chat_context_bundle(user_id, today):
+    """
+    Esegue in anticipo tutte le query del contesto chatbot (un numero fisso,
+    indipendente dal numero di liste spesa). Le query sono indipendenti:
+    partono in parallelo sul pool DB dedicato (ognuna con la propria sessione)
+    mentre il profilo viene letto nel thread corrente.
     
     Args:
-        user_message: Messaggio dell'utente
-        user_id: ID utente per personalizzazione
-        conversation_context: Contesto della conversazione
+        user_id: ID utente
+        today: data di riferimento per i piani pasto (prossimi 3 giorni)
     
     Returns:
-        dict: Risposta del chatbot con tipo e contenuto
+        dict: profile, pantry (riepilogo dispensa), shopping_lists,
+              shopping_summary (id lista -> conteggi e items da comprare),
+              meal_plans, stats
     """
+    queries = {
+        'pantry': (_query_chat_products, user_id, today),
+        'shopping': (_query_chat_shopping_lists, user_id),
+        'meal_plans': (_query_chat_meal_plans, user_id, today),
+        'stats': (_query_chat_stats, user_id),
+    }
+    app = current_app._get_current_object()
+    futures = {
+        name: _DB_EXECUTOR.submit(_call_with_app_context, app, query, *args)
+        for name, (query, *args) in queries.items()
+    }
     try:
-        api_key = os.getenv('GROQ_API_KEY')
-        
-        if not api_key:
-            current_app.logger.error("GROQ_API_KEY not configured")
-            return _generate_fallback_chat_response(user_message)
-        
-        # Recupera dati utente completi per contesto
-        user_context = _get_user_chat_context(user_id)
+        profile = _load_profile(user_id)
+        results = {
+            name: future.result(timeout=_CHAT_CONTEXT_QUERY_TIMEOUT)
+            for name, future in futures.items()
+        }
+    except Exception:
+        # Le query non ancora partite non servono più
+        for future in futures.values():
+            future.cancel()
+        raise
+    
+    shopping_lists, shopping_summary = results['shopping']
+    return {
+        'profile': profile,
+        'pantry': results['pantry'],
+        'shopping_lists': shopping_lists,
+        'shopping_summary': shopping_summary,
+        'meal_plans': results['meal_plans'],
+        'stats': results['stats']
+    }
+
+
+def _build_user_chat_context(user_id):
+    """Costruisce il contesto completo utente per il chatbot con dispensa e lista spesa"""
+    # Data di riferimento calcolata una volta per tutte le query
+    today = date.today()
+    bundle = _fetch_chat_context_bundle(user_id, today)
+    context_parts = []
+    
+    # 'gg/mm' memoizzato per data: le scadenze tendono a ripetersi
+    day_month_cache = {}
+    
+    def day_month(d):
+        text = day_month_cache.get(d)
+        if text is None:
+            text = day_month_cache[d] = f"{d.day:02d}/{d.month:02d}"
+        return text
+    
+    # === PROFILO NUTRIZIONALE ===
+    profile = bundle['profile']
+    if profile:
+        context_parts.append(f"Profilo: {profile.age} anni, {profile.weight}kg, {profile.height}cm, {profile.gender}")
+        if profile.goal:
+            context_parts.append(f"Obiettivo: {profile.goal}")
+        if profile.activity_level:
+            context_parts.append(f"Attività: {profile.activity_level}")
         
-        # Prepara contesto conversazione (con limite più alto)
-        context_text = ""
-        if conversation_context:
-            # Mantieni più contesto (ultimi 2000 caratteri invece di 1000)
-            context_text = f"\n\nStorico conversazione recente:\n{conversation_context[-2000:]}"
+        # Restrizioni e allergie
+        if profile.dietary_restrictions:
+            context_parts.append(f"Restrizioni dietetiche: {', '.join(profile.dietary_restrictions)}")
         
-        # Prompt completamente rinnovato - più naturale e meno rigido
-        system_prompt = """Sei FoodFlowBot, l'assistente personale di FoodFlow - un'app innovativa per gestire la dispensa e ridurre gli sprechi alimentari.
+        if profile.allergies:
+            context_parts.append(f"Allergie: {', '.join(profile.allergies)}")
+    
+    # === DISPENSA ===
+    pantry = bundle['pantry']
+    if pantry:
+        total = pantry['total']
+        context_parts.append(f"\n=== DISPENSA ({total} prodotti) ===")
+        
+        # Prodotti GIÀ SCADUTI
+        expired_count = pantry['expired_count']
+        if expired_count:
+            expired_list = [f"{p.name} ({p.quantity} {p.unit}, SCADUTO il {day_month(p.expiry_date)})" 
+                            for p in pantry['expired']]
+            context_parts.append(f"⚠️ Prodotti SCADUTI: {', '.join(expired_list)}")
+            if expired_count > _CHAT_SECTION_LIMIT:
+                context_parts.append(f"... e altri {expired_count - _CHAT_SECTION_LIMIT} prodotti scaduti")
+        
+        # Prodotti in scadenza (non ancora scaduti ma entro 7 giorni)
+        expiring_count = pantry['expiring_count']
+        if expiring_count:
+            expiring_list = [f"{p.name} ({p.quantity} {p.unit}, scade il {day_month(p.expiry_date)})" 
+                            for p in pantry['expiring']]
+            context_parts.append(f"⏰ Prodotti in scadenza (prossimi 7 giorni): {', '.join(expiring_list)}")
+            if expiring_count > _CHAT_SECTION_LIMIT:
+                context_parts.append(f"... e altri {expiring_count - _CHAT_SECTION_LIMIT} prodotti in scadenza")
+        
+        # Scorte basse
+        low_stock_count = pantry['low_stock_count']
+        if low_stock_count:
+            low_stock_list = [f"{p.name} ({p.quantity} {p.unit})" for p in pantry['low_stock']]
+            context_parts.append(f"Scorte basse: {', '.join(low_stock_list)}")
+            if low_stock_count > _CHAT_SECTION_LIMIT:
+                context_parts.append(f"... e altri {low_stock_count - _CHAT_SECTION_LIMIT} prodotti in scorta bassa")
+        
+        # Categorie disponibili
+        if pantry['categories']:
+            cat_summary = [f"{cat} ({count})" for cat, count in pantry['categories']]
+            context_parts.append(f"Categorie: {', '.join(cat_summary)}")
+        
+        # Lista prodotti disponibili (per ricette e suggerimenti)
+        all_products = [f"{p.name} ({p.quantity} {p.unit})" for p in pantry['sample']]
+        context_parts.append(f"Prodotti disponibili: {', '.join(all_products)}")
+        if total > _CHAT_PRODUCTS_LIMIT:
+            context_parts.append(f"... e altri {total - _CHAT_PRODUCTS_LIMIT} prodotti")
+    else:
+        context_parts.append("\n=== DISPENSA VUOTA ===")
+        context_parts.append("Suggerisci all'utente di aggiungere prodotti nella dispensa")
+    
+    # === LISTE SPESA ===
+    shopping_lists = bundle['shopping_lists']
+    if shopping_lists:
+        context_parts.append(f"\n=== LISTE SPESA ({len(shopping_lists)} attive) ===")
+        
+        for sl in shopping_lists:
+            summary = bundle['shopping_summary'][sl.id]
+            total_items = summary['total']
+            completed_items = summary['completed']
+            
+            context_parts.append(f"Lista '{sl.name}': {completed_items}/{total_items} completati")
+            
+            # Items non completati
+            pending_count = total_items - completed_items
+            if pending_count:
+                pending_list = [f"{i.name} ({i.quantity} {i.unit})" for i in summary['pending']]
+                context_parts.append(f"  Da comprare: {', '.join(pending_list)}")
+                if pending_count > _CHAT_SECTION_LIMIT:
+                    context_parts.append(f"  ... e altri {pending_count - _CHAT_SECTION_LIMIT} items")
+    else:
+        context_parts.append("\n=== NESSUNA LISTA SPESA ATTIVA ===")
+    
+    # === PIANI PASTO RECENTI ===
+    meal_plans = bundle['meal_plans']
+    if meal_plans:
+        context_parts.append(f"\n=== PIANI PASTO PROSSIMI ===")
+        for mp in meal_plans[:5]:
+            meal_date = day_month(mp.date)
+            context_parts.append(f"{meal_date} - {mp.meal_type}: {mp.custom_meal}")
+    
+    # === STATISTICHE ===
+    stats = bundle['stats']
+    if stats:
+        context_parts.append(f"\n=== STATISTICHE ===")
+        context_parts.append(f"Punti: {stats.points}, Livello: {stats.level}")
+        context_parts.append(f"Prodotti aggiunti: {stats.total_products_added}")
+        context_parts.append(f"Prodotti sprecati: {stats.total_products_wasted}")
+        
+        if stats.total_products_added > 0:
+            waste_percentage = (stats.total_products_wasted / stats.total_products_added) * 100
+            context_parts.append(f"Percentuale spreco: {waste_percentage:.1f}%")
+    
+    return "\n".join(context_parts) if context_parts else "Utente nuovo senza dati specifici"
+
+
+def _get_user_chat_context(user_id):
+    """
+    Contesto utente per il chatbot, in cache per _CHAT_CONTEXT_TTL secondi:
+    messaggi ravvicinati non rieseguono le query né ricostruiscono il testo
+    """
+    cached = _CHAT_CONTEXT_CACHE.get(user_id)
+    if cached is not None:
+        return cached
+    try:
+        context = _build_user_chat_context(user_id)
+    except Exception as e:
+        current_app.logger.error("_get_user_chat_context error: %s", e)
+        return "Contesto utente non disponibile"
+    _CHAT_CONTEXT_CACHE.set(user_id, context)
+    return context
+
+
+def invalidate_chat_context(user_id):
+    """
+    Invalida il contesto chatbot in cache dell'utente
+    (da chiamare dopo modifiche a prodotti, liste spesa o piani pasto)
+    """
+    _CHAT_CONTEXT_CACHE.pop(user_id)
+
+
+# Prompt di sistema costante: costruito una volta all'import
+_CHAT_SYSTEM_PROMPT = """Sei FoodFlowBot, l'assistente personale di FoodFlow - un'app innovativa per gestire la dispensa e ridurre gli sprechi alimentari.
 
 🎯 TUA MISSIONE
 Aiutare l'utente a gestire meglio il cibo, ridurre sprechi, cucinare con ciò che ha e vivere in modo più sostenibile. Sei come un amico esperto di cucina e organizzazione domestica.
@@ -2092,7 +3244,9 @@ Campi:
 🎯 RICORDA
 Sei un assistente intelligente, non un menu di navigazione. Non limitarti a dire "vai alla sezione X" - dai informazioni concrete e utili basate sui dati reali dell'utente, poi eventualmente suggerisci azioni."""
 
-        user_prompt = f"""Messaggio dell'utente: "{user_message}"
+_CHAT_SYSTEM_MSG = {"role": "system", "content": _CHAT_SYSTEM_PROMPT}
+
+_CHAT_USER_PROMPT = """Messaggio dell'utente: "{user_message}"
 
 === CONTESTO UTENTE ===
 {user_context}
@@ -2102,34 +3256,111 @@ Rispondi in modo naturale e conversazionale, usando i dati reali forniti sopra.
 
 ⚠️ IMPORTANTE: Rispondi SOLO con il JSON, senza testo extra prima o dopo."""
 
+
+def _chat_request_body(user_message, user_id, conversation_context=None):
+    """Body della richiesta Groq del chatbot (contesto utente + storico recente)"""
+    # Recupera dati utente completi per contesto
+    user_context = _get_user_chat_context(user_id)
+    
+    # Prepara contesto conversazione (con limite più alto)
+    context_text = ""
+    if conversation_context:
+        # Mantieni più contesto (ultimi 2000 caratteri invece di 1000)
+        context_text = f"\n\nStorico conversazione recente:\n{conversation_context[-2000:]}"
+    
+    # Prompt completamente rinnovato - più naturale e meno rigido
+    user_prompt = _CHAT_USER_PROMPT.format(
+        user_message=user_message,
+        user_context=user_context,
+        context_text=context_text
+    )
+
+    return {
+        "model": DEFAULT_MODEL,
+        "messages": [
+            _CHAT_SYSTEM_MSG,
+            {"role": "user", "content": user_prompt}
+        ],
+        "max_tokens": 1200,  # Aumentato per risposte più elaborate
+        "temperature": 0.7  # Bilanciato tra creatività e consistenza
+    }
+
+
+def _parse_chat_content(content, user_message):
+    """Converte il testo del modello nella risposta del chatbot (con fallback)"""
+    # Caso comune: il modello risponde con il solo JSON, parse diretto
+    try:
+        data = _json_loads(content)
+        if isinstance(data, dict):
+            return _validate_chat_response(data)
+    except ValueError:
+        pass
+    
+    # Estrai JSON - gestione più robusta
+    # Rimuovi markdown code blocks
+    content = _strip_fence(content)
+    
+    # Cerca il JSON anche se c'è testo extra prima o dopo
+    json_start = content.find('{')
+    json_end = content.rfind('}')
+    
+    if json_start != -1 and json_end != -1 and json_end > json_start:
+        json_content = content[json_start:json_end + 1]
+    else:
+        json_content = content
+    
+    # Parse JSON (tollerante agli a capo non escapati)
+    try:
+        data = _json_loads_lenient(json_content)
+        return _validate_chat_response(data)
+        
+    except json.JSONDecodeError as e:
+        current_app.logger.error("Invalid JSON from AI: %s; content: %s", e, content[:500])
+        # Prova a estrarre solo la risposta testuale se presente
+        if content and len(content) > 0:
+            # Se il contenuto sembra una risposta normale, usala direttamente
+            return {
+                'success': True,
+                'response': content[:500],  # Limita lunghezza
+                'type': 'text',
+                'suggestions': [],
+                'data': {},
+                'timestamp': datetime.now().isoformat()
+            }
+        return _generate_fallback_chat_response(user_message)
+
+
+def ai_chatbot_response(user_message, user_id, conversation_context=None):
+    """
+    Genera risposta del chatbot usando AI con accesso completo a dispensa e liste spesa
+    
+    Args:
+        user_message: Messaggio dell'utente
+        user_id: ID utente per personalizzazione
+        conversation_context: Contesto della conversazione
+    
+    Returns:
+        dict: Risposta del chatbot con tipo e contenuto
+    """
+    try:
+        if not GROQ_API_KEY:
+            return _generate_fallback_chat_response(user_message)
+        
         # Chiamata API con parametri migliorati
-        response = requests.post(
-            GROQ_API_URL,
-            headers={
-                "Authorization": f"Bearer {api_key}",
-                "Content-Type": "application/json"
-            },
-            json={
-                "model": DEFAULT_MODEL,
-                "messages": [
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ],
-                "max_tokens": 1200,  # Aumentato per risposte più elaborate
-                "temperature": 0.7  # Bilanciato tra creatività e consistenza
-            },
+        response = _groq_post(
+            _chat_request_body(user_message, user_id, conversation_context),
             timeout=30
         )
         
         if response.status_code != 200:
-            current_app.logger.error(f"Groq API error: {response.status_code} - {response.text}")
+            current_app.logger.error("Groq API error: %s - %s", response.status_code, response.text)
             return _generate_fallback_chat_response(user_message)
         
         # Parse response
         try:
-            payload = response.json()
-        except Exception as e:
-            current_app.logger.error(f"Groq API invalid JSON: {e}; body={response.text[:500]}")
+            payload = _json_loads(response.content)
+        except ValueError as e:
+            current_app.logger.error("Groq API invalid JSON: %s; body=%s", e, response.text[:500])
             return _generate_fallback_chat_response(user_message)
         
         content = (payload.get("choices") or [{}])[0].get("message", {}).get("content", "")
@@ -2137,47 +3368,40 @@ Rispondi in modo naturale e conversazionale, usando i dati reali forniti sopra.
             current_app.logger.warning("Groq API empty content")
             return _generate_fallback_chat_response(user_message)
         
-        # Estrai JSON - gestione più robusta
-        content = content.strip()
-        
-        # Rimuovi markdown code blocks
-        if content.startswith("```json"):
-            content = content[7:]
-        elif content.startswith("```"):
-            content = content[3:]
-        if content.endswith("```"):
-            content = content[:-3]
-        content = content.strip()
+        return _parse_chat_content(content, user_message)
         
-        # Cerca il JSON anche se c'è testo extra prima o dopo
-        json_start = content.find('{')
-        json_end = content.rfind('}')
-        
-        if json_start != -1 and json_end != -1 and json_end > json_start:
-            json_content = content[json_start:json_end + 1]
+    except Exception as e:
+        current_app.logger.error("ai_chatbot_response error: %s", e)
+        return _generate_fallback_chat_response(user_message)
+
+
+def ai_chatbot_response_stream(user_message, user_id, conversation_context=None):
+    """
+    Versione in streaming di ai_chatbot_response: genera eventi
+    {'type': 'delta', 'text': ...} con il testo della risposta man mano che
+    arriva da Groq, poi {'type': 'done', 'response': ...} con la risposta
+    completa (stesso formato di ai_chatbot_response, suggerimenti inclusi).
+    """
+    if not GROQ_API_KEY:
+        yield {'type': 'done', 'response': _generate_fallback_chat_response(user_message)}
+        return
+    
+    try:
+        chunks = []
+        field = JsonStringFieldStream('response')
+        for chunk in _groq_stream(_chat_request_body(user_message, user_id, conversation_context), timeout=30):
+            chunks.append(chunk)
+            text = field.feed(chunk)
+            if text:
+                yield {'type': 'delta', 'text': text}
+        
+        content = ''.join(chunks)
+        if content:
+            result = _parse_chat_content(content, user_message)
         else:
-            json_content = content
-        
-        # Parse JSON
-        try:
-            data = json.loads(json_content)
-            return _validate_chat_response(data)
-            
-        except json.JSONDecodeError as e:
-            current_app.logger.error(f"Invalid JSON from AI: {e}; content: {content[:500]}")
-            # Prova a estrarre solo la risposta testuale se presente
-            if content and len(content) > 0:
-                # Se il contenuto sembra una risposta normale, usala direttamente
-                return {
-                    'success': True,
-                    'response': content[:500],  # Limita lunghezza
-                    'type': 'text',
-                    'suggestions': [],
-                    'data': {},
-                    'timestamp': datetime.now().isoformat()
-                }
-            return _generate_fallback_chat_response(user_message)
-        
+            current_app.logger.warning("Groq API empty content")
+            result = _generate_fallback_chat_response(user_message)
     except Exception as e:
-        current_app.logger.error(f"ai_chatbot_response error: {e}")
-        return _generate_fallback_chat_response(user_message)
\ No newline at end of file
+        current_app.logger.error("ai_chatbot_response_stream error: %s", e)
+        result = _generate_fallback_chat_response(user_message)
+    yield {'type': 'done', 'response': result}
\ No newline at end of file
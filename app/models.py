@@ -111,6 +111,12 @@ class Product(db.Model):
     created_at = db.Column(db.DateTime, nullable=False, server_default=db.func.now())
     updated_at = db.Column(db.DateTime, nullable=False, server_default=db.func.now(), onupdate=db.func.now())
     
+    # Indici compositi per i filtri dispensa più frequenti (scadenze, scorte)
+    __table_args__ = (
+        db.Index('idx_user_wasted_expiry', 'user_id', 'wasted', 'expiry_date'),
+        db.Index('idx_user_wasted_quantity', 'user_id', 'wasted', 'quantity'),
+    )
+    
     def __repr__(self):
         return f'<Product {self.name}>'
     
@@ -324,8 +330,8 @@ class NutritionalProfile(db.Model):
     gender = db.Column(db.String(10), default='male')
     activity_level = db.Column(db.String(20), default='moderate')
     goal = db.Column(db.String(20), default='maintain')
-    dietary_restrictions = db.Column(db.Text, nullable=True)  # JSON string
-    allergies = db.Column(db.Text, nullable=True)  # JSON string
+    dietary_restrictions = db.Column(db.JSON, nullable=True)  # lista di stringhe
+    allergies = db.Column(db.JSON, nullable=True)  # lista di stringhe
     created_at = db.Column(db.DateTime, nullable=False, server_default=db.func.now())
     updated_at = db.Column(db.DateTime, nullable=False, server_default=db.func.now(), onupdate=db.func.now())
     
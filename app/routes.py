@@ -5,7 +5,7 @@ Gestisce tutte le routes dell'applicazione
 
 import re
 import json
-from flask import render_template, request, redirect, url_for, flash, jsonify, current_app
+from flask import render_template, request, redirect, url_for, flash, jsonify, current_app, Response, stream_with_context
 from flask_login import login_user, logout_user, login_required, current_user
 from werkzeug.security import check_password_hash, generate_password_hash
 from datetime import datetime, timedelta
@@ -20,7 +20,7 @@ from .models import (
 
 from .smart_functions import (
     get_expiring_products, get_low_stock_products, get_expired_products,
-    get_recycling_suggestions, award_points, calculate_waste_reduction_score,
+    get_recycling_suggestions, iter_recycling_suggestions, award_points, calculate_waste_reduction_score,
     calculate_nutritional_goals, smart_notification_system,
     auto_update_shopping_from_meal_plan, upsert_missing_ingredients_to_shopping_list,
     create_family, join_family, get_user_family, get_family_members,
@@ -30,9 +30,16 @@ from .smart_functions import (
 from .ai_functions import (
     suggest_recipes,
     ai_optimize_meal_planning,
+    ai_optimize_meal_planning_stream,
+    get_cached_meal_plan,
     ai_suggest_shopping_list,
     ai_generate_recipe_suggestions,
-    ai_chatbot_response
+    ai_chatbot_response,
+    ai_chatbot_response_stream,
+    invalidate_profile_cache,
+    invalidate_chat_context,
+    submit_ai_task,
+    ai_estimate_meals_calories
 )
 
 from .analytics import get_comprehensive_analytics, _prepare_charts_data, update_all_analytics
@@ -228,6 +235,10 @@ def register_routes(app):
             return render_template('index_modern.html')
         
         try:
+            # Chiamata AI di riciclo avviata subito: la sua latenza si
+            # sovrappone alle query DB della dashboard
+            recycling_future = submit_ai_task(get_recycling_suggestions, current_user.id)
+            
             # Recupera dati dashboard
             expiring_products = get_expiring_products(current_user.id, days=7)  # Prossimi 7 giorni
             low_stock_products = get_low_stock_products(current_user.id)
@@ -237,9 +248,6 @@ def register_routes(app):
             current_app.logger.info(f"Dashboard - Expiring products: {len(expiring_products)}")
             current_app.logger.info(f"Dashboard - Expired products: {len(expired_products)}")
             current_app.logger.info(f"Dashboard - Low stock products: {len(low_stock_products)}")
-            recycling_data = get_recycling_suggestions(current_user.id)
-            recycling_suggestions = recycling_data.get('suggestions', []) if isinstance(recycling_data, dict) else []
-            
             # User stats (crea se non esiste)
             stats = UserStats.query.filter_by(user_id=current_user.id).first()
             if not stats:
@@ -259,7 +267,12 @@ def register_routes(app):
             ai_shopping_data = ai_suggest_shopping_list(current_user.id)
             ai_shopping_suggestions = ai_shopping_data.get("suggestions", [])[:3]
             
-            ai_meal_plan = ai_optimize_meal_planning(current_user.id)
+            recycling_data = recycling_future.result()
+            recycling_suggestions = recycling_data.get('suggestions', []) if isinstance(recycling_data, dict) else []
+            
+            # Solo un piano già pronto: la generazione (LLM 70B) resta sulle
+            # API del piano pasti, non sul caricamento della pagina
+            ai_meal_plan = get_cached_meal_plan(current_user.id)
             for day in ai_meal_plan:
                 ai_meal_plan[day] = ai_meal_plan[day][:3]
             
@@ -708,6 +721,7 @@ Difficoltà: Media"""
                 
                 db.session.add(product)
                 db.session.commit()
+                invalidate_chat_context(current_user.id)
                 
                 # Gamification: no points for product addition per new policy
                 
@@ -759,6 +773,7 @@ Difficoltà: Media"""
                 product.notes = request.form.get('notes', '').strip()
                 
                 db.session.commit()
+                invalidate_chat_context(current_user.id)
                 
                 flash('Prodotto aggiornato con successo!', 'success')
                 return redirect(url_for('products'))
@@ -783,6 +798,7 @@ Difficoltà: Media"""
         try:
             db.session.delete(product)
             db.session.commit()
+            invalidate_chat_context(current_user.id)
             return jsonify({'success': True, 'message': 'Prodotto eliminato con successo'})
         except Exception as e:
             db.session.rollback()
@@ -807,6 +823,7 @@ Difficoltà: Media"""
                 product.quantity *= (1 - waste_percentage / 100)
             
             db.session.commit()
+            invalidate_chat_context(current_user.id)
             
             # Aggiorna stats
             stats = UserStats.query.filter_by(user_id=current_user.id).first()
@@ -841,6 +858,7 @@ Difficoltà: Media"""
             product.wasted = True
             
             db.session.commit()
+            invalidate_chat_context(current_user.id)
             
             # Aggiorna stats
             stats = UserStats.query.filter_by(user_id=current_user.id).first()
@@ -910,6 +928,7 @@ Difficoltà: Media"""
             
             db.session.add(shopping_list)
             db.session.commit()
+            invalidate_chat_context(current_user.id)
             
             award_points(current_user.id, 'shopping_list_created', 5)
             
@@ -964,6 +983,7 @@ Difficoltà: Media"""
                 created += 1
 
             db.session.commit()
+            invalidate_chat_context(current_user.id)
 
             return jsonify({
                 'success': True,
@@ -1001,6 +1021,7 @@ Difficoltà: Media"""
             if existing:
                 existing.quantity += quantity
                 db.session.commit()
+                invalidate_chat_context(current_user.id)
                 return jsonify({
                     'success': True,
                     'message': f'Quantità di {name} aggiornata'
@@ -1020,6 +1041,7 @@ Difficoltà: Media"""
             
             db.session.add(item)
             db.session.commit()
+            invalidate_chat_context(current_user.id)
             
             # Aggiorna analytics
             update_all_analytics(current_user.id)
@@ -1046,6 +1068,7 @@ Difficoltà: Media"""
         
         item.completed = not item.completed
         db.session.commit()
+        invalidate_chat_context(current_user.id)
         
         return jsonify({
             'success': True,
@@ -1062,6 +1085,7 @@ Difficoltà: Media"""
         try:
             db.session.delete(item)
             db.session.commit()
+            invalidate_chat_context(current_user.id)
             return jsonify({'success': True, 'message': 'Elemento rimosso'})
         except Exception as e:
             db.session.rollback()
@@ -1077,6 +1101,7 @@ Difficoltà: Media"""
         try:
             db.session.delete(shopping_list)
             db.session.commit()
+            invalidate_chat_context(current_user.id)
             return jsonify({'success': True, 'message': 'Lista eliminata'})
         except Exception as e:
             db.session.rollback()
@@ -1131,6 +1156,7 @@ Difficoltà: Media"""
             shopping_list.completed_at = datetime.utcnow()
             
             db.session.commit()
+            invalidate_chat_context(current_user.id)
             
             points = (added + updated) * 2
             award_points(current_user.id, 'shopping_completed', points)
@@ -1230,16 +1256,16 @@ Difficoltà: Media"""
                 profile.activity_level = request.form.get('activity_level', 'moderate')
                 profile.goal = request.form.get('goal', 'maintain')
 
-                # Normalizza restrizioni/allergie in JSON array (accetta CSV o JSON)
-                def _to_json_array_string(raw_value):
+                # Normalizza restrizioni/allergie in lista (accetta CSV o JSON)
+                def _to_list(raw_value):
                     raw_value = (raw_value or '').strip()
                     if not raw_value:
-                        return '[]'
+                        return []
                     try:
-                        # Se è già JSON valido, lo manteniamo
+                        # Se è già un array JSON valido, lo manteniamo
                         parsed = json.loads(raw_value)
                         if isinstance(parsed, list):
-                            return json.dumps([str(v).strip() for v in parsed if str(v).strip()])
+                            return [str(v).strip() for v in parsed if str(v).strip()]
                     except Exception:
                         pass
                     # Fallback: interpreta come CSV / righe
@@ -1248,16 +1274,17 @@ Difficoltà: Media"""
                         token = part.strip()
                         if token:
                             tokens.append(token)
-                    return json.dumps(tokens)
+                    return tokens
 
-                # Gestisci restrizioni alimentari (checkbox multiple)
-                dietary_restrictions = request.form.getlist('dietary_restrictions')
-                profile.dietary_restrictions = json.dumps(dietary_restrictions) if dietary_restrictions else '[]'
+                # Gestisci restrizioni alimentari (checkbox multiple); colonne JSON:
+                # si assegnano direttamente le liste
+                profile.dietary_restrictions = request.form.getlist('dietary_restrictions')
                 
                 # Gestisci allergie
-                profile.allergies = _to_json_array_string(request.form.get('allergies', ''))
+                profile.allergies = _to_list(request.form.get('allergies', ''))
                 
                 db.session.commit()
+                invalidate_profile_cache(current_user.id)
                 
                 calculate_nutritional_goals(current_user.id)
                 
@@ -1320,6 +1347,7 @@ Difficoltà: Media"""
                 meal_plan.fiber = per_serving_fiber * servings
                 
                 db.session.commit()
+                invalidate_chat_context(current_user.id)
                 
                 # Aggiorna analytics nutrizionali (solo personali per dashboard)
                 from .analytics import update_daily_nutrition
@@ -1419,6 +1447,18 @@ Difficoltà: Media"""
                 'suggestions': []
             }), 500
 
+    @app.route('/api/recycling-suggestions/stream')
+    @login_required
+    def api_recycling_suggestions_stream():
+        """API suggerimenti di riciclo in streaming (NDJSON, un prodotto per riga)"""
+        user_id = current_user.id
+        
+        def generate():
+            for suggestion in iter_recycling_suggestions(user_id):
+                yield json.dumps(suggestion, ensure_ascii=False) + '\n'
+        
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
 
     # ========================================
     # CHATBOT
@@ -1460,6 +1500,29 @@ Difficoltà: Media"""
             }), 500
     
     
+    @app.route('/api/chatbot/message/stream', methods=['POST'])
+    @login_required
+    def api_chatbot_message_stream():
+        """API chatbot in streaming (NDJSON: eventi 'delta' col testo, poi 'done')"""
+        data = request.get_json(silent=True) or {}
+        user_message = data.get('message', '').strip()
+        conversation_context = data.get('context', '')
+        
+        if not user_message:
+            return jsonify({
+                'success': False,
+                'message': 'Messaggio vuoto'
+            }), 400
+        
+        user_id = current_user.id
+        
+        def generate():
+            for event in ai_chatbot_response_stream(user_message, user_id, conversation_context):
+                yield json.dumps(event, ensure_ascii=False) + '\n'
+        
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    
+    
     # ========================================
     # API ENDPOINTS
     # ========================================
@@ -1471,17 +1534,20 @@ Difficoltà: Media"""
         try:
             # Parametri opzionali
             servings = request.args.get('servings', type=int)
-            recipes = suggest_recipes(current_user.id, servings=servings)
             
             expiring_products = Product.query.filter(
                 Product.user_id == current_user.id,
                 Product.expiry_date <= datetime.utcnow().date() + timedelta(days=7)
             ).all()
             
-            expiring_based = []
+            # Le due richieste AI sono indipendenti: la seconda gira in parallelo
+            expiring_future = None
             if expiring_products:
                 ingredients = [(p.name, p.quantity, p.unit) for p in expiring_products]
-                expiring_based = ai_generate_recipe_suggestions(ingredients, current_user.id, max_recipes=3)
+                expiring_future = submit_ai_task(ai_generate_recipe_suggestions, ingredients, current_user.id, max_recipes=3)
+            
+            recipes = suggest_recipes(current_user.id, servings=servings)
+            expiring_based = expiring_future.result() if expiring_future else []
             
             return jsonify({
                 'success': True,
@@ -1506,8 +1572,9 @@ Difficoltà: Media"""
             servings = request.json.get('servings') if request.is_json else None
             share_with_family = bool(request.json.get('share_with_family')) if request.is_json else False
             
-            # Genera piano pasti con AI (considera vincoli famiglia se condiviso)
-            meal_plan = ai_optimize_meal_planning(current_user.id, days, share_with_family)
+            # Genera piano pasti con AI (considera vincoli famiglia se condiviso):
+            # richiesta esplicita dell'utente, quindi sempre un piano nuovo
+            meal_plan = ai_optimize_meal_planning(current_user.id, days, share_with_family, refresh=True)
             
             if not meal_plan:
                 return jsonify({
@@ -1515,6 +1582,19 @@ Difficoltà: Media"""
                     'message': 'Impossibile generare piano pasti. Verifica di avere ingredienti nella dispensa.'
                 }), 400
             
+            # Pasti senza calorie dall'AI: stima in un'unica richiesta prima del salvataggio
+            missing = [
+                meal_data for day_meals in meal_plan.values() for meal_data in day_meals
+                if not meal_data.get('calories') and meal_data.get('description')
+            ]
+            if missing:
+                estimates = ai_estimate_meals_calories(
+                    [(meal_data['description'], meal_data['meal_type']) for meal_data in missing]
+                )
+                for meal_data, nutrition in zip(missing, estimates):
+                    for field in ('calories', 'protein', 'carbs', 'fat'):
+                        meal_data[field] = nutrition.get(field, 0)
+            
             # Salva piano pasti nel database
             saved_meals = []
             today = datetime.now().date()
@@ -1568,6 +1648,7 @@ Difficoltà: Media"""
                         saved_meals.append(meal)
             
             db.session.commit()
+            invalidate_chat_context(current_user.id)
             
             # Aggiorna analytics nutrizionali per tutti i giorni del piano (solo personali per dashboard)
             from .analytics import update_daily_nutrition
@@ -1593,6 +1674,22 @@ Difficoltà: Media"""
                 'message': 'Errore nella generazione del piano pasti'
             }), 500
 
+    @app.route('/api/ai-meal-plan/stream', methods=['POST'])
+    @login_required
+    def api_ai_meal_plan_stream():
+        """API anteprima piano pasti AI in streaming (NDJSON, un giorno per riga)"""
+        days = request.json.get('days', 7) if request.is_json else 7
+        share_with_family = bool(request.json.get('share_with_family')) if request.is_json else False
+        user_id = current_user.id
+        
+        def generate():
+            # Nessun salvataggio: il piano completo resta in cache AI e viene
+            # riutilizzato dalla successiva POST /api/ai-meal-plan
+            for day_offset, meals in ai_optimize_meal_planning_stream(user_id, days, share_with_family):
+                yield json.dumps({'day': day_offset, 'meals': meals}, ensure_ascii=False) + '\n'
+        
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
     @app.route('/api/recalculate-calories/<int:meal_id>', methods=['POST'])
     @login_required
     def recalculate_calories(meal_id):
@@ -1613,6 +1710,7 @@ Difficoltà: Media"""
             meal_plan.fiber = nutrition['fiber']
             
             db.session.commit()
+            invalidate_chat_context(current_user.id)
             
             # Aggiorna analytics nutrizionali (solo personali per dashboard)
             from .analytics import update_daily_nutrition
@@ -1676,6 +1774,7 @@ Difficoltà: Media"""
                     prod.quantity = max(0.0, (prod.quantity or 0) - qty)
                     decremented.append({'name': prod.name, 'quantity': qty, 'unit': unit})
             db.session.commit()
+            invalidate_chat_context(current_user.id)
             return jsonify({'success': True, 'decremented': decremented})
         except Exception as e:
             db.session.rollback()
@@ -1709,6 +1808,7 @@ Difficoltà: Media"""
             result = create_family(current_user.id, family_name)
             
             if result['success']:
+                invalidate_profile_cache(current_user.id)
                 return jsonify({
                     'success': True,
                     'message': result['message'],
@@ -1734,6 +1834,7 @@ Difficoltà: Media"""
             result = join_family(current_user.id, family_code)
             
             if result['success']:
+                invalidate_profile_cache(current_user.id)
                 return jsonify({
                     'success': True,
                     'message': result['message']
@@ -1753,6 +1854,7 @@ Difficoltà: Media"""
             result = leave_family(current_user.id)
             
             if result['success']:
+                invalidate_profile_cache(current_user.id)
                 return jsonify({
                     'success': True,
                     'message': result['message']
@@ -1818,6 +1920,7 @@ Difficoltà: Media"""
         try:
             db.session.delete(meal)
             db.session.commit()
+            invalidate_chat_context(current_user.id)
             return jsonify({'success': True, 'message': 'Pasto eliminato con successo'})
         except Exception as e:
             db.session.rollback()
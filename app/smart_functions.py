@@ -95,16 +95,22 @@ def get_expired_products(user_id, days_overdue=0):
         Product.wasted == False  # Non ancora riciclati
     ).order_by(Product.expiry_date.desc()).all()
 
+
+def _get_recyclable_products(user_id, limit=10):
+    """Prodotti scaduti non ancora riciclati per i suggerimenti di riciclo"""
+    return Product.query.filter(
+        Product.user_id == user_id,
+        Product.expiry_date < datetime.now().date(),
+        Product.wasted == False
+    ).limit(limit).all()
+
+
 def get_recycling_suggestions(user_id):
     """Genera suggerimenti di riciclo per prodotti scaduti usando AI"""
     try:
         from .ai_functions import ai_suggest_food_recycling
         
-        expired_products = Product.query.filter(
-            Product.user_id == user_id,
-            Product.expiry_date < datetime.now().date(),
-            Product.wasted == False
-        ).limit(10).all()
+        expired_products = _get_recyclable_products(user_id)
         
         if not expired_products:
             return {
@@ -135,6 +141,22 @@ def get_recycling_suggestions(user_id):
         current_app.logger.error(f"get_recycling_suggestions error: {e}")
         return {'success': False, 'suggestions': [], 'total_products': 0}
     
+
+def iter_recycling_suggestions(user_id):
+    """
+    Suggerimenti di riciclo in streaming: un dict per prodotto
+    {product_id, product_name, recycling_options} appena disponibile
+    """
+    from .ai_functions import ai_suggest_food_recycling_stream
+    
+    for suggestion in ai_suggest_food_recycling_stream(_get_recyclable_products(user_id)):
+        yield {
+            'product_id': suggestion['product'].id,
+            'product_name': suggestion['product_name'],
+            'recycling_options': suggestion['recycling_options']
+        }
+
+
 def get_low_stock_products(user_id, threshold_multiplier=1.0):
     """
     Recupera prodotti con scorte basse
@@ -24,6 +24,11 @@ class Config:
     # ===== API KEYS =====
     GROQ_API_KEY = os.environ.get('GROQ_API_KEY')  # La chiave deve essere impostata come variabile d'ambiente
 
+    # ===== SERVER (app.py) =====
+    FLASK_DEBUG = os.environ.get('FLASK_DEBUG', 'True').lower() == 'true'
+    FLASK_HOST = os.environ.get('FLASK_HOST', '0.0.0.0')
+    FLASK_PORT = int(os.environ.get('FLASK_PORT', 5000))
+
     # ===== SESSION =====
     PERMANENT_SESSION_LIFETIME = 604800  # 7 giorni in secondi
     SESSION_COOKIE_HTTPONLY = True
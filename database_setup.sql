@@ -47,7 +47,9 @@ CREATE TABLE IF NOT EXISTS `product` (
     INDEX `idx_expiry_date` (`expiry_date`),
     INDEX `idx_category` (`category`),
     INDEX `idx_wasted` (`wasted`),
-    INDEX `idx_is_shared` (`is_shared`)
+    INDEX `idx_is_shared` (`is_shared`),
+    INDEX `idx_user_wasted_expiry` (`user_id`, `wasted`, `expiry_date`),
+    INDEX `idx_user_wasted_quantity` (`user_id`, `wasted`, `quantity`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
 
 -- ============================================
@@ -190,8 +192,8 @@ CREATE TABLE IF NOT EXISTS `nutritional_profile` (
     `gender` VARCHAR(10) DEFAULT 'male',
     `activity_level` VARCHAR(20) DEFAULT 'moderate',
     `goal` VARCHAR(20) DEFAULT 'maintain',
-    `dietary_restrictions` TEXT NULL,
-    `allergies` TEXT NULL,
+    `dietary_restrictions` JSON NULL,
+    `allergies` JSON NULL,
     `created_at` DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
     `updated_at` DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
     FOREIGN KEY (`user_id`) REFERENCES `user`(`id`) ON DELETE CASCADE,
@@ -285,6 +287,19 @@ CREATE TABLE IF NOT EXISTS `shopping_analytics` (
     INDEX `idx_user_date_shopping` (`user_id`, `date`)
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
 
+-- ============================================
+-- MIGRAZIONI (database già esistenti)
+-- ============================================
+
+-- Indici compositi per i filtri dispensa (eseguire una volta se la tabella
+-- `product` esisteva già prima dell'aggiornamento)
+-- CREATE INDEX `idx_user_wasted_expiry` ON `product` (`user_id`, `wasted`, `expiry_date`);
+-- CREATE INDEX `idx_user_wasted_quantity` ON `product` (`user_id`, `wasted`, `quantity`);
+
+-- Restrizioni e allergie come colonne JSON native (i valori esistenti sono già
+-- array JSON in formato testo, quindi la conversione è diretta)
+-- ALTER TABLE `nutritional_profile` MODIFY `dietary_restrictions` JSON NULL, MODIFY `allergies` JSON NULL;
+
 -- ============================================
 -- DATI INIZIALI
 -- ============================================